@@ -0,0 +1,207 @@
+"""Async variants of the items, search, bag and auth endpoints (DB_ASYNC).
+
+main.py mounts this router in place of the sync routes with the same path
+and method. Handlers await the asyncpg/aiosqlite engine, so a slow client
+holds a coroutine rather than a threadpool thread. The query code itself is
+shared with the sync endpoints: AsyncSession.run_sync runs it on the async
+connection without leaving the event loop.
+"""
+from typing import Literal
+
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+import config
+import bag
+from bag_buffer import bag_buffer
+from catalog import ItemQuery, item_query, parse_fields, decode_cursor, fetch_page, facet_counts, astream_json, astream_ndjson, dump_json
+from catalog_cache import cached_response_async, streamed_response_async
+from fastjson import JSONBody
+from db import get_async_session, SessionLocal, BagItem, Item, User
+from functions import (
+    create_access_token, hash_password_async, verify_password_async, needs_rehash, rehash_password,
+    get_current_user_async, get_current_user_read_async,
+)
+from replicas import async_read_session, client_wrote_recently, get_async_catalog_session, wrote_recently
+from search import search, warm_memory_index
+from suggest import suggester
+
+router = APIRouter()
+
+async def _once(build):
+    # cached_response_async takes an async iterator of chunks
+    yield await build()
+
+# ---------------- Items ----------------
+@router.get("/items")
+async def get_items(
+    cursor: str | None = Query(None, description="Opaque cursor from a previous page's next_cursor"),
+    limit: int | None = Query(None, ge=1, le=1000, description="Page size; omit to stream the whole catalog"),
+    fields: str | None = Query(None, description="Comma separated columns to return (id is always included)"),
+    fmt: Literal["json", "ndjson"] = Query("json", alias="format", description="json or newline-delimited json"),
+    q: ItemQuery = Depends(item_query),
+    with_facets: bool = Query(False, alias="facets", description="Add category/company/price/rating/discount counts (paged json only)"),
+    db: AsyncSession = Depends(get_async_catalog_session),
+):
+    cols = parse_fields(fields)
+    after = decode_cursor(cursor, q.sort) if cursor else None
+    if with_facets and (limit is None or fmt != "json"):
+        raise HTTPException(status_code=400, detail="facets need a paged json listing (set limit)")
+    if fmt == "ndjson":
+        return StreamingResponse(astream_ndjson(cols, after, limit, q), media_type="application/x-ndjson")
+
+    def page(s):
+        body = fetch_page(s, cols, after, limit, q)
+        if with_facets:
+            body["facets"] = facet_counts(s, q)
+        return body
+
+    if limit is None:
+        return streamed_response_async(("items", cols, after, q), lambda: astream_json(cols, after, q))
+    build = lambda: _once(lambda: db.run_sync(lambda s: dump_json(page(s))))
+    cached = await cached_response_async(("items", cols, after, limit, q, with_facets), build)
+    return cached if cached is not None else JSONBody(await db.run_sync(page))
+
+# ---------------- Auth ----------------
+@router.post("/register", status_code=201)
+async def register(payload: dict, db: AsyncSession = Depends(get_async_session)):
+    username = (payload.get("username") or "").strip()
+    password = (payload.get("password") or "")
+    email = (payload.get("email") or "").strip()
+
+    if not username or not password or not email:
+        raise HTTPException(status_code=400, detail="username, email and password are required")
+
+    exists = await db.scalar(select(User.id).where(or_(User.username == username, User.email == email)))
+    if exists:
+        raise HTTPException(status_code=409, detail="username or email already exists")
+
+    pwd_hash, salt = await hash_password_async(password)
+    user = User(username=username, email=email, password_hash=pwd_hash, salt=salt)
+    db.add(user)
+    try:
+        await db.commit()
+        await db.refresh(user)
+    except Exception:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail="error creating user")
+    return {"message": "User created", "user": {"id": user.id, "username": user.username, "email": user.email}}
+
+@router.post("/login")
+async def login(payload: dict, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_async_session)):
+    email = (payload.get("useremail") or "").strip()
+    password = payload.get("password") or ""
+
+    if not email or not password:
+        raise HTTPException(status_code=400, detail="email and password are required")
+
+    row = (await db.execute(
+        select(User.id, User.username, User.email, User.password_hash, User.salt).where(User.email == email)
+    )).mappings().first()
+
+    if not row:
+        raise HTTPException(status_code=404, detail="user not found")
+
+    if not await verify_password_async(password, row["password_hash"], row["salt"]):
+        raise HTTPException(status_code=401, detail="password does not match")
+
+    if needs_rehash(row["password_hash"], row["salt"]):
+        background_tasks.add_task(rehash_password, row["id"], password, row["password_hash"])
+
+    token = create_access_token(str(row["id"]), extra={"username": row["username"], "email": row["email"]})
+
+    return {
+        "access_token": token,
+        "token_type": "bearer",
+        "user": {"id": row["id"], "username": row["username"], "email": row["email"]},
+    }
+
+@router.get("/me")
+async def me(current_user: dict = Depends(get_current_user_read_async)):
+    return {"user": current_user}
+
+# ---------------- Bag ----------------
+async def _bag_write(db: AsyncSession, op: str, user_id: int, ids: list[str]) -> int:
+    """bag.add/remove, or the write-behind buffer's; both return how many products changed."""
+    if not config.settings.BAG_WRITE_BEHIND:
+        return await db.run_sync(getattr(bag, op), user_id, ids)
+
+    def tap():
+        # The buffer appends (and may fsync) its log: that stays off the event loop
+        with SessionLocal() as s:
+            return getattr(bag_buffer, op)(s, user_id, ids)
+
+    return await run_in_threadpool(tap)
+
+@router.post("/bag", status_code=201)
+async def add_to_bag(payload: dict, current_user: dict = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_session)):
+    product_id = (payload.get("product_id") or "").strip()
+    if not product_id:
+        raise HTTPException(status_code=400, detail="product_id is required")
+    # Nothing added is either already in the bag or not in the catalog
+    if not await _bag_write(db, "add", current_user["id"], [product_id]) and await db.get(Item, product_id) is None:
+        raise HTTPException(status_code=404, detail="product not found")
+    return {"ok": True, "product_id": product_id}
+
+# Registered before /bag/{product_id} so "batch" isn't taken for a product id
+@router.post("/bag/batch", status_code=201)
+async def add_to_bag_batch(payload: dict, current_user: dict = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_session)):
+    ids = bag.product_ids(payload)
+    return {"ok": True, "added": await _bag_write(db, "add", current_user["id"], ids)}
+
+@router.delete("/bag/batch")
+async def remove_from_bag_batch(payload: dict, current_user: dict = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_session)):
+    ids = bag.product_ids(payload)
+    return {"ok": True, "removed": await _bag_write(db, "remove", current_user["id"], ids)}
+
+@router.delete("/bag/{product_id}")
+async def remove_from_bag(product_id: str, current_user: dict = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_session)):
+    if not await _bag_write(db, "remove", current_user["id"], [product_id]):
+        raise HTTPException(status_code=404, detail="not found")
+    return {"ok": True}
+
+@router.get("/bag/ids")
+async def get_bag_ids(request: Request, current_user: dict = Depends(get_current_user_read_async)):
+    user_id = current_user["id"]
+    # A replica may not have this user's own recent taps yet, and the write-behind buffer keeps what it reads
+    primary = config.settings.BAG_WRITE_BEHIND or wrote_recently(("bag", user_id)) or client_wrote_recently(request)
+    async with async_read_session(primary=primary) as db:
+        if config.settings.BAG_WRITE_BEHIND:
+            return {"ids": await db.run_sync(bag_buffer.ids, user_id)}
+        ids = (await db.execute(select(BagItem.product_id).where(BagItem.user_id == user_id))).scalars().all()
+    return {"ids": ids}
+
+@router.get("/bag")
+async def get_bag(current_user: dict = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_session)):
+    if config.settings.BAG_WRITE_BEHIND and bag_buffer.dirty(current_user["id"]):
+        await run_in_threadpool(bag_buffer.flush)  # the flusher writes through the sync engine
+    items = await db.run_sync(bag.with_items, current_user["id"])
+    return JSONBody({"items": items, "count": len(items)})
+
+# ---------------- Search ----------------
+@router.get("/search/items")
+async def search_items(
+    q: str = Query(..., min_length=1, description="Free text search"),
+    limit: int = Query(50, ge=1, le=200, description="Max items to return"),
+    offset: int = Query(0, ge=0, le=config.settings.SEARCH_MAX_OFFSET, description="Results to skip; use cursor for deeper pages"),
+    cursor: str | None = Query(None, description="next_cursor from the previous page"),
+    mode: Literal["fts","like","fuzzy","memory"] = Query("fts", description="fts, substring (like), typo-tolerant (fuzzy) or in-process index (memory)"),
+    op:   Literal["AND","OR"] = Query("AND", description="Combine words for like/fuzzy/memory"),
+    db: AsyncSession = Depends(get_async_catalog_session)
+):
+    run = lambda s: search(s, q, limit, offset, cursor, mode, op)
+    build = lambda: _once(lambda: db.run_sync(lambda s: dump_json(run(s))))
+    cached = await cached_response_async(("search", q, limit, offset, cursor, mode, op), build)
+    return cached if cached is not None else JSONBody(await db.run_sync(run))
+
+@router.get("/search/suggest")
+async def search_suggest(
+    q: str = Query(..., min_length=1, description="What the user has typed so far"),
+    limit: int = Query(5, ge=1, le=config.settings.SUGGEST_MAX_LIMIT, description="Completions to return"),
+    db: AsyncSession = Depends(get_async_catalog_session)
+):
+    await db.run_sync(warm_memory_index, suggester)
+    return {"suggestions": suggester.complete(q, limit)}
@@ -0,0 +1,71 @@
+from __future__ import annotations
+from typing import Any, Dict, Iterable, List
+
+from fastapi import HTTPException
+from sqlalchemy import select, delete, literal
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+import replicas
+from catalog import ITEM_FIELDS
+from config import settings
+from db import BagItem, Item, engine
+
+# INSERT ... ON CONFLICT DO NOTHING comes from the dialect's own insert()
+_insert = postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert
+_BAG_COLUMNS = [getattr(Item, f) for f in ITEM_FIELDS]
+
+def product_ids(payload: Dict[str, Any]) -> List[str]:
+    """Validated, de-duplicated `product_ids` from a batch request body."""
+    raw = payload.get("product_ids")
+    if not isinstance(raw, list) or not raw:
+        raise HTTPException(status_code=400, detail="product_ids must be a non-empty list")
+    ids = list(dict.fromkeys(str(p).strip() for p in raw if str(p).strip()))
+    if not ids:
+        raise HTTPException(status_code=400, detail="product_ids must be a non-empty list")
+    if len(ids) > settings.BAG_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"at most {settings.BAG_BATCH_MAX} product_ids per request")
+    return ids
+
+def insert_statement(user_id: int, ids: Iterable[str]):
+    """INSERT of the catalog products among `ids` into a bag, skipping ones already there."""
+    known = select(literal(user_id), Item.id).where(Item.id.in_(list(ids)))
+    return (
+        _insert(BagItem)
+        .from_select(["user_id", "product_id"], known)
+        .on_conflict_do_nothing(index_elements=["user_id", "product_id"])
+    )
+
+def delete_statement(user_id: int, ids: Iterable[str]):
+    return delete(BagItem).where(BagItem.user_id == user_id, BagItem.product_id.in_(list(ids)))
+
+def add(db: Session, user_id: int, ids: Iterable[str]) -> int:
+    """Add products to a bag in one statement. Returns rows added.
+
+    Products already in the bag, or not in the catalog (product_id is a
+    foreign key), are skipped.
+    """
+    stmt = insert_statement(user_id, ids)
+    # rowcount isn't reliable for multi-row inserts on every driver; RETURNING lists exactly the new rows
+    added = len(db.execute(stmt.returning(BagItem.product_id)).all())
+    db.commit()
+    replicas.note_write(("bag", user_id))
+    return added
+
+def remove(db: Session, user_id: int, ids: List[str]) -> int:
+    """Remove products from a bag in one statement. Returns rows removed."""
+    res = db.execute(delete_statement(user_id, ids))
+    db.commit()
+    replicas.note_write(("bag", user_id))
+    return res.rowcount
+
+def with_items(db: Session, user_id: int) -> List[Dict[str, Any]]:
+    """The bag's products with their catalog rows, oldest first, in one query."""
+    stmt = (
+        select(*_BAG_COLUMNS, BagItem.added_at)
+        .select_from(BagItem)
+        .join(Item, Item.id == BagItem.product_id)
+        .where(BagItem.user_id == user_id)
+        .order_by(BagItem.added_at, BagItem.product_id)
+    )
+    return [dict(r) for r in db.execute(stmt).mappings()]
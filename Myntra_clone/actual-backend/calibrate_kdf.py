@@ -0,0 +1,64 @@
+# calibrate_kdf.py
+# Benchmark the password KDF on this machine and print the cost that lands
+# closest to a target per-hash latency, ready to paste into .env.
+#
+#   python calibrate_kdf.py --scheme pbkdf2_sha256 --target-ms 250
+#   python calibrate_kdf.py --scheme scrypt --target-ms 100
+
+import argparse
+import secrets
+import statistics
+import time
+
+import passwords
+
+def time_hash(scheme: str, params: dict, samples: int) -> float:
+    """Median milliseconds for one hash at `params`."""
+    salt_hex = secrets.token_bytes(16).hex()
+    runs = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        passwords.derive(scheme, params, "calibration-password", salt_hex)
+        runs.append((time.perf_counter() - start) * 1000)
+    return statistics.median(runs)
+
+def calibrate_pbkdf2(target_ms: float, samples: int) -> tuple[dict, float]:
+    # PBKDF2 cost is linear in iterations: measure once, scale, then confirm
+    probe = 50_000
+    per_iter = time_hash("pbkdf2_sha256", {"i": probe}, samples) / probe
+    iterations = max(10_000, round(target_ms / per_iter / 10_000) * 10_000)
+    params = {"i": iterations}
+    return params, time_hash("pbkdf2_sha256", params, samples)
+
+def calibrate_scrypt(target_ms: float, samples: int, r: int, p: int) -> tuple[dict, float]:
+    # scrypt's N must be a power of two: keep doubling while we stay under the target
+    best = {"n": 2 ** 12, "r": r, "p": p}
+    best_ms = time_hash("scrypt", best, samples)
+    while True:
+        candidate = {"n": best["n"] * 2, "r": r, "p": p}
+        ms = time_hash("scrypt", candidate, samples)
+        if ms > target_ms:
+            return best, best_ms
+        best, best_ms = candidate, ms
+
+def main():
+    ap = argparse.ArgumentParser(description="Pick a password KDF cost for a target latency.")
+    ap.add_argument("--scheme", choices=passwords.SCHEMES, default="pbkdf2_sha256")
+    ap.add_argument("--target-ms", type=float, default=250.0, help="desired time for one hash")
+    ap.add_argument("--samples", type=int, default=5, help="hashes timed per measurement")
+    ap.add_argument("--scrypt-r", type=int, default=8)
+    ap.add_argument("--scrypt-p", type=int, default=1)
+    args = ap.parse_args()
+
+    if args.scheme == "scrypt":
+        params, ms = calibrate_scrypt(args.target_ms, args.samples, args.scrypt_r, args.scrypt_p)
+        env = ["PASSWORD_SCHEME=scrypt", f"SCRYPT_N={params['n']}", f"SCRYPT_R={params['r']}", f"SCRYPT_P={params['p']}"]
+    else:
+        params, ms = calibrate_pbkdf2(args.target_ms, args.samples)
+        env = ["PASSWORD_SCHEME=pbkdf2_sha256", f"PBKDF2_ITERATIONS={params['i']}"]
+
+    print(f"{args.scheme} {params} -> {ms:.1f} ms per hash (target {args.target_ms:.0f} ms)")
+    print("\n".join(env))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+from __future__ import annotations
+import base64, json
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Iterator, Literal, Sequence, Tuple
+
+from fastapi import HTTPException, Query
+from sqlalchemy import select, func, tuple_
+from sqlalchemy.orm import Session
+
+import facets
+from config import settings
+from fastjson import dumps
+from db import Item
+from replicas import catalog_engine, async_catalog_engine
+
+# Public item columns, in response order (internal columns such as tsv are never exposed)
+ITEM_FIELDS: tuple[str, ...] = (
+    "id", "image", "company", "item_name", "original_price", "current_price",
+    "discount_percentage", "return_period", "delivery_date", "rating_stars",
+    "rating_count", "category", "tags",
+)
+# Rows fetched per server-side cursor round-trip and per streamed chunk
+STREAM_BATCH = 1000
+
+Sort = Literal["id", "price_asc", "price_desc", "discount", "rating"]
+# sort -> (column, descending); ties break on id in the same direction so one (column, id) index serves both
+SORTS: Dict[str, Tuple[str, bool]] = {
+    "id": ("id", False),
+    "price_asc": ("current_price", False),
+    "price_desc": ("current_price", True),
+    "discount": ("discount_percentage", True),
+    "rating": ("rating_stars", True),
+}
+# Facet thresholds, as offered by the filter UI ("4★ & above", "30% and more")
+RATING_BUCKETS = (4, 3, 2, 1)
+DISCOUNT_BUCKETS = (10, 20, 30, 40, 50, 60, 70, 80, 90)
+
+def dump_json(payload: Any) -> bytes:
+    return dumps(payload)
+
+# ---------- Projection ----------
+def parse_fields(fields: str | None) -> tuple[str, ...]:
+    """Turn `fields=a,b` into a column tuple; `id` is always kept for the keyset."""
+    if not fields:
+        return ITEM_FIELDS
+    wanted = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in wanted if f not in ITEM_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"unknown fields: {', '.join(unknown)}")
+    return tuple(dict.fromkeys(["id", *wanted]))
+
+# ---------- Filters & sorts ----------
+@dataclass(frozen=True)
+class ItemQuery:
+    """Server-side filters and sort for /items; hashable, so it can be part of a cache key."""
+    category: Tuple[str, ...] = ()
+    company: Tuple[str, ...] = ()
+    min_price: float | None = None
+    max_price: float | None = None
+    min_discount: int | None = None
+    min_rating: float | None = None
+    sort: Sort = "id"
+
+    def conditions(self, skip: str | None = None) -> list:
+        """WHERE clauses for the active filters, leaving out facet `skip` (to count its alternatives)."""
+        conds = []
+        if self.category and skip != "category":
+            conds.append(Item.category.in_(self.category))
+        if self.company and skip != "company":
+            conds.append(Item.company.in_(self.company))
+        if skip != "price":
+            if self.min_price is not None:
+                conds.append(Item.current_price >= self.min_price)
+            if self.max_price is not None:
+                conds.append(Item.current_price <= self.max_price)
+        if self.min_discount is not None and skip != "discount":
+            conds.append(Item.discount_percentage >= self.min_discount)
+        if self.min_rating is not None and skip != "rating":
+            conds.append(Item.rating_stars >= self.min_rating)
+        return conds
+
+ALL_ITEMS = ItemQuery()
+
+async def item_query(
+    category: list[str] = Query([], description="Only these categories (repeatable)"),
+    company: list[str] = Query([], description="Only these companies (repeatable)"),
+    min_price: float | None = Query(None, ge=0),
+    max_price: float | None = Query(None, ge=0),
+    min_discount: int | None = Query(None, ge=0, le=100, description="Minimum discount percentage"),
+    min_rating: float | None = Query(None, ge=0, le=5, description="Minimum rating stars"),
+    sort: Sort = Query("id", description="id, price_asc, price_desc, discount or rating; items without that value are left out"),
+) -> ItemQuery:
+    """/items filter and sort parameters, shared by the sync and async endpoints.
+
+    async only so FastAPI calls it inline instead of on a threadpool thread.
+    """
+    return ItemQuery(tuple(sorted(set(category))), tuple(sorted(set(company))), min_price, max_price, min_discount, min_rating, sort)
+
+# ---------- Keyset cursor ----------
+# Position after the last row served: (sort value, id); the value is None for the id sort
+After = Tuple[Any, str]
+
+def encode_cursor(last_id: str, sort: Sort = "id", value: Any = None) -> str:
+    payload = [last_id] if sort == "id" else [sort, value, last_id]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, sort: Sort = "id") -> After:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if sort == "id":
+            (last_id,) = payload
+            return None, str(last_id)
+        cursor_sort, value, last_id = payload
+        # A cursor only makes sense for the ordering that produced it
+        if cursor_sort != sort or not isinstance(value, (int, float)):
+            raise ValueError(cursor_sort)
+        return value, str(last_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid cursor")
+
+def _select(fields: Sequence[str], after: After | None, q: ItemQuery = ALL_ITEMS):
+    """Keyset query for `q`; with a sort, the sort column is appended after `fields` for the cursor."""
+    cols = [getattr(Item, f) for f in fields]
+    stmt = select(*cols).where(*q.conditions())
+    if q.sort == "id":
+        stmt = stmt.order_by(Item.id)
+        if after is not None:
+            stmt = stmt.where(Item.id > after[1])
+        return stmt
+    name, desc = SORTS[q.sort]
+    col = getattr(Item, name)
+    # Items without a value for the sort column have no place in that order and are left out
+    stmt = stmt.add_columns(col).where(col.is_not(None))
+    if desc:
+        stmt = stmt.order_by(col.desc(), Item.id.desc())
+    else:
+        stmt = stmt.order_by(col, Item.id)
+    if after is not None:
+        key, last = tuple_(col, Item.id), tuple_(*after)
+        stmt = stmt.where(key < last if desc else key > last)
+    return stmt
+
+# ---------- Paged listing ----------
+def fetch_page(
+    db: Session, fields: Sequence[str], after: After | None, limit: int, q: ItemQuery = ALL_ITEMS,
+) -> Dict[str, Any]:
+    # One extra row tells us whether another page exists without a COUNT(*)
+    rows = db.execute(_select(fields, after, q).limit(limit + 1)).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "items": [dict(zip(fields, r)) for r in rows],
+        # rows[-1][-1] is the sort column _select appended (unused for the id sort)
+        "next_cursor": encode_cursor(rows[-1][0], q.sort, rows[-1][-1]) if has_more else None,
+    }
+
+# ---------- Facets ----------
+def facet_counts(db: Session, q: ItemQuery) -> Dict[str, Any]:
+    """Counts for the filter UI.
+
+    Each facet is counted under every active filter except its own, so the
+    alternatives to the current selection keep their counts.
+    """
+    n = func.count()
+    out: Dict[str, Any] = {}
+    unfiltered = q == ItemQuery(sort=q.sort)
+    for field in ("category", "company"):
+        if unfiltered:
+            # Nothing to narrow by: the precomputed counts are the answer
+            out[field] = facets.values(db, field, settings.ITEMS_FACET_LIMIT)
+            continue
+        col = getattr(Item, field)
+        rows = db.execute(
+            select(col, n).where(col.is_not(None), *q.conditions(skip=field))
+            .group_by(col).order_by(n.desc(), col).limit(settings.ITEMS_FACET_LIMIT)
+        ).all()
+        out[field] = [{"value": v, "count": c} for v, c in rows]
+    lo, hi = db.execute(
+        select(func.min(Item.current_price), func.max(Item.current_price)).where(*q.conditions(skip="price"))
+    ).one()
+    out["price"] = {"min": lo, "max": hi}
+    rating = db.execute(
+        select(*(n.filter(Item.rating_stars >= b) for b in RATING_BUCKETS)).where(*q.conditions(skip="rating"))
+    ).one()
+    out["rating"] = [{"min": b, "count": c} for b, c in zip(RATING_BUCKETS, rating)]
+    discount = db.execute(
+        select(*(n.filter(Item.discount_percentage >= b) for b in DISCOUNT_BUCKETS)).where(*q.conditions(skip="discount"))
+    ).one()
+    out["discount"] = [{"min": b, "count": c} for b, c in zip(DISCOUNT_BUCKETS, discount)]
+    return out
+
+# ---------- Streaming ----------
+def iter_rows(
+    fields: Sequence[str], after: After | None = None, limit: int | None = None, q: ItemQuery = ALL_ITEMS,
+) -> Iterator[Dict[str, Any]]:
+    """Yield rows from a server-side cursor; never materialises the whole table."""
+    stmt = _select(fields, after, q)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    # Own connection: the request-scoped session may be closed before the body is sent
+    with catalog_engine().connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=STREAM_BATCH).execute(stmt)
+        for row in result:
+            yield dict(zip(fields, row))
+
+async def aiter_rows(
+    fields: Sequence[str], after: After | None = None, limit: int | None = None, q: ItemQuery = ALL_ITEMS,
+) -> AsyncIterator[Dict[str, Any]]:
+    """iter_rows on the async engine (DB_ASYNC)."""
+    stmt = _select(fields, after, q)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    async with async_catalog_engine().connect() as conn:
+        result = await conn.stream(stmt, execution_options={"yield_per": STREAM_BATCH})
+        async for row in result:
+            yield dict(zip(fields, row))
+
+def _row_batches(fields: Sequence[str], after: After | None, limit: int | None, q: ItemQuery) -> Iterator[list]:
+    batch: list = []
+    for row in iter_rows(fields, after, limit, q):
+        batch.append(row)
+        if len(batch) >= STREAM_BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def _arow_batches(fields: Sequence[str], after: After | None, limit: int | None, q: ItemQuery) -> AsyncIterator[list]:
+    batch: list = []
+    async for row in aiter_rows(fields, after, limit, q):
+        batch.append(row)
+        if len(batch) >= STREAM_BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _ndjson(batch: list) -> bytes:
+    return b"".join(dumps(row) + b"\n" for row in batch)
+
+def _json_elements(batch: list) -> bytes:
+    # One encoder call per batch: the batch as a JSON array, without its brackets
+    return dumps(batch)[1:-1]
+
+def stream_ndjson(
+    fields: Sequence[str], after: After | None = None, limit: int | None = None, q: ItemQuery = ALL_ITEMS,
+) -> Iterator[bytes]:
+    for batch in _row_batches(fields, after, limit, q):
+        yield _ndjson(batch)
+
+def stream_json(fields: Sequence[str], after: After | None = None, q: ItemQuery = ALL_ITEMS) -> Iterator[bytes]:
+    """Chunked body with the same `{"items": [...]}` shape as the unpaged listing."""
+    yield b'{"items":['
+    sep = b""
+    for batch in _row_batches(fields, after, None, q):
+        yield sep + _json_elements(batch)
+        sep = b","
+    yield b"]}"
+
+async def astream_ndjson(
+    fields: Sequence[str], after: After | None = None, limit: int | None = None, q: ItemQuery = ALL_ITEMS,
+) -> AsyncIterator[bytes]:
+    async for batch in _arow_batches(fields, after, limit, q):
+        yield _ndjson(batch)
+
+async def astream_json(fields: Sequence[str], after: After | None = None, q: ItemQuery = ALL_ITEMS) -> AsyncIterator[bytes]:
+    yield b'{"items":['
+    sep = b""
+    async for batch in _arow_batches(fields, after, None, q):
+        yield sep + _json_elements(batch)
+        sep = b","
+    yield b"]}"
@@ -0,0 +1,247 @@
+from __future__ import annotations
+import asyncio, math, secrets, threading, time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Hashable, Iterable, Iterator
+
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+
+from config import settings
+
+@dataclass(frozen=True)
+class Snapshot:
+    body: bytes
+    version: int
+    window: int
+
+class CatalogCache:
+    """Process-wide cache of pre-serialised catalog responses.
+
+    Entries belong to a catalog version. Writes to the items table in this
+    process bump the version and drop every entry; writes made by other
+    workers (or by sql_convert.py) become visible once entries expire, at the
+    next multiple of `ttl` seconds on the wall clock (the same for every worker).
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.version = 0
+        self.changed_at = -math.inf  # monotonic time of the last invalidate()
+        self.modified_at = time.time()  # wall-clock time of the last invalidate(), or of startup
+        # Tells this process's versions apart from other workers' (each counts its own writes)
+        self.epoch = secrets.token_hex(4)
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, Snapshot] = OrderedDict()
+        self._too_large: set[Hashable] = set()
+        self._building: dict[Hashable, threading.Lock] = {}
+        self._abuilding: dict[Hashable, asyncio.Lock] = {}
+
+    def invalidate(self) -> None:
+        # HTTP dates have one-second resolution: move Last-Modified past any value already sent
+        last_modified = self.validators()[1]
+        with self._lock:
+            self.version += 1
+            self.changed_at = time.monotonic()
+            self.modified_at = max(time.time(), math.floor(last_modified) + 1)
+            self._entries.clear()
+            self._too_large.clear()
+
+    def window(self) -> int:
+        """Which `ttl`-long wall-clock window this is; entries never outlive the one they were built in."""
+        return int(time.time() // self.ttl) if self.ttl else 0
+
+    def validators(self) -> tuple[str, float]:
+        """(version token, last-modified time) for HTTP caching (http_cache.py), without a query.
+
+        The token changes on every write in this process and at every window
+        boundary, when other workers' writes become visible here. Workers that
+        have not written themselves agree on both values.
+        """
+        window = self.window()
+        with self._lock:
+            version, modified_at = self.version, self.modified_at
+        if not self.ttl:
+            return f"{self.epoch}.{version}", modified_at
+        if not version:
+            return str(window), window * self.ttl
+        return f"{window}.{self.epoch}.{version}", max(modified_at, window * self.ttl)
+
+    def _lookup(self, key: Hashable) -> Snapshot | None:
+        with self._lock:
+            snap = self._entries.get(key)
+            if snap is None:
+                return None
+            if snap.window != self.window():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return snap
+
+    def get(self, key: Hashable, build: Callable[[], Iterable[bytes]]) -> Snapshot | None:
+        """Return the cached body for `key`, building it once on a miss.
+
+        Returns None when the body is larger than `max_bytes`; the caller should
+        then serve the request uncached.
+        """
+        snap = self._lookup(key)
+        if snap is not None:
+            return snap
+        with self._lock:
+            if key in self._too_large:
+                return None
+            key_lock = self._building.setdefault(key, threading.Lock())
+        # Concurrent misses on the same key wait for a single build
+        with key_lock:
+            try:
+                snap = self._lookup(key)
+                if snap is not None or self._gave_up(key):
+                    return snap
+                version = self.version
+                chunks, size = [], 0
+                for chunk in build():
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        return self._give_up(key)
+                    chunks.append(chunk)
+                return self._keep(key, b"".join(chunks), version)
+            finally:
+                with self._lock:
+                    self._building.pop(key, None)
+
+    async def aget(self, key: Hashable, build: Callable[[], AsyncIterator[bytes]]) -> Snapshot | None:
+        """`get` for the async endpoints: concurrent misses wait on an asyncio lock, not a thread lock."""
+        snap = self._lookup(key)
+        if snap is not None:
+            return snap
+        with self._lock:
+            if key in self._too_large:
+                return None
+            key_lock = self._abuilding.setdefault(key, asyncio.Lock())
+        async with key_lock:
+            try:
+                snap = self._lookup(key)
+                if snap is not None or self._gave_up(key):
+                    return snap
+                version = self.version
+                chunks, size = [], 0
+                async for chunk in build():
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        return self._give_up(key)
+                    chunks.append(chunk)
+                return self._keep(key, b"".join(chunks), version)
+            finally:
+                with self._lock:
+                    self._abuilding.pop(key, None)
+
+    def tee(self, key: Hashable, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Pass a streamed body through as it is built, keeping a copy if it ends within `max_bytes`."""
+        version, kept, size = self.version, [], 0
+        for chunk in chunks:
+            yield chunk
+            kept, size = self._collect(key, kept, size, chunk)
+        if kept is not None:
+            self._keep(key, b"".join(kept), version)
+
+    async def atee(self, key: Hashable, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        version, kept, size = self.version, [], 0
+        async for chunk in chunks:
+            yield chunk
+            kept, size = self._collect(key, kept, size, chunk)
+        if kept is not None:
+            self._keep(key, b"".join(kept), version)
+
+    def _collect(self, key: Hashable, kept: list | None, size: int, chunk: bytes) -> tuple[list | None, int]:
+        if kept is None:
+            return None, size
+        size += len(chunk)
+        if size > self.max_bytes:
+            self._give_up(key)
+            return None, size
+        kept.append(chunk)
+        return kept, size
+
+    def _gave_up(self, key: Hashable) -> bool:
+        # Set by a build that finished while this request waited for the key's lock
+        with self._lock:
+            return key in self._too_large
+
+    def _give_up(self, key: Hashable) -> None:
+        with self._lock:
+            self._too_large.add(key)
+        return None
+
+    def _keep(self, key: Hashable, body: bytes, version: int) -> Snapshot:
+        snap = Snapshot(body=body, version=version, window=self.window())
+        with self._lock:
+            # A write that landed mid-build makes this body stale: serve it once, don't keep it
+            if version == self.version:
+                self._entries[key] = snap
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return snap
+
+catalog_cache = CatalogCache(
+    max_entries=settings.CATALOG_CACHE_MAX_ENTRIES,
+    max_bytes=settings.CATALOG_CACHE_MAX_BYTES,
+    ttl=settings.CATALOG_CACHE_TTL_SECONDS,
+)
+
+def cached_response(
+    key: Hashable,
+    build: Callable[[], Iterable[bytes]],
+    media_type: str = "application/json",
+) -> Response | None:
+    """Serve `key` from the catalog cache (validators and 304s come from http_cache.py).
+
+    Returns None when caching is disabled or the body is too large to keep.
+    """
+    if not settings.CATALOG_CACHE_ENABLED:
+        return None
+    snap = catalog_cache.get(key, build)
+    return None if snap is None else Response(content=snap.body, media_type=media_type)
+
+async def cached_response_async(
+    key: Hashable,
+    build: Callable[[], AsyncIterator[bytes]],
+    media_type: str = "application/json",
+) -> Response | None:
+    """cached_response for the async endpoints; `build` yields the body's chunks asynchronously."""
+    if not settings.CATALOG_CACHE_ENABLED:
+        return None
+    snap = await catalog_cache.aget(key, build)
+    return None if snap is None else Response(content=snap.body, media_type=media_type)
+
+def _streamed(key: Hashable, build: Callable, tee: Callable, media_type: str) -> Response:
+    if not settings.CATALOG_CACHE_ENABLED:
+        return StreamingResponse(build(), media_type=media_type)
+    snap = catalog_cache._lookup(key)
+    if snap is not None:
+        return Response(content=snap.body, media_type=media_type)
+    if catalog_cache._gave_up(key):
+        return StreamingResponse(build(), media_type=media_type)
+    return StreamingResponse(tee(key, build()), media_type=media_type)
+
+def streamed_response(
+    key: Hashable,
+    build: Callable[[], Iterable[bytes]],
+    media_type: str = "application/json",
+) -> Response:
+    """Serve a streamed body (the whole catalog) from the cache, else stream it as it is read.
+
+    A miss is never buffered before the first byte: the body goes out chunk by
+    chunk and is kept on the way if it ends within CATALOG_CACHE_MAX_BYTES.
+    Bodies known to be larger are streamed without collecting them.
+    """
+    return _streamed(key, build, catalog_cache.tee, media_type)
+
+def streamed_response_async(
+    key: Hashable,
+    build: Callable[[], AsyncIterator[bytes]],
+    media_type: str = "application/json",
+) -> Response:
+    """streamed_response for the async endpoints; `build` yields the body's chunks asynchronously."""
+    return _streamed(key, build, catalog_cache.atee, media_type)
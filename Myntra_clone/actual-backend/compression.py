@@ -0,0 +1,173 @@
+"""gzip / brotli response compression, negotiated from Accept-Encoding.
+
+JSON and text bodies of at least COMPRESS_MIN_BYTES are compressed; streamed
+bodies (the whole-catalog and ndjson listings) are compressed chunk by chunk,
+flushed after each so clients can start parsing. brotli is preferred when the
+brotli package is installed and the client accepts it, gzip otherwise.
+
+A compressed body gets its own ETag (the original plus -br / -gzip) since a
+strong ETag names one exact byte sequence. Bodies that carry an ETag
+(http_cache.py's catalog responses) are compressed once per ETag and coding;
+the output is kept, least recently used first out, up to
+COMPRESS_CACHE_MAX_BYTES.
+"""
+from __future__ import annotations
+import zlib
+from collections import OrderedDict
+from typing import Callable, Tuple
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import metrics
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+_COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+# Bodies (or stream chunks) this large are compressed off the event loop
+_THREAD_MIN_BYTES = 64 * 1024
+
+def negotiate(accept_encoding: str) -> str | None:
+    """"br", "gzip" or None (identity) for an Accept-Encoding header, honouring q-values."""
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, *params = part.split(";")
+        weight = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key.lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        if name.strip():
+            weights[name.strip().lower()] = weight
+    wildcard = weights.get("*", 0.0)
+    offered = ("br", "gzip") if brotli is not None else ("gzip",)
+    best = max(offered, key=lambda c: weights.get(c, wildcard))  # ties go to the first offered
+    return best if weights.get(best, wildcard) > 0 else None
+
+def _tagged(etag: str, coding: str) -> str:
+    return etag[:-1] + f'-{coding}"' if etag.endswith('"') else etag
+
+class _Stream:
+    """Incremental compressor for one streamed body."""
+
+    def __init__(self, coding: str, gzip_level: int, brotli_quality: int):
+        if coding == "br":
+            c = brotli.Compressor(quality=brotli_quality)
+            self.chunk: Callable[[bytes], bytes] = lambda data: c.process(data) + c.flush()
+            self.finish: Callable[[], bytes] = c.finish
+        else:
+            z = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)  # wbits 31: gzip container
+            self.chunk = lambda data: z.compress(data) + z.flush(zlib.Z_SYNC_FLUSH)
+            self.finish = z.flush
+
+class CompressMiddleware:
+    def __init__(
+        self, app: ASGIApp, min_bytes: int = 1024, gzip_level: int = 6,
+        brotli_quality: int = 4, cache_max_bytes: int = 32 * 1024 * 1024,
+    ):
+        self.app = app
+        self.min_bytes = min_bytes
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.cache_max_bytes = cache_max_bytes
+        # (etag, coding) -> compressed body; only touched from the event loop
+        self._cache: OrderedDict[Tuple[str, str], bytes] = OrderedDict()
+        self._cache_bytes = 0
+        self.bytes_in = metrics.counter("compression.bytes_in")
+        self.bytes_out = metrics.counter("compression.bytes_out")
+        self.cache_hits = metrics.counter("compression.cache_hits")
+
+    def _compress(self, body: bytes, coding: str) -> bytes:
+        if coding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        z = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)
+        return z.compress(body) + z.flush()
+
+    async def _compress_body(self, body: bytes, coding: str, etag: str | None) -> bytes:
+        key = (etag, coding)
+        if etag is not None and key in self._cache:
+            self._cache.move_to_end(key)
+            self.cache_hits.inc()
+            return self._cache[key]
+        if len(body) >= _THREAD_MIN_BYTES:
+            data = await run_in_threadpool(self._compress, body, coding)
+        else:
+            data = self._compress(body, coding)
+        if etag is not None and len(data) <= self.cache_max_bytes:
+            self._cache[key] = data
+            self._cache_bytes += len(data)
+            while self._cache_bytes > self.cache_max_bytes:
+                self._cache_bytes -= len(self._cache.popitem(last=False)[1])
+        return data
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        coding = negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        start: Message | None = None  # held until the first body message shows the size
+        passthrough = False
+        stream: _Stream | None = None
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start, passthrough, stream
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                content_type = headers.get("content-type", "")
+                if "content-encoding" in headers or not content_type.startswith(_COMPRESSIBLE_TYPES):
+                    passthrough = True
+                    await send(message)
+                    return
+                headers.add_vary_header("Accept-Encoding")
+                if coding is None:
+                    passthrough = True
+                    await send(message)
+                    return
+                start = message
+                return
+
+            body, more = message.get("body", b""), message.get("more_body", False)
+            headers = MutableHeaders(scope=start)
+            if stream is None:
+                if not more and len(body) < self.min_bytes:
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                headers["Content-Encoding"] = coding
+                etag = headers.get("etag")
+                if etag is not None:
+                    headers["ETag"] = _tagged(etag, coding)
+                if not more:
+                    # The whole body in one message
+                    data = await self._compress_body(body, coding, etag)
+                    headers["Content-Length"] = str(len(data))
+                    self.bytes_in.inc(len(body))
+                    self.bytes_out.inc(len(data))
+                    await send(start)
+                    await send({"type": "http.response.body", "body": data})
+                    return
+                del headers["Content-Length"]
+                stream = _Stream(coding, self.gzip_level, self.brotli_quality)
+                await send(start)
+            if len(body) >= _THREAD_MIN_BYTES:
+                data = await run_in_threadpool(stream.chunk, body)
+            else:
+                data = stream.chunk(body)
+            if not more:
+                data += stream.finish()
+            self.bytes_in.inc(len(body))
+            self.bytes_out.inc(len(data))
+            await send({"type": "http.response.body", "body": data, "more_body": more})
+
+        await self.app(scope, receive, send_compressed)
@@ -1,14 +1,33 @@
 from pathlib import Path
-import json
-from sqlalchemy import create_engine, text, String, Integer, Float, Text, TIMESTAMP
+from sqlalchemy import (
+    create_engine, text, inspect, insert, select, Computed, ForeignKey, Index, String, Integer, Float, Text, TIMESTAMP,
+)
+from sqlalchemy.engine import URL, Connection, Engine, make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, DeclarativeBase, Mapped, mapped_column
 from sqlalchemy.sql import func
 from sqlalchemy.dialects.postgresql import TSVECTOR
 from config import settings
-from typing import Any, Generator
+import db_pool
+import facets
+from catalog_cache import catalog_cache
+from ingest import IngestStats, load_feed
+from typing import Any, AsyncGenerator, Generator, List, Tuple
 
 file_path = Path("items.json")
 
+# Generated search column; the same expression backs the GIN index
+TSV_EXPR = (
+    "to_tsvector('simple', coalesce(item_name,'') || ' ' || coalesce(company,'') || ' ' || "
+    "coalesce(category,'') || ' ' || coalesce(tags,''))"
+)
+# Lower-cased text the substring/fuzzy search runs over; pg_trgm indexes exactly this expression
+SEARCH_TEXT_SQL = (
+    "lower(coalesce(item_name,'') || ' ' || coalesce(company,'') || ' ' || "
+    "coalesce(category,'') || ' ' || coalesce(tags,''))"
+)
+
 # ---------------- Base ----------------
 class Base(DeclarativeBase):
     pass
@@ -29,7 +48,19 @@ class Item(Base):
     rating_count: Mapped[int | None] = mapped_column(Integer)
     category: Mapped[str | None] = mapped_column(String(128))
     tags: Mapped[str | None] = mapped_column(Text)
-    tsv: Mapped[Any] = mapped_column(TSVECTOR)
+    tsv: Mapped[Any] = mapped_column(TSVECTOR, Computed(TSV_EXPR, persisted=True), nullable=True)
+
+class ItemHash(Base):
+    # Content hash of each item as last written by the feed seeder
+    __tablename__ = "item_hashes"
+    id: Mapped[str] = mapped_column(String, primary_key=True)
+    content_hash: Mapped[str] = mapped_column(String(32), nullable=False)
+
+class SchemaVersion(Base):
+    # One row per applied migration; the startup check only reads max(version)
+    __tablename__ = "schema_version"
+    version: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    applied_at: Mapped[Any] = mapped_column(TIMESTAMP(timezone=True), server_default=func.now())
 
 class User(Base):
     __tablename__ = "users"
@@ -42,12 +73,29 @@ class User(Base):
 
 class BagItem(Base):
     __tablename__ = "bag_items"
-    email: Mapped[str] = mapped_column(String(320), primary_key=True)
-    product_id: Mapped[str] = mapped_column(String, primary_key=True)
+    # Keyed by the integer user id (the JWT sub); the primary key also serves per-user lookups
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    product_id: Mapped[str] = mapped_column(ForeignKey("items.id", ondelete="CASCADE"), primary_key=True)
     added_at: Mapped[Any] = mapped_column(TIMESTAMP(timezone=True), server_default=func.now())
+    # Lets deleting an item find the bag rows to cascade to
+    __table_args__ = (Index("idx_bag_product", "product_id"),)
+
+class ReplicaHeartbeat(Base):
+    # One row the primary stamps with the time; replicas.py reads it back from each replica to measure lag
+    __tablename__ = "replica_heartbeat"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    beat_at: Mapped[float] = mapped_column(Float, nullable=False)
+
+# Bag rows from before the user_id key, parked by migration 5 until backfill_bag.py moves them
+BAG_LEGACY_TABLE = "bag_items_legacy"
 
 # ---------------- Engine & Session ----------------
-engine = create_engine(settings.DATABASE_URL, future=True, pool_pre_ping=True, echo=False)
+engine = create_engine(
+    settings.DATABASE_URL, future=True, echo=False, **db_pool.engine_options(make_url(settings.DATABASE_URL), "db")
+)
+db_pool.instrument(engine, "db")
+# Catalog streaming reads through this; the same engine until reads get their own
+read_engine = engine
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
 
 def get_session() -> Generator[SessionLocal, None, None]:
@@ -57,82 +105,179 @@ def get_session() -> Generator[SessionLocal, None, None]:
     finally:
         db.close()
 
-# ---------------- Setup Tables & Indexes ----------------
-def setup_tables_and_indexes():
-    """Create tables and indexes safely without seeding data."""
-    Base.metadata.create_all(bind=engine)
+def _async_url(url: str) -> URL:
+    """DATABASE_URL with the asyncio driver: asyncpg for Postgres, aiosqlite for SQLite."""
+    u = make_url(url)
+    if u.get_backend_name() == "sqlite":
+        return u.set(drivername="sqlite+aiosqlite")
+    query = dict(u.query)
+    # asyncpg spells libpq's sslmode as ssl
+    if "sslmode" in query:
+        query["ssl"] = query.pop("sslmode")
+    return u.set(drivername="postgresql+asyncpg", query=query)
 
-    with engine.begin() as conn:
-        # Safe tsvector column creation
-        conn.execute(text("""
-        DO $$
-        BEGIN
-            IF NOT EXISTS (
-                SELECT 1
-                FROM information_schema.columns
-                WHERE table_name='items' AND column_name='tsv'
-            ) THEN
-                ALTER TABLE items
-                ADD COLUMN tsv tsvector
-                GENERATED ALWAYS AS (
-                    to_tsvector('simple',
-                        coalesce(item_name,'') || ' ' ||
-                        coalesce(company,'')   || ' ' ||
-                        coalesce(category,'')  || ' ' ||
-                        coalesce(tags,'')
-                    )
-                ) STORED;
-            END IF;
-        END
-        $$;
-        """))
-
-        # Safe index creation
-        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_items_tsv ON items USING GIN (tsv);"))
-        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_items_category ON items(category);"))
-        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_items_company ON items(company);"))
-        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_items_itemname ON items(item_name);"))
+# DB_ASYNC: the async endpoints (async_api.py) use this engine; scripts, migrations and the
+# remaining sync endpoints keep the sync one
+async_engine = None
+if settings.DB_ASYNC:
+    _url = _async_url(settings.DATABASE_URL)
+    async_engine = create_async_engine(_url, **db_pool.engine_options(_url, "db_async", is_async=True))
+    db_pool.instrument(async_engine.sync_engine, "db_async")
+async_read_engine = async_engine
+AsyncSessionLocal = (
+    async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False) if async_engine is not None else None
+)
 
-# ---------------- Optional JSON Seeder ----------------
-def seed_items_from_json():
-    """Manually run this script to seed items from JSON."""
-    if not file_path.exists():
+def replica_engines() -> List[Tuple[Engine, Any]]:
+    """(sync, async or None) engine pair per DATABASE_REPLICA_URLS entry."""
+    pairs = []
+    for i, url in enumerate(settings.replica_urls):
+        sync = create_engine(url, future=True, echo=False, **db_pool.engine_options(make_url(url), f"db_replica{i}"))
+        db_pool.instrument(sync, f"db_replica{i}")
+        async_ = None
+        if settings.DB_ASYNC:
+            _aurl = _async_url(url)
+            async_ = create_async_engine(_aurl, **db_pool.engine_options(_aurl, f"db_async_replica{i}", is_async=True))
+            db_pool.instrument(async_.sync_engine, f"db_async_replica{i}")
+        pairs.append((sync, async_))
+    return pairs
+
+async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# ---------------- Migrations ----------------
+def _migrate_v1(conn: Connection):
+    # Tables made by an older create_all have tsv as a plain NOT NULL column
+    is_generated = conn.execute(text("""
+        SELECT is_generated FROM information_schema.columns
+        WHERE table_name='items' AND column_name='tsv'
+    """)).scalar()
+    if is_generated == "NEVER":
+        conn.execute(text("ALTER TABLE items DROP COLUMN tsv"))
+
+    # Safe tsvector column creation
+    conn.execute(text(f"""
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1
+            FROM information_schema.columns
+            WHERE table_name='items' AND column_name='tsv'
+        ) THEN
+            ALTER TABLE items ADD COLUMN tsv tsvector GENERATED ALWAYS AS ({TSV_EXPR}) STORED;
+        END IF;
+    END
+    $$;
+    """))
+
+    # Safe index creation
+    conn.execute(text("CREATE INDEX IF NOT EXISTS idx_items_tsv ON items USING GIN (tsv);"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS idx_items_category ON items(category);"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS idx_items_company ON items(company);"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS idx_items_itemname ON items(item_name);"))
+
+def _migrate_v2(conn: Connection):
+    # Substring/typo search: pg_trgm may not be installable (managed databases, missing
+    # contrib), in which case search falls back to unindexed LIKE
+    try:
+        with conn.begin_nested():
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except DBAPIError:
+        return
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_items_trgm ON items USING GIN (({SEARCH_TEXT_SQL}) gin_trgm_ops)"))
+
+# /items filters and sorts: (name, key columns, carried columns). Each leads with what a
+# listing filters or sorts on and carries the other facet columns, so facet counts and
+# keyset ordering come from the index alone
+_LISTING_INDEXES = (
+    ("idx_items_category_price", "category, current_price, id", "company, discount_percentage, rating_stars"),
+    ("idx_items_company_price", "company, current_price, id", "category, discount_percentage, rating_stars"),
+    ("idx_items_price", "current_price, id", ""),
+    ("idx_items_discount", "discount_percentage, id", ""),
+    ("idx_items_rating", "rating_stars, id", ""),
+)
+
+def _migrate_v3(conn: Connection):
+    for name, keys, carried in _LISTING_INDEXES:
+        include = f" INCLUDE ({carried})" if carried else ""
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON items ({keys}){include}"))
+    # Prefixes of the composites above
+    conn.execute(text("DROP INDEX IF EXISTS idx_items_category"))
+    conn.execute(text("DROP INDEX IF EXISTS idx_items_company"))
+
+def _migrate_v4(conn: Connection):
+    # Trigger-maintained facet counts (facets.py)
+    facets.setup(conn)
+
+def _migrate_v5(conn: Connection):
+    # bag_items goes from (email, product_id) to (user_id, product_id). Only DDL here: existing
+    # rows are parked in BAG_LEGACY_TABLE and moved in batches by backfill_bag.py
+    if "email" not in {c["name"] for c in inspect(conn).get_columns("bag_items")}:
         return
+    conn.execute(text("DROP INDEX IF EXISTS idx_bag_product"))
+    conn.execute(text(f"ALTER TABLE bag_items RENAME TO {BAG_LEGACY_TABLE}"))
+    # The primary key index keeps its name across the rename and would clash with the new table's
+    conn.execute(text(f"ALTER INDEX IF EXISTS bag_items_pkey RENAME TO {BAG_LEGACY_TABLE}_pkey"))
+    BagItem.__table__.create(conn)
+
+def _migrate_v6(conn: Connection):
+    # The heartbeat row replicas.py updates (create_all made the table)
+    conn.execute(insert(ReplicaHeartbeat).values(id=1, beat_at=0))
+
+# Every schema change gets the next number here; migrate.py applies the missing ones in order
+MIGRATIONS = {
+    1: _migrate_v1,
+    2: _migrate_v2,
+    3: _migrate_v3,
+    4: _migrate_v4,
+    5: _migrate_v5,
+    6: _migrate_v6,
+}
+SCHEMA_VERSION = max(MIGRATIONS)
+_MIGRATION_LOCK_KEY = 0x6D79_6E74  # pg advisory lock shared by all migrators
 
-    data = json.loads(file_path.read_text(encoding="utf-8"))
-    items = data.get("items", [])
-
-    upsert_sql = text("""
-    INSERT INTO items (id,image,company,item_name,original_price,current_price,discount_percentage,
-                       return_period,delivery_date,rating_stars,rating_count,category,tags)
-    VALUES (:id,:image,:company,:item_name,:original_price,:current_price,:discount_percentage,
-            :return_period,:delivery_date,:rating_stars,:rating_count,:category,:tags)
-    ON CONFLICT(id) DO UPDATE SET
-        image=excluded.image,
-        company=excluded.company,
-        item_name=excluded.item_name,
-        original_price=excluded.original_price,
-        current_price=excluded.current_price,
-        discount_percentage=excluded.discount_percentage,
-        return_period=excluded.return_period,
-        delivery_date=excluded.delivery_date,
-        rating_stars=excluded.rating_stars,
-        rating_count=excluded.rating_count,
-        category=excluded.category,
-        tags=excluded.tags
-    """)
+def current_schema_version(conn: Connection) -> int:
+    if not inspect(conn).has_table(SchemaVersion.__tablename__):
+        return 0
+    return conn.execute(select(func.max(SchemaVersion.version))).scalar() or 0
 
+def setup_tables_and_indexes() -> int:
+    """Create tables and bring the schema up to SCHEMA_VERSION, without seeding data.
+
+    Meant for `python migrate.py` at deploy time. Concurrent runs serialize on
+    an advisory lock and the later ones find nothing left to do.
+    """
     with engine.begin() as conn:
-        def norm(it):
-            r = it.get("rating") or {}
-            return dict(
-                id=it["id"], image=it.get("image"), company=it.get("company"),
-                item_name=it.get("item_name"), original_price=it.get("original_price"),
-                current_price=it.get("current_price"), discount_percentage=it.get("discount_percentage"),
-                return_period=it.get("return_period"), delivery_date=it.get("delivery_date"),
-                rating_stars=r.get("stars"), rating_count=r.get("count"),
-                category=it.get("category"), tags=it.get("tags"),
-            )
-
-        for it in items:
-            conn.execute(upsert_sql, norm(it))
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _MIGRATION_LOCK_KEY})
+        Base.metadata.create_all(bind=conn)
+        current = current_schema_version(conn)
+        for version in sorted(v for v in MIGRATIONS if v > current):
+            MIGRATIONS[version](conn)
+            conn.execute(insert(SchemaVersion).values(version=version))
+    return SCHEMA_VERSION
+
+def ensure_schema():
+    """Cold-start check: a single version lookup once the database has been migrated."""
+    with engine.connect() as conn:
+        current = current_schema_version(conn)
+    if current >= SCHEMA_VERSION:
+        return
+    if not settings.AUTO_MIGRATE:
+        raise RuntimeError(
+            f"database schema is at version {current}, this build needs {SCHEMA_VERSION}: run `python migrate.py`"
+        )
+    setup_tables_and_indexes()
+
+# ---------------- Optional JSON Seeder ----------------
+def seed_items_from_json(
+    batch_size: int | None = None, commit_every: int | None = None, full: bool = False
+) -> IngestStats | None:
+    """Manually run this script to seed items from JSON (only changed rows are written)."""
+    if not file_path.exists():
+        return None
+
+    stats = load_feed(engine, file_path, batch_size, commit_every, full)
+    # Drop cached /items and /search responses built from the old rows
+    catalog_cache.invalidate()
+    return stats
@@ -0,0 +1,147 @@
+"""Connection pool settings and instrumentation for the engines built in db.py.
+
+engine_options() turns the DB_POOL_* / DB_STATEMENT_TIMEOUT_MS settings into
+create_engine() arguments; instrument() adds the checkout pings and the
+metrics shown on /metrics under the engine's prefix ("db", "db_async"):
+
+  <prefix>.pool.wait_ms            time to get a connection from the pool (includes connecting)
+  <prefix>.pool.timeouts           checkouts that gave up after DB_POOL_TIMEOUT_SECONDS
+  <prefix>.pool.in_use / idle / overflow
+  <prefix>.query_ms                every statement
+  <prefix>.slow_queries            the last DB_SLOW_QUERY_LOG_SIZE statements over DB_SLOW_QUERY_MS,
+                                   as statement_shape()s
+  <prefix>.statement_timeouts      statements cancelled by DB_STATEMENT_TIMEOUT_MS
+"""
+from __future__ import annotations
+import math, re, time
+from typing import Any, Dict
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import URL, Engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, Pool, QueuePool
+
+import metrics
+from config import settings
+
+# Literals and placeholder lists, whatever the driver's paramstyle (?, %(name)s, %s, $1)
+_LITERAL = re.compile(r"'(?:[^']|'')*'|(?<![\w$])\d+(?:\.\d+)?")
+_PARAM = r"(?:\?|%\(\w+\)s|%s|\$\d+)"
+_PARAM_LIST = re.compile(rf"\(\s*{_PARAM}(?:\s*,\s*{_PARAM})+\s*\)")
+SHAPE_MAX_CHARS = 200
+
+def statement_shape(statement: str) -> str:
+    """The statement with values and IN lists folded away, cut to SHAPE_MAX_CHARS: what /metrics shows."""
+    shape = _LITERAL.sub("?", " ".join(statement.split()))
+    return _PARAM_LIST.sub("(...)", shape)[:SHAPE_MAX_CHARS]
+
+# Checkouts are usually well under a millisecond; the tail is what matters
+WAIT_MS_BUCKETS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000, 30000)
+# SQLite checks its statement deadline every this many VM instructions
+_SQLITE_PROGRESS_STEPS = 10_000
+
+def _timed_pool(base: type[Pool], prefix: str) -> type[Pool]:
+    wait_ms = metrics.histogram(f"{prefix}.pool.wait_ms", WAIT_MS_BUCKETS)
+    timeouts = metrics.counter(f"{prefix}.pool.timeouts")
+
+    # A subclass rather than pool events: no event fires when a checkout starts waiting.
+    # engine.dispose() recreates the pool from its class, so the metrics carry over.
+    class TimedPool(base):
+        def _do_get(self):
+            start = time.perf_counter()
+            try:
+                return super()._do_get()
+            except exc.TimeoutError:
+                timeouts.inc()
+                raise
+            finally:
+                wait_ms.observe((time.perf_counter() - start) * 1000)
+
+    TimedPool.__name__ = f"Timed{base.__name__}"
+    return TimedPool
+
+def engine_options(url: URL, prefix: str, is_async: bool = False) -> Dict[str, Any]:
+    """create_engine() / create_async_engine() keyword arguments for `url`."""
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return {}  # one in-memory database per connection: keep SQLAlchemy's own pool for it
+    opts: Dict[str, Any] = {
+        "poolclass": _timed_pool(AsyncAdaptedQueuePool if is_async else QueuePool, prefix),
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT_SECONDS,
+        "pool_recycle": settings.DB_POOL_RECYCLE_SECONDS,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING == "always",
+    }
+    timeout = settings.DB_STATEMENT_TIMEOUT_MS
+    if timeout and url.get_backend_name() == "postgresql":
+        # Set at connect time, so it holds for every statement without a SET round trip
+        if url.get_driver_name() == "asyncpg":
+            opts["connect_args"] = {"server_settings": {"statement_timeout": str(timeout)}}
+        else:
+            opts["connect_args"] = {"options": f"-c statement_timeout={timeout}"}
+    return opts
+
+def instrument(engine: Engine, prefix: str) -> None:
+    """Attach the idle pre-ping, pool gauges and query metrics to `engine` (for async engines, its sync_engine)."""
+    pool = lambda: engine.pool  # dispose() swaps the pool object
+    metrics.gauge(f"{prefix}.pool.in_use", lambda: pool().checkedout())
+    metrics.gauge(f"{prefix}.pool.idle", lambda: pool().checkedin() if isinstance(pool(), QueuePool) else 0)
+    metrics.gauge(f"{prefix}.pool.overflow", lambda: max(pool().overflow(), 0) if isinstance(pool(), QueuePool) else 0)
+    query_ms = metrics.histogram(f"{prefix}.query_ms")
+    slow = metrics.events(f"{prefix}.slow_queries", settings.DB_SLOW_QUERY_LOG_SIZE)
+    timeouts = metrics.counter(f"{prefix}.statement_timeouts")
+    timeout_s = settings.DB_STATEMENT_TIMEOUT_MS / 1000
+
+    if settings.DB_POOL_PRE_PING == "idle":
+        @event.listens_for(engine, "checkin")
+        def _checked_in(_dbapi_conn, record):
+            if record is not None:
+                record.info["idle_since"] = time.monotonic()
+
+        @event.listens_for(engine, "checkout")
+        def _ping_if_idle(dbapi_conn, record, _proxy):
+            # Only a connection that sat idle may have been dropped by the server or a proxy
+            idle_since = record.info.pop("idle_since", None)
+            if idle_since is None or time.monotonic() - idle_since < settings.DB_POOL_PING_IDLE_SECONDS:
+                return
+            try:
+                engine.dialect.do_ping(dbapi_conn)
+            except Exception:
+                raise exc.DisconnectionError()  # the pool retries with a fresh connection
+
+    if timeout_s and engine.dialect.name == "sqlite" and engine.dialect.driver == "pysqlite":
+        # SQLite has no statement_timeout; a progress handler aborts statements past their deadline
+        @event.listens_for(engine, "connect")
+        def _sqlite_deadline(dbapi_conn, record):
+            dbapi_conn.set_progress_handler(
+                lambda: time.monotonic() > record.info.get("deadline", math.inf), _SQLITE_PROGRESS_STEPS
+            )
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _started(conn, _cursor, _statement, _parameters, _context, _executemany):
+        now = time.monotonic()
+        conn.info.setdefault("query_start", []).append(now)
+        if timeout_s:
+            conn.connection.info["deadline"] = now + timeout_s
+
+    def _done(conn, statement: str, error: str | None = None) -> None:
+        ms = (time.monotonic() - conn.info["query_start"].pop()) * 1000
+        if not conn.invalidated:
+            conn.connection.info.pop("deadline", None)
+        query_ms.observe(ms)
+        if settings.DB_SLOW_QUERY_MS and ms >= settings.DB_SLOW_QUERY_MS:
+            entry = {"ms": round(ms, 1), "statement": statement_shape(statement)}
+            slow.record(entry if error is None else {**entry, "error": error})
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _finished(conn, _cursor, statement, _parameters, _context, _executemany):
+        _done(conn, statement)
+
+    @event.listens_for(engine, "handle_error")
+    def _failed(context):
+        # Postgres: "canceling statement due to statement timeout"; SQLite's progress handler: "interrupted"
+        message = str(context.original_exception).strip()
+        if "statement timeout" in message or (timeout_s and message == "interrupted"):
+            timeouts.inc()
+        conn = context.connection
+        if conn is not None and conn.info.get("query_start") and context.statement is not None:
+            _done(conn, context.statement, message.splitlines()[0][:200] if message else type(context.original_exception).__name__)
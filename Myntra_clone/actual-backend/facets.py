@@ -0,0 +1,151 @@
+"""Precomputed item counts per facet value (category, company, price band).
+
+Counts live in `facet_counts` and are kept current by triggers on items, so
+the CRUD endpoints, the feed seeders and sql_convert.py all update them
+incrementally without knowing about them. Large reseeds suspend the triggers
+and rebuild the table once (ingest.sync_items). Reading one value's count is
+a primary-key lookup.
+
+Postgres materialized views can only be refreshed as a whole, so both
+backends use a trigger-maintained table.
+"""
+from __future__ import annotations
+from typing import Any, Callable, Dict, List
+
+from sqlalchemy import select, table, column
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+FACETS = ("category", "company", "price")
+# Upper bounds of the price bands; the last band is open ("5000+")
+PRICE_BANDS = (500, 1000, 2000, 5000)
+
+facet_counts = table("facet_counts", column("facet"), column("value"), column("item_count"))
+
+def _price_band(col: str) -> str:
+    """SQL CASE mapping a price column to its band label, NULL for no price."""
+    whens, lo = [], 0
+    for hi in PRICE_BANDS:
+        whens.append(f"WHEN {col} < {hi} THEN '{lo}-{hi - 1}'")
+        lo = hi
+    return f"CASE WHEN {col} IS NULL THEN NULL {' '.join(whens)} ELSE '{lo}+' END"
+
+def _values(row: str) -> Dict[str, str]:
+    """facet -> SQL for that facet's value in `row` (new/old in triggers, items in the rebuild)."""
+    return {"category": f"{row}.category", "company": f"{row}.company", "price": _price_band(f"{row}.current_price")}
+
+def _increment(row: str) -> str:
+    pairs = " UNION ALL ".join(f"SELECT '{f}' AS facet, {v} AS value" for f, v in _values(row).items())
+    return (
+        f"INSERT INTO facet_counts (facet, value, item_count) SELECT facet, value, 1 FROM ({pairs}) AS v "
+        "WHERE value IS NOT NULL "
+        "ON CONFLICT (facet, value) DO UPDATE SET item_count = facet_counts.item_count + 1"
+    )
+
+def _decrement(row: str) -> str:
+    match = " OR ".join(f"(facet = '{f}' AND value = {v})" for f, v in _values(row).items())
+    # Rows that drop to 0 stay (readers skip them); a later insert reuses them
+    return f"UPDATE facet_counts SET item_count = item_count - 1 WHERE {match}"
+
+_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS facet_counts (
+    facet VARCHAR(32) NOT NULL,
+    value VARCHAR(255) NOT NULL,
+    item_count INTEGER NOT NULL,
+    PRIMARY KEY (facet, value)
+)"""
+_WATCHED = "category, company, current_price"
+
+def _sqlite_triggers() -> List[str]:
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS items_facets_ai AFTER INSERT ON items BEGIN {_increment('new')}; END",
+        f"CREATE TRIGGER IF NOT EXISTS items_facets_ad AFTER DELETE ON items BEGIN {_decrement('old')}; END",
+        f"CREATE TRIGGER IF NOT EXISTS items_facets_au AFTER UPDATE OF {_WATCHED} ON items "
+        f"BEGIN {_decrement('old')}; {_increment('new')}; END",
+    ]
+
+_PG_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION items_facets_bump() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        {_decrement('OLD')};
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        {_increment('NEW')};
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql"""
+_PG_TRIGGER = (
+    f"CREATE TRIGGER items_facets AFTER INSERT OR DELETE OR UPDATE OF {_WATCHED} ON items "
+    "FOR EACH ROW EXECUTE FUNCTION items_facets_bump()"
+)
+
+def rebuild(conn: Connection) -> None:
+    """Recount everything from items in one pass per facet."""
+    conn.exec_driver_sql("DELETE FROM facet_counts")
+    selects = " UNION ALL ".join(
+        f"SELECT '{f}', value, count(*) FROM (SELECT {v} AS value FROM items) AS t{i} "
+        "WHERE value IS NOT NULL GROUP BY value"
+        for i, (f, v) in enumerate(_values("items").items())
+    )
+    conn.exec_driver_sql(f"INSERT INTO facet_counts (facet, value, item_count) {selects}")
+
+def setup(conn: Connection) -> None:
+    """Create the table and its triggers, then fill it (a schema migration step)."""
+    conn.exec_driver_sql(_CREATE_TABLE)
+    if conn.dialect.name == "sqlite":
+        for sql in _sqlite_triggers():
+            conn.exec_driver_sql(sql)
+    else:
+        conn.exec_driver_sql(_PG_FUNCTION)
+        conn.exec_driver_sql("DROP TRIGGER IF EXISTS items_facets ON items")
+        conn.exec_driver_sql(_PG_TRIGGER)
+    rebuild(conn)
+
+def suspend(conn: Connection) -> Callable[[], None] | None:
+    """Stop per-row counting for a bulk load; the returned callable recounts and resumes it."""
+    if conn.dialect.name == "sqlite":
+        names = [r[0] for r in conn.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type='trigger' AND name LIKE 'items_facets_%'")]
+        if not names:
+            return None
+        for name in names:
+            conn.exec_driver_sql(f'DROP TRIGGER "{name}"')
+
+        def restore() -> None:
+            rebuild(conn)
+            for sql in _sqlite_triggers():
+                conn.exec_driver_sql(sql)
+        return restore
+
+    if conn.exec_driver_sql("SELECT 1 FROM pg_trigger WHERE tgname = 'items_facets'").first() is None:
+        return None
+    conn.exec_driver_sql("ALTER TABLE items DISABLE TRIGGER items_facets")
+
+    def restore() -> None:
+        rebuild(conn)
+        conn.exec_driver_sql("ALTER TABLE items ENABLE TRIGGER items_facets")
+    return restore
+
+# ---------- Reads ----------
+def _band_start(label: str) -> int:
+    return int(label.split("-")[0].rstrip("+"))
+
+def values(db: Session, facet: str, limit: int | None = None) -> List[Dict[str, Any]]:
+    """Values of `facet` with their item counts: most items first, price bands in price order."""
+    stmt = (
+        select(facet_counts.c.value, facet_counts.c.item_count)
+        .where(facet_counts.c.facet == facet, facet_counts.c.item_count > 0)
+    )
+    if facet != "price":
+        stmt = stmt.order_by(facet_counts.c.item_count.desc(), facet_counts.c.value).limit(limit)
+    rows = db.execute(stmt).all()
+    if facet == "price":
+        rows = sorted(rows, key=lambda r: _band_start(r[0]))[:limit]
+    return [{"value": v, "count": n} for v, n in rows]
+
+def count(db: Session, facet: str, value: str) -> int:
+    return db.execute(
+        select(facet_counts.c.item_count).where(facet_counts.c.facet == facet, facet_counts.c.value == value)
+    ).scalar() or 0
@@ -0,0 +1,307 @@
+from __future__ import annotations
+import io, os, time
+from dataclasses import dataclass
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, Mapping
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.engine import Connection, Engine
+
+import facets
+import feed
+from config import settings
+
+ITEM_COLUMNS: tuple[str, ...] = (
+    "id", "image", "company", "item_name", "original_price", "current_price",
+    "discount_percentage", "return_period", "delivery_date", "rating_stars",
+    "rating_count", "category", "tags",
+)
+# SQLite FTS tables kept in sync by triggers on items, with the columns they index
+FTS_TABLES: Dict[str, tuple[str, ...]] = {
+    "items_fts": ("id", "item_name", "company", "category", "tags"),
+    "items_trgm": ("id", "item_name", "company", "category", "tags"),
+}
+
+_COLS = ", ".join(ITEM_COLUMNS)
+_UPDATE_SET = ", ".join(f"{c}=excluded.{c}" for c in ITEM_COLUMNS if c != "id")
+UPSERT_SQL = text(
+    f"INSERT INTO items ({_COLS}) VALUES ({', '.join(':' + c for c in ITEM_COLUMNS)}) "
+    f"ON CONFLICT(id) DO UPDATE SET {_UPDATE_SET}"
+)
+
+def item_row(it: Mapping[str, Any]) -> Dict[str, Any]:
+    """Flatten one feed item (rating is nested in the feed) into an items row."""
+    r = it.get("rating") or {}
+    return dict(
+        id=it["id"], image=it.get("image"), company=it.get("company"),
+        item_name=it.get("item_name"), original_price=it.get("original_price"),
+        current_price=it.get("current_price"), discount_percentage=it.get("discount_percentage"),
+        return_period=it.get("return_period"), delivery_date=it.get("delivery_date"),
+        rating_stars=r.get("stars"), rating_count=r.get("count"),
+        category=it.get("category"), tags=it.get("tags"),
+    )
+
+def batched(rows: Iterable[Any], size: int) -> Iterator[list]:
+    it = iter(rows)
+    while batch := list(islice(it, size)):
+        yield batch
+
+@dataclass
+class IngestStats:
+    rows: int = 0
+    inserted: int = 0
+    updated: int = 0
+    deleted: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows / self.seconds if self.seconds else float(self.rows)
+
+    @property
+    def unchanged(self) -> int:
+        return self.rows - self.inserted - self.updated
+
+    def add(self, other: "IngestStats") -> None:
+        self.rows += other.rows
+        self.inserted += other.inserted
+        self.updated += other.updated
+        self.deleted += other.deleted
+
+    def __str__(self) -> str:
+        return (
+            f"{self.rows} items in {self.seconds:.2f}s ({self.rows_per_sec:,.0f} rows/s): "
+            f"{self.inserted} inserted, {self.updated} updated, {self.deleted} deleted"
+        )
+
+_known_hashes = text("SELECT id, content_hash FROM item_hashes WHERE id IN :ids").bindparams(
+    bindparam("ids", expanding=True)
+)
+_save_hash = text(
+    "INSERT INTO item_hashes (id, content_hash) VALUES (:id, :content_hash) "
+    "ON CONFLICT(id) DO UPDATE SET content_hash=excluded.content_hash"
+)
+
+# ---------- Delta sync ----------
+def sync_items(
+    conn: Connection,
+    items: Iterable[Mapping[str, Any]],
+    batch_size: int | None = None,
+    defer_search_index: bool | None = None,
+    delete_missing: bool = True,
+    full: bool = False,
+) -> IngestStats:
+    """Bring items in line with a feed inside the caller's transaction.
+
+    Each feed item's content hash is compared with the one stored in
+    item_hashes at the previous sync and only new or changed rows are written
+    (`full` rewrites everything). With `delete_missing`, items that came from
+    an earlier feed but are absent from this one are deleted; rows created
+    through the API never have a hash and are left alone.
+
+    Rows are written through COPY into a temp table plus one INSERT ... ON
+    CONFLICT on Postgres and executemany per batch elsewhere. Once
+    SEED_DEFER_MIN_CHANGES rows have changed, the GIN index (Postgres) or FTS
+    triggers (SQLite) are dropped and rebuilt once at the end, and facet
+    counting is paused and redone the same way; on Postgres that holds an
+    exclusive lock on items until commit.
+    """
+    batch_size = batch_size or settings.SEED_BATCH_SIZE
+    if defer_search_index is None:
+        defer_search_index = settings.SEED_DEFER_SEARCH_INDEX
+    postgres = conn.dialect.name == "postgresql"
+    stats = IngestStats()
+    restores: list[Callable[[], None]] = []
+    suspended = False
+    start = time.perf_counter()
+    if delete_missing:
+        _create_seen_ids(conn)
+
+    def changed_rows() -> Iterator[Dict[str, Any]]:
+        nonlocal suspended
+        for batch in batched(items, batch_size):
+            hashed = [(item_row(it), feed.item_hash(it)) for it in batch]
+            ids = [row["id"] for row, _ in hashed]
+            known = dict(conn.execute(_known_hashes, {"ids": ids}).all())
+            if delete_missing:
+                conn.execute(_mark_seen, [{"id": i} for i in ids])
+            rows, hashes = [], []
+            for row, h in hashed:
+                old = known.get(row["id"])
+                if old == h and not full:
+                    continue
+                if old is None:
+                    stats.inserted += 1
+                else:
+                    stats.updated += 1
+                rows.append(row)
+                hashes.append({"id": row["id"], "content_hash": h})
+            stats.rows += len(batch)
+            if hashes:
+                conn.execute(_save_hash, hashes)
+            # Small deltas go through the live index; past the threshold one rebuild is cheaper
+            if (defer_search_index and not suspended and rows
+                    and (full or stats.inserted + stats.updated >= settings.SEED_DEFER_MIN_CHANGES)):
+                search_restore = _suspend_pg_search_index(conn) if postgres else _suspend_sqlite_fts(conn)
+                restores.extend(r for r in (search_restore, facets.suspend(conn)) if r is not None)
+                suspended = True
+            yield from rows
+
+    if postgres and _copy_supported(conn):
+        _copy_upsert(conn, changed_rows(), batch_size)
+    else:
+        _executemany_upsert(conn, changed_rows(), batch_size)
+    if delete_missing:
+        stats.deleted = _delete_unseen(conn)
+    for restore in restores:
+        restore()
+    stats.seconds = time.perf_counter() - start
+    return stats
+
+_mark_seen = text("INSERT INTO feed_seen_ids (id) VALUES (:id) ON CONFLICT(id) DO NOTHING")
+
+def _create_seen_ids(conn: Connection) -> None:
+    conn.exec_driver_sql("DROP TABLE IF EXISTS feed_seen_ids")
+    if conn.dialect.name == "postgresql":
+        conn.exec_driver_sql("CREATE TEMP TABLE feed_seen_ids (id TEXT PRIMARY KEY) ON COMMIT DROP")
+    else:
+        conn.exec_driver_sql("CREATE TEMP TABLE feed_seen_ids (id TEXT PRIMARY KEY)")
+
+def _delete_unseen(conn: Connection) -> int:
+    gone = "SELECT id FROM item_hashes WHERE id NOT IN (SELECT id FROM feed_seen_ids)"
+    deleted = conn.exec_driver_sql(f"DELETE FROM items WHERE id IN ({gone})").rowcount
+    conn.exec_driver_sql(f"DELETE FROM item_hashes WHERE id IN ({gone})")
+    conn.exec_driver_sql("DROP TABLE feed_seen_ids")
+    return deleted
+
+_stale_hash = text("UPDATE item_hashes SET content_hash = '' WHERE id = :id")
+
+def mark_stale(conn: Connection, item_id: str) -> None:
+    """Note an API edit of a feed item: the next sync rewrites it, or deletes it if the feed dropped it."""
+    conn.execute(_stale_hash, {"id": item_id})
+
+def delete_missing_items(conn: Connection, ids: Iterable[str], batch_size: int | None = None) -> int:
+    """Delete feed-owned items whose id is not in `ids` (the complete id list of the current feed)."""
+    _create_seen_ids(conn)
+    for batch in batched(ids, batch_size or settings.SEED_BATCH_SIZE):
+        conn.execute(_mark_seen, [{"id": i} for i in batch])
+    return _delete_unseen(conn)
+
+def load_feed(
+    engine: Engine,
+    path: str | os.PathLike,
+    batch_size: int | None = None,
+    commit_every: int | None = None,
+    full: bool = False,
+) -> IngestStats:
+    """Stream a feed file (see feed.py) into items without loading it whole.
+
+    With `commit_every` unset the feed is synced in one transaction. Otherwise
+    every `commit_every` items are committed and the file offset after them is
+    checkpointed next to the feed, so a rerun after a crash picks up there (a
+    crash between commit and checkpoint just replays one chunk, which then
+    hashes as unchanged). Deletions run as a last pass over the feed's ids,
+    and search indexes stay live in that mode: dropping them across commits
+    would leave them missing if the run died.
+    """
+    if commit_every is None:
+        commit_every = settings.SEED_COMMIT_EVERY
+    start = time.perf_counter()
+    if not commit_every:
+        with engine.begin() as conn:
+            stats = sync_items(conn, (it for it, _ in feed.iter_items(path)), batch_size, full=full)
+        stats.seconds = time.perf_counter() - start
+        return stats
+
+    stats = IngestStats()
+    for chunk in batched(feed.iter_items(path, feed.read_checkpoint(path)), commit_every):
+        with engine.begin() as conn:
+            stats.add(sync_items(conn, (it for it, _ in chunk), batch_size,
+                                 defer_search_index=False, delete_missing=False, full=full))
+        feed.write_checkpoint(path, chunk[-1][1])
+    with engine.begin() as conn:
+        stats.deleted = delete_missing_items(conn, (it["id"] for it, _ in feed.iter_items(path)), batch_size)
+    feed.clear_checkpoint(path)
+    stats.seconds = time.perf_counter() - start
+    return stats
+
+def _executemany_upsert(conn: Connection, rows: Iterable[Dict[str, Any]], batch_size: int) -> int:
+    n = 0
+    for batch in batched(rows, batch_size):
+        conn.execute(UPSERT_SQL, batch)
+        n += len(batch)
+    return n
+
+# ---------- Postgres COPY path ----------
+def _copy_supported(conn: Connection) -> bool:
+    cur = conn.connection.cursor()
+    try:
+        return hasattr(cur, "copy") or hasattr(cur, "copy_expert")
+    finally:
+        cur.close()
+
+def _copy_text(value: Any) -> str:
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def _copy_upsert(conn: Connection, rows: Iterable[Dict[str, Any]], batch_size: int) -> int:
+    conn.exec_driver_sql("DROP TABLE IF EXISTS items_stage")
+    conn.exec_driver_sql(f"CREATE TEMP TABLE items_stage ON COMMIT DROP AS SELECT {_COLS} FROM items WITH NO DATA")
+    # Feed order, so the last occurrence of a duplicated id wins
+    conn.exec_driver_sql("ALTER TABLE items_stage ADD COLUMN stage_seq bigserial")
+
+    copy_sql = f"COPY items_stage ({_COLS}) FROM STDIN"
+    cur = conn.connection.cursor()
+    n = 0
+    try:
+        for batch in batched(rows, batch_size):
+            payload = "".join(
+                "\t".join(_copy_text(r[c]) for c in ITEM_COLUMNS) + "\n" for r in batch
+            )
+            if hasattr(cur, "copy"):  # psycopg 3
+                with cur.copy(copy_sql) as copy:
+                    copy.write(payload)
+            else:  # psycopg2
+                cur.copy_expert(copy_sql, io.StringIO(payload))
+            n += len(batch)
+    finally:
+        cur.close()
+
+    conn.exec_driver_sql(f"""
+        INSERT INTO items ({_COLS})
+        SELECT DISTINCT ON (id) {_COLS} FROM items_stage ORDER BY id, stage_seq DESC
+        ON CONFLICT(id) DO UPDATE SET {_UPDATE_SET}
+    """)
+    return n
+
+# ---------- Deferred search-index maintenance ----------
+def _suspend_pg_search_index(conn: Connection) -> Callable[[], None] | None:
+    if conn.exec_driver_sql("SELECT to_regclass('idx_items_tsv')").scalar() is None:
+        return None
+    conn.exec_driver_sql("DROP INDEX idx_items_tsv")
+    return lambda: conn.exec_driver_sql("CREATE INDEX idx_items_tsv ON items USING GIN (tsv)")
+
+def _suspend_sqlite_fts(conn: Connection) -> Callable[[], None] | None:
+    fts = [t for t in FTS_TABLES if conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (t,)).first()]
+    if not fts:
+        return None
+    triggers = [
+        (name, sql) for name, sql in conn.exec_driver_sql(
+            "SELECT name, sql FROM sqlite_master WHERE type='trigger' AND tbl_name='items'"
+        ).all()
+        if any(t in sql for t in fts)
+    ]
+    for name, _ in triggers:
+        conn.exec_driver_sql(f'DROP TRIGGER "{name}"')
+
+    def restore() -> None:
+        # One rebuild is far cheaper than an FTS write per upserted row
+        for table in fts:
+            cols = ", ".join(FTS_TABLES[table])
+            conn.exec_driver_sql(f"DELETE FROM {table}")
+            conn.exec_driver_sql(f"INSERT INTO {table} ({cols}) SELECT {cols} FROM items")
+        for _, sql in triggers:
+            conn.exec_driver_sql(sql)
+    return restore
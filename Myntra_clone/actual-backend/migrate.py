@@ -0,0 +1,39 @@
+# migrate.py
+# Schema bootstrap/upgrade, run once per deploy instead of on every worker cold start.
+#
+#   python migrate.py            # create tables, apply pending migrations
+#   python migrate.py --seed     # ... then sync items from items.json
+#   python migrate.py --check    # exit 1 if the database is behind this build
+
+import argparse
+import sys
+
+from sqlalchemy import inspect
+
+from db import engine, BAG_LEGACY_TABLE, SCHEMA_VERSION, current_schema_version, setup_tables_and_indexes, seed_items_from_json
+
+def main():
+    ap = argparse.ArgumentParser(description="Create or upgrade the database schema.")
+    ap.add_argument("--check", action="store_true", help="only report the schema version")
+    ap.add_argument("--seed", action="store_true", help="sync items from items.json after migrating")
+    ap.add_argument("--full", action="store_true", help="with --seed, rewrite every item even if unchanged")
+    ap.add_argument("--commit-every", type=int, default=None, help="with --seed, commit and checkpoint every N items")
+    args = ap.parse_args()
+
+    with engine.connect() as conn:
+        current = current_schema_version(conn)
+    if args.check:
+        print(f"schema version {current}, build expects {SCHEMA_VERSION}")
+        sys.exit(0 if current >= SCHEMA_VERSION else 1)
+
+    setup_tables_and_indexes()
+    print(f"schema version {current} -> {SCHEMA_VERSION}")
+    with engine.connect() as conn:
+        if inspect(conn).has_table(BAG_LEGACY_TABLE):
+            print(f"{BAG_LEGACY_TABLE} holds bag rows from before migration 5: run backfill_bag.py")
+    if args.seed:
+        stats = seed_items_from_json(commit_every=args.commit_every, full=args.full)
+        print(f"seeded {stats}" if stats else "items.json not found, nothing seeded")
+
+if __name__ == "__main__":
+    main()
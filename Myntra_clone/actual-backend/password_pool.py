@@ -0,0 +1,87 @@
+from __future__ import annotations
+import asyncio, multiprocessing, threading, time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable
+
+from fastapi import HTTPException
+
+import metrics
+from config import settings
+
+# ---------- Worker side (top level so a process pool can pickle it) ----------
+def _timed(fn: Callable[..., Any], *args: Any) -> tuple[Any, float]:
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+# ---------- Pool ----------
+class PasswordPool:
+    """Size-limited executor for password hashing, separate from the request threadpool.
+
+    At most `max_pending` jobs may be running or queued; past that `run` fails
+    immediately with a 503 instead of letting a login storm pile up behind the
+    catalog endpoints.
+    """
+
+    def __init__(self, kind: str, workers: int, max_pending: int):
+        self.kind = kind
+        self.workers = workers
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor: Executor | None = None
+
+        self.queue_ms = metrics.histogram("password_pool.queue_ms")
+        self.hash_ms = metrics.histogram("password_pool.hash_ms")
+        self.total_ms = metrics.histogram("password_pool.total_ms")
+        self.rejected = metrics.counter("password_pool.rejected")
+        metrics.gauge("password_pool.pending", lambda: self._pending)
+
+    def _get_executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                if self.kind == "process":
+                    # spawn: never fork a process that already runs threads and DB pools
+                    self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+                else:
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="password")
+            return self._executor
+
+    def _release(self, _future: Any = None) -> None:
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if not self._slots.acquire(blocking=False):
+            self.rejected.inc()
+            raise HTTPException(status_code=503, detail="authentication is busy, retry shortly", headers={"Retry-After": "1"})
+        with self._lock:
+            self._pending += 1
+        submitted = time.perf_counter()
+        try:
+            future = self._get_executor().submit(_timed, fn, *args)
+        except BaseException:
+            self._release()
+            raise
+        # Free the slot when the job ends, even if the request was cancelled before that
+        future.add_done_callback(self._release)
+        result, hash_ms = await asyncio.wrap_future(future)
+        total_ms = (time.perf_counter() - submitted) * 1000
+        self.hash_ms.observe(hash_ms)
+        self.queue_ms.observe(max(total_ms - hash_ms, 0.0))
+        self.total_ms.observe(total_ms)
+        return result
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+password_pool = PasswordPool(
+    kind=settings.PASSWORD_POOL_KIND,
+    workers=settings.PASSWORD_POOL_WORKERS,
+    max_pending=settings.PASSWORD_POOL_MAX_PENDING,
+)
@@ -0,0 +1,54 @@
+"""Self-describing password hashes.
+
+Stored form is `<scheme>$<params>$<salt_hex>$<hash_hex>`, e.g.
+`pbkdf2_sha256$i=150000$9f..$4c..` or `scrypt$n=16384,r=8,p=1$9f..$4c..`.
+Rows written before this format hold a bare hex digest in users.password_hash
+and the salt in users.salt; those are read as pbkdf2_sha256 at the legacy cost.
+
+Only the standard library is used here so process-pool workers import it cheaply.
+"""
+from __future__ import annotations
+import hashlib
+from typing import Dict, NamedTuple
+
+SCHEMES = ("pbkdf2_sha256", "scrypt")
+_PARAMS = {"pbkdf2_sha256": ("i",), "scrypt": ("n", "r", "p")}
+
+class ParsedHash(NamedTuple):
+    scheme: str
+    params: Dict[str, int]
+    salt_hex: str
+    digest_hex: str
+
+def derive(scheme: str, params: Dict[str, int], password: str, salt_hex: str) -> str:
+    salt = bytes.fromhex(salt_hex)
+    if scheme == "pbkdf2_sha256":
+        return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, params["i"]).hex()
+    if scheme == "scrypt":
+        n, r, p = params["n"], params["r"], params["p"]
+        # scrypt needs ~128*n*r bytes; the default 32 MiB cap would reject larger costs
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + (1 << 20)).hex()
+    raise ValueError(f"unknown password scheme {scheme!r}")
+
+def encode(scheme: str, params: Dict[str, int], salt_hex: str, digest_hex: str) -> str:
+    packed = ",".join(f"{k}={v}" for k, v in params.items())
+    return f"{scheme}${packed}${salt_hex}${digest_hex}"
+
+def parse(stored: str, salt_hex: str, legacy_iterations: int) -> ParsedHash:
+    if "$" not in stored:
+        bytes.fromhex(salt_hex)
+        return ParsedHash("pbkdf2_sha256", {"i": legacy_iterations}, salt_hex, stored)
+    scheme, packed, salt, digest = stored.split("$")
+    if scheme not in SCHEMES:
+        raise ValueError(f"unknown password scheme {scheme!r}")
+    params = {k: int(v) for k, v in (kv.split("=") for kv in packed.split(","))}
+    # Anything derive() would choke on is rejected here, as a ValueError like the rest
+    if set(params) != set(_PARAMS[scheme]) or min(params.values()) < 1:
+        raise ValueError(f"bad {scheme} parameters {packed!r}")
+    if scheme == "scrypt" and (params["n"] < 2 or params["n"] & (params["n"] - 1)):
+        raise ValueError("scrypt n must be a power of 2")
+    bytes.fromhex(salt)
+    return ParsedHash(scheme, params, salt, digest)
+
+def needs_rehash(parsed: ParsedHash, scheme: str, params: Dict[str, int]) -> bool:
+    return parsed.scheme != scheme or parsed.params != params
@@ -0,0 +1,240 @@
+"""Read replicas (DATABASE_REPLICA_URLS) and the lag check that decides when to use them.
+
+Read-only endpoints (items listing, search, /bag/ids, /me) take their session
+from get_read_session() or get_catalog_session(); everything else stays on the
+primary. A background thread in every worker reads replica_heartbeat on the
+primary every REPLICA_HEARTBEAT_SECONDS and, when no other worker has stamped
+it within the interval, stamps the time (a compare-and-set, so one worker
+writes per interval); then it reads the row back from each replica: how old
+the replica's copy is, is its lag. Reads go round robin to replicas
+within REPLICA_MAX_LAG_SECONDS and to the primary when none is (or none was
+measured lately).
+
+A replica can be up to REPLICA_MAX_LAG_SECONDS behind, so for that long after
+this process changes something (note_write, or any catalog write) reads about
+it stay on the primary. The client carries its own marker too: a successful
+write request gets a `last_write` cookie (and X-Last-Write header) with the
+time, and reads that send it back, to any worker, stay on the primary until it
+is older than the lag. So users see their own writes; other users' writes show
+up on the replicas after the lag.
+
+Anything with the same schema can stand in for a replica: a copy of the
+SQLite file, or a second Postgres database.
+"""
+from __future__ import annotations
+import itertools, math, threading, time
+from typing import Any, AsyncGenerator, Dict, Generator, Hashable, List
+
+from fastapi import Request
+from sqlalchemy import select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import metrics
+from catalog_cache import catalog_cache
+from config import settings
+from db import (
+    AsyncSessionLocal, ReplicaHeartbeat, SessionLocal, async_read_engine, engine, read_engine, replica_engines,
+)
+
+# A stamp younger than this share of the interval is left alone, so timer jitter doesn't skip a beat
+_BEAT_SLACK = 0.9
+# Measurements older than this many heartbeats count as missing (the thread stalled or stopped)
+_STALE_AFTER_BEATS = 3
+# note_write keys kept before old ones are swept
+_MAX_RECENT_WRITES = 10_000
+# Where a client carries the time of its last write (cookie, or the header for clients without cookies)
+WRITE_MARKER_COOKIE = "last_write"
+WRITE_MARKER_HEADER = "X-Last-Write"
+_UNSAFE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+class Replica:
+    def __init__(self, index: int, sync_engine: Engine, async_engine: Any):
+        self.engine = sync_engine
+        self.async_engine = async_engine
+        self.Session = sessionmaker(bind=sync_engine, autoflush=False, future=True)
+        self.AsyncSession = (
+            async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+            if async_engine is not None else None
+        )
+        self.lag = math.inf
+        self.measured_at = -math.inf  # monotonic
+        metrics.gauge(f"db_replica{index}.lag_seconds", lambda: round(self.lag, 3) if math.isfinite(self.lag) else -1)
+
+class ReplicaSet:
+    def __init__(self, pairs: List[tuple], max_lag: float, interval: float):
+        self.members = [Replica(i, s, a) for i, (s, a) in enumerate(pairs)]
+        self.max_lag = max_lag
+        self.interval = interval
+        self._turn = itertools.count()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.reads = metrics.counter("replicas.reads")
+        self.fallbacks = metrics.counter("replicas.fallbacks")
+
+    # ---------- Lifecycle ----------
+    def start(self) -> None:
+        if not self.members or not self.interval or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="replica-heartbeat", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.beat()
+            except Exception:
+                pass  # primary unreachable: the replicas' lag grows until reads fall back
+            self.measure()
+            self._stop.wait(self.interval)
+
+    # ---------- Lag ----------
+    def beat(self) -> bool:
+        """Stamp the heartbeat unless another worker did this interval; True if this call wrote it."""
+        now = time.time()
+        stale = now - self.interval * _BEAT_SLACK
+        with engine.connect() as conn:
+            beat_at = conn.execute(select(ReplicaHeartbeat.beat_at).where(ReplicaHeartbeat.id == 1)).scalar()
+        if beat_at is not None and beat_at > stale:
+            return False  # fresh: the read above took no write lock
+        with engine.begin() as conn:
+            # Compare-and-set: of the workers that saw it stale, only the first matches. Postgres
+            # re-checks the WHERE after waiting on the row lock; SQLite runs one writer at a time
+            written = conn.execute(
+                update(ReplicaHeartbeat)
+                .where(ReplicaHeartbeat.id == 1, ReplicaHeartbeat.beat_at <= stale)
+                .values(beat_at=now)
+            ).rowcount
+        return written == 1
+
+    def measure(self) -> None:
+        for replica in self.members:
+            try:
+                with replica.engine.connect() as conn:
+                    beat_at = conn.execute(select(ReplicaHeartbeat.beat_at).where(ReplicaHeartbeat.id == 1)).scalar()
+                replica.lag = time.time() - beat_at if beat_at else math.inf
+            except Exception:
+                replica.lag = math.inf  # down, or not migrated yet
+            replica.measured_at = time.monotonic()
+
+    def pick(self) -> Replica | None:
+        """A replica within max_lag, round robin; None sends the read to the primary."""
+        if not self.members:
+            return None
+        cutoff = time.monotonic() - _STALE_AFTER_BEATS * self.interval
+        fresh = [r for r in self.members if r.lag <= self.max_lag and r.measured_at >= cutoff]
+        if not fresh:
+            self.fallbacks.inc()
+            return None
+        self.reads.inc()
+        return fresh[next(self._turn) % len(fresh)]
+
+replicas = ReplicaSet(
+    replica_engines(),
+    max_lag=settings.REPLICA_MAX_LAG_SECONDS,
+    interval=settings.REPLICA_HEARTBEAT_SECONDS,
+)
+
+# ---------- Read-your-writes ----------
+_recent_writes: Dict[Hashable, float] = {}
+_recent_lock = threading.Lock()
+
+def note_write(key: Hashable) -> None:
+    """Record that this process just changed `key` (e.g. ("bag", user_id)); reads of it stay on the primary."""
+    if not replicas.members:
+        return
+    now = time.monotonic()
+    with _recent_lock:
+        _recent_writes[key] = now
+        if len(_recent_writes) > _MAX_RECENT_WRITES:
+            for old in [k for k, at in _recent_writes.items() if now - at >= replicas.max_lag]:
+                del _recent_writes[old]
+
+def wrote_recently(key: Hashable) -> bool:
+    at = _recent_writes.get(key)
+    return at is not None and time.monotonic() - at < replicas.max_lag
+
+def _catalog_changed_recently() -> bool:
+    return time.monotonic() - catalog_cache.changed_at < replicas.max_lag
+
+def client_wrote_recently(request: Request) -> bool:
+    """Whether the client's write marker, set by whichever worker took the write, is within the lag."""
+    value = request.cookies.get(WRITE_MARKER_COOKIE) or request.headers.get(WRITE_MARKER_HEADER)
+    try:
+        written_at = float(value)
+    except (TypeError, ValueError):
+        return False
+    return time.time() - written_at < replicas.max_lag
+
+class WriteMarkerMiddleware:
+    """Stamps successful write requests with the client's write marker (only when replicas are configured)."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] not in _UNSAFE_METHODS or not replicas.members:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_marked(message: Message) -> None:
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                now = f"{time.time():.3f}"
+                headers = MutableHeaders(scope=message)
+                headers.append(
+                    "Set-Cookie",
+                    f"{WRITE_MARKER_COOKIE}={now}; Max-Age={math.ceil(replicas.max_lag)}; Path=/; HttpOnly; SameSite=Lax",
+                )
+                headers[WRITE_MARKER_HEADER] = now
+            await send(message)
+
+        await self.app(scope, receive, send_marked)
+
+# ---------- Sessions and engines for reads ----------
+def read_session(primary: bool = False) -> Session:
+    """A session for read-only work: on a fresh replica unless `primary`, else the primary's."""
+    replica = None if primary else replicas.pick()
+    return replica.Session() if replica is not None else SessionLocal()
+
+def async_read_session(primary: bool = False) -> AsyncSession:
+    replica = None if primary else replicas.pick()
+    if replica is not None and replica.AsyncSession is not None:
+        return replica.AsyncSession()
+    return AsyncSessionLocal()
+
+def catalog_engine() -> Engine:
+    """Engine for catalog streaming (catalog.iter_rows)."""
+    replica = None if _catalog_changed_recently() else replicas.pick()
+    return replica.engine if replica is not None else read_engine
+
+def async_catalog_engine():
+    replica = None if _catalog_changed_recently() else replicas.pick()
+    return replica.async_engine if replica is not None and replica.async_engine is not None else async_read_engine
+
+def get_read_session(request: Request) -> Generator[Session, None, None]:
+    with read_session(primary=client_wrote_recently(request)) as db:
+        yield db
+
+def get_catalog_session(request: Request) -> Generator[Session, None, None]:
+    # Items and search: on the primary for a while after this process or this client changed something
+    with read_session(primary=_catalog_changed_recently() or client_wrote_recently(request)) as db:
+        yield db
+
+async def get_async_read_session(request: Request) -> AsyncGenerator[AsyncSession, None]:
+    async with async_read_session(primary=client_wrote_recently(request)) as db:
+        yield db
+
+async def get_async_catalog_session(request: Request) -> AsyncGenerator[AsyncSession, None]:
+    async with async_read_session(primary=_catalog_changed_recently() or client_wrote_recently(request)) as db:
+        yield db
@@ -1,16 +1,19 @@
 # setup_db.py
 # Combine: seed_items.py + create_users_table.py + create_bag_table.py + FTS
 
-import json
-import sqlite3
+import os
 from pathlib import Path
 
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import OperationalError
+
 DB_PATH = "items.db"
 JSON_PATH = "items.json"
 
 # ---------- ITEMS ----------
-def ensure_items_table(conn: sqlite3.Connection):
-    conn.execute("""
+def ensure_items_table(conn: Connection):
+    conn.exec_driver_sql("""
     CREATE TABLE IF NOT EXISTS items (
         id TEXT PRIMARY KEY,
         image TEXT,
@@ -27,15 +30,15 @@ def ensure_items_table(conn: sqlite3.Connection):
         tags TEXT
     )
     """)
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_items_category ON items(category)")
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_items_tags ON items(tags)")
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_items_item_name ON items(item_name)")
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_items_company ON items(company)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS idx_items_category ON items(category)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS idx_items_tags ON items(tags)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS idx_items_item_name ON items(item_name)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS idx_items_company ON items(company)")
 
-def ensure_items_fts(conn: sqlite3.Connection):
+def ensure_items_fts(conn: Connection):
     # Create FTS5 virtual table (fast, ranked search).
     # If your Python/SQLite build lacks FTS5, this will raise an error.
-    conn.execute("""
+    conn.exec_driver_sql("""
     CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
         id,
         item_name,
@@ -46,20 +49,20 @@ def ensure_items_fts(conn: sqlite3.Connection):
     );
     """)
     # Keep FTS in sync with base table
-    conn.execute("""
+    conn.exec_driver_sql("""
     CREATE TRIGGER IF NOT EXISTS items_ai
     AFTER INSERT ON items BEGIN
         INSERT INTO items_fts (id, item_name, company, category, tags)
         VALUES (new.id, new.item_name, new.company, new.category, new.tags);
     END;
     """)
-    conn.execute("""
+    conn.exec_driver_sql("""
     CREATE TRIGGER IF NOT EXISTS items_ad
     AFTER DELETE ON items BEGIN
         DELETE FROM items_fts WHERE id = old.id;
     END;
     """)
-    conn.execute("""
+    conn.exec_driver_sql("""
     CREATE TRIGGER IF NOT EXISTS items_au
     AFTER UPDATE ON items BEGIN
         UPDATE items_fts
@@ -71,61 +74,19 @@ def ensure_items_fts(conn: sqlite3.Connection):
     END;
     """)
 
-def load_items_from_json(path: str):
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    # shape: {"items": [ [ {...}, ... ] ]}
-    return data["items"][0]
-
-def upsert_items(conn: sqlite3.Connection, items: list[dict]):
-    sql = """
-    INSERT INTO items (
-        id, image, company, item_name,
-        original_price, current_price, discount_percentage,
-        return_period, delivery_date,
-        rating_stars, rating_count,
-        category, tags
-    ) VALUES (
-        ?, ?, ?, ?,
-        ?, ?, ?,
-        ?, ?,
-        ?, ?,
-        ?, ?
+# ---------- ITEM HASHES ----------
+def ensure_item_hashes_table(conn: Connection):
+    # Content hash of each item as last written from the feed
+    conn.exec_driver_sql("""
+    CREATE TABLE IF NOT EXISTS item_hashes (
+        id TEXT PRIMARY KEY,
+        content_hash TEXT NOT NULL
     )
-    ON CONFLICT(id) DO UPDATE SET
-        image=excluded.image,
-        company=excluded.company,
-        item_name=excluded.item_name,
-        original_price=excluded.original_price,
-        current_price=excluded.current_price,
-        discount_percentage=excluded.discount_percentage,
-        return_period=excluded.return_period,
-        delivery_date=excluded.delivery_date,
-        rating_stars=excluded.rating_stars,
-        rating_count=excluded.rating_count,
-        category=excluded.category,
-        tags=excluded.tags
-    """
-    for it in items:
-        conn.execute(sql, (
-            it["id"],
-            it.get("image"),
-            it.get("company"),
-            it.get("item_name"),
-            it.get("original_price"),
-            it.get("current_price"),
-            it.get("discount_percentage"),
-            it.get("return_period"),
-            it.get("delivery_date"),
-            (it.get("rating") or {}).get("stars"),
-            (it.get("rating") or {}).get("count"),
-            it.get("category"),
-            it.get("tags"),
-        ))
+    """)
 
 # ---------- USERS ----------
-def ensure_users_table(conn: sqlite3.Connection):
-    conn.execute("""
+def ensure_users_table(conn: Connection):
+    conn.exec_driver_sql("""
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             email TEXT UNIQUE NOT NULL,
@@ -137,22 +98,23 @@ def ensure_users_table(conn: sqlite3.Connection):
     """)
 
 # ---------- BAG ITEMS ----------
-def ensure_bag_table(conn: sqlite3.Connection):
-    conn.execute("""
+def ensure_bag_table(conn: Connection):
+    # Same shape as db.BagItem. An older (email, product_id) table is left alone:
+    # migrate.py parks it and backfill_bag.py moves its rows.
+    conn.exec_driver_sql("""
     CREATE TABLE IF NOT EXISTS bag_items (
-      email TEXT NOT NULL,
-      product_id TEXT NOT NULL,
+      user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+      product_id TEXT NOT NULL REFERENCES items(id) ON DELETE CASCADE,
       added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-      PRIMARY KEY (email, product_id)
+      PRIMARY KEY (user_id, product_id)
     );
     """)
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_bag_email ON bag_items(email)")
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_bag_product ON bag_items(product_id)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS idx_bag_product ON bag_items(product_id)")
 
-def backfill_fts(conn: sqlite3.Connection):
+def backfill_fts(conn: Connection):
     # Clear and repopulate FTS from items
-    conn.execute("DELETE FROM items_fts")
-    conn.execute("""
+    conn.exec_driver_sql("DELETE FROM items_fts")
+    conn.exec_driver_sql("""
         INSERT INTO items_fts (id, item_name, company, category, tags)
         SELECT id, item_name, company, category, tags
         FROM items
@@ -160,44 +122,45 @@ def backfill_fts(conn: sqlite3.Connection):
 
 # ---------- MAIN ----------
 def main():
-    conn = sqlite3.connect(DB_PATH)
-    try:
+    # ingest reads its batch sizes from config, which wants a DATABASE_URL; this script only writes the file
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{DB_PATH}")
+    from ingest import load_feed
+
+    engine = create_engine(f"sqlite:///{DB_PATH}")
+
+    @event.listens_for(engine, "connect")
+    def _foreign_keys(dbapi_conn, _):
+        # Items that leave the feed take their bag rows with them
+        dbapi_conn.execute("PRAGMA foreign_keys = ON")
+
+    with engine.begin() as conn:
         # create/ensure tables
         ensure_items_table(conn)
-        # Try to create FTS (skip quietly if FTS not available)
+        ensure_item_hashes_table(conn)
+        ensure_users_table(conn)
+        ensure_bag_table(conn)
+        # FTS before the load, so its triggers (or the bulk rebuild in ingest) keep it current;
+        # skipped quietly if FTS is not available
         try:
-            ensure_items_fts(conn)
+            with conn.begin_nested():
+                ensure_items_fts(conn)
             has_fts = True
-        except sqlite3.OperationalError:
+        except OperationalError:
             # Your SQLite build might not include FTS5
             print("⚠️  FTS5 not available in this SQLite build. Falling back to LIKE search in API.")
             has_fts = False
+        # A file from before FTS existed
+        if has_fts and not conn.exec_driver_sql("SELECT 1 FROM items_fts LIMIT 1").first():
+            backfill_fts(conn)
 
-        ensure_users_table(conn)
-        ensure_bag_table(conn)
-
-        # seed items from JSON if present
-        seeded = False
-        if Path(JSON_PATH).exists():
-            items = load_items_from_json(JSON_PATH)
-            upsert_items(conn, items)
-            print(f"✅ Seeded {len(items)} items into {DB_PATH}")
-            seeded = True
-        else:
-            print(f"ℹ️ {JSON_PATH} not found, skipping items seed.")
-
-        # Backfill FTS once (on first run or after reseed)
-        if has_fts:
-            # Only backfill if we just seeded or if FTS is empty
-            cnt = conn.execute("SELECT COUNT(1) FROM items_fts").fetchone()[0]
-            if seeded or cnt == 0:
-                backfill_fts(conn)
-                print("✅ FTS backfilled from items")
-
-        conn.commit()
-        print("✅ users and bag_items tables ready in items.db")
-    finally:
-        conn.close()
+    # seed items from JSON if present: the same delta sync the app's seeders run
+    if Path(JSON_PATH).exists():
+        stats = load_feed(engine, JSON_PATH)
+        print(f"✅ Synced {stats} into {DB_PATH}")
+    else:
+        print(f"ℹ️ {JSON_PATH} not found, skipping items seed.")
+    engine.dispose()
+    print("✅ users and bag_items tables ready in items.db")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,189 @@
+from __future__ import annotations
+import heapq, re, threading, time
+from typing import Any, Dict, Iterable, List, Mapping, Set, Tuple
+
+from config import settings
+
+# Fields whose values are offered as completions
+SUGGEST_FIELDS = ("item_name", "company", "category")
+# Completions are also reachable from the start of their 2nd..Nth word ("shi" -> "Slim Fit Shirt")
+MAX_WORD_STARTS = 6
+
+Key = Tuple[str, str]  # (field, normalised text)
+
+def normalize(text: str) -> str:
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+class _Node:
+    __slots__ = ("children", "here", "top")
+
+    def __init__(self):
+        self.children: Dict[str, _Node] = {}
+        self.here: Set[Tuple[str, Key]] = set()  # (indexed string, key) ending here, or below at max depth
+        self.top: List[Key] = []                  # best keys in this subtree, heaviest first
+
+class Suggester:
+    """Prefix trie of catalog phrases, weighted by the rating_count of the items carrying them.
+
+    Every node keeps its subtree's top `k` keys, so a completion is one walk
+    down the trie. Nodes stop at `depth` characters: the last node holds its
+    whole tail as a bucket that longer prefixes filter, which keeps the trie
+    small without slowing the short prefixes type-ahead sends most. Item
+    writes adjust the weights along the affected paths only, stopping as soon
+    as a node's top list doesn't change.
+    """
+
+    def __init__(self, k: int, depth: int, ttl: float):
+        self.k = k
+        self.depth = depth
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._built_at: float | None = None
+        self._reset()
+
+    def _reset(self) -> None:
+        self._root = _Node()
+        self._weight: Dict[Key, int] = {}
+        self._count: Dict[Key, int] = {}        # items carrying the key; gone at 0
+        self._label: Dict[Key, str] = {}        # display text, as first seen
+        self._item_keys: Dict[str, List[Tuple[Key, int]]] = {}
+
+    # ---------- Maintenance ----------
+    def stale(self) -> bool:
+        with self._lock:
+            if self._built_at is None:
+                return True
+            return bool(self.ttl) and time.monotonic() - self._built_at > self.ttl
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._built_at = None
+
+    def load(self, rows: Iterable[Mapping[str, Any]]) -> None:
+        with self._lock:
+            self._reset()
+            for row in rows:
+                self._item_keys[row["id"]] = contrib = self._contributions(row)
+                for key, w in contrib:
+                    self._weight[key] = self._weight.get(key, 0) + w
+                    self._count[key] = self._count.get(key, 0) + 1
+            for key in self._weight:
+                for s in self._strings(key):
+                    self._walk(s[:self.depth], create=True)[-1].here.add((s, key))
+            self._fill(self._root)
+            self._built_at = time.monotonic()
+
+    def upsert(self, row: Mapping[str, Any]) -> None:
+        with self._lock:
+            if self._built_at is None:
+                return
+            old = self._item_keys.pop(row["id"], [])
+            self._item_keys[row["id"]] = new = self._contributions(row)
+            self._apply(old, new)
+
+    def remove(self, item_id: str) -> None:
+        with self._lock:
+            if self._built_at is not None:
+                self._apply(self._item_keys.pop(item_id, []), [])
+
+    def _contributions(self, row: Mapping[str, Any]) -> List[Tuple[Key, int]]:
+        w = int(row.get("rating_count") or 0)
+        out = []
+        for field in SUGGEST_FIELDS:
+            value = row.get(field)
+            text = normalize(str(value)) if value else ""
+            if text:
+                self._label.setdefault((field, text), str(value).strip())
+                out.append(((field, text), w))
+        return out
+
+    def _strings(self, key: Key) -> List[str]:
+        words = key[1].split(" ")
+        return [" ".join(words[i:]) for i in range(min(len(words), MAX_WORD_STARTS))]
+
+    def _walk(self, prefix: str, create: bool = False) -> List[_Node]:
+        """Nodes from the root along `prefix`; shorter than len(prefix) + 1 when it runs out."""
+        node, path = self._root, [self._root]
+        for ch in prefix:
+            nxt = node.children.get(ch)
+            if nxt is None:
+                if not create:
+                    break
+                nxt = node.children[ch] = _Node()
+            node = nxt
+            path.append(node)
+        return path
+
+    def _rank(self, keys: Iterable[Key]) -> List[Key]:
+        return heapq.nsmallest(self.k, set(keys), key=lambda key: (-self._weight[key], key[1]))
+
+    def _fill(self, node: _Node) -> None:
+        for child in node.children.values():
+            self._fill(child)
+        node.top = self._rank(self._candidates(node))
+
+    def _candidates(self, node: _Node) -> Iterable[Key]:
+        yield from (key for _, key in node.here)
+        for child in node.children.values():
+            yield from child.top
+
+    def _apply(self, old: List[Tuple[Key, int]], new: List[Tuple[Key, int]]) -> None:
+        """Move one item's weight from its `old` keys to its `new` ones and refresh the touched paths."""
+        delta: Dict[Key, Tuple[int, int]] = {}
+        for key, w in old:
+            dw, dc = delta.get(key, (0, 0))
+            delta[key] = (dw - w, dc - 1)
+        for key, w in new:
+            dw, dc = delta.get(key, (0, 0))
+            delta[key] = (dw + w, dc + 1)
+        for key, (dw, dc) in delta.items():
+            if dw == 0 and dc == 0:
+                continue
+            existed = key in self._weight
+            self._weight[key] = self._weight.get(key, 0) + dw
+            self._count[key] = self._count.get(key, 0) + dc
+            gone = self._count[key] <= 0
+            for s in self._strings(key):
+                path = self._walk(s[:self.depth], create=not gone)
+                if gone:
+                    path[-1].here.discard((s, key))
+                elif not existed:
+                    path[-1].here.add((s, key))
+                self._refresh(path, key, gone)
+            if gone:
+                del self._weight[key], self._count[key]
+                self._label.pop(key, None)
+
+    def _refresh(self, path: List[_Node], key: Key, gone: bool) -> None:
+        """Re-rank `path` bottom-up after `key` changed weight (or left, when `gone`)."""
+        for node in reversed(path):
+            # A departing key still has a weight; leave it out of the ranking
+            top = self._rank(k for k in self._candidates(node) if not (gone and k == key))
+            # Ancestors only see this node's top; once that is unchanged and doesn't hold key, stop
+            if top == node.top and key not in top:
+                break
+            node.top = top
+
+    # ---------- Query ----------
+    def complete(self, prefix: str, limit: int) -> List[Dict[str, Any]]:
+        """Up to `limit` completions of `prefix`, heaviest first."""
+        prefix = normalize(prefix) + (" " if prefix[-1:].isspace() and prefix.strip() else "")
+        if not prefix:
+            return []
+        with self._lock:
+            path = self._walk(prefix[:self.depth])
+            if len(path) <= min(len(prefix), self.depth):
+                return []
+            node = path[-1]
+            if len(prefix) <= self.depth:
+                keys = node.top[:limit]
+            else:
+                # Past the trie depth: filter the bucket this prefix falls into
+                keys = self._rank(key for s, key in node.here if s.startswith(prefix))[:limit]
+            return [{"text": self._label[key], "field": key[0], "weight": self._weight[key]} for key in keys]
+
+suggester = Suggester(
+    k=settings.SUGGEST_MAX_LIMIT,
+    depth=settings.SUGGEST_TRIE_DEPTH,
+    ttl=settings.SEARCH_INDEX_TTL_SECONDS,
+)
@@ -0,0 +1,711 @@
+# test_backend.py
+# Backend checks against a throwaway SQLite file (sql_convert.py's tables, a
+# small generated catalog). Run from this directory:
+#
+#   python -m pytest -q test_backend.py
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+
+# Before any app module reads config
+_tmp = tempfile.TemporaryDirectory()
+DB_FILE = os.path.join(_tmp.name, "primary.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{DB_FILE}"
+os.environ["CATALOG_CACHE_TTL_SECONDS"] = "0"  # no wall-clock windows: entries live until a write
+
+import pytest
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, delete, insert, select, update
+from sqlalchemy.orm import Session
+
+import facets
+import functions
+from bag_buffer import BagBuffer
+from catalog import ItemQuery, decode_cursor, dump_json, encode_cursor, fetch_page, stream_json
+from catalog_cache import cached_response, catalog_cache, streamed_response
+import replicas
+from feed import FeedError, iter_items, read_checkpoint, write_checkpoint
+from db import Base, BagItem, Item, ReplicaHeartbeat, SessionLocal, User, engine
+from http_cache import ConditionalGetMiddleware
+from config import settings
+from db_pool import SHAPE_MAX_CHARS, statement_shape
+from functions import (
+    create_access_token, hash_password, needs_rehash, rehash_password, set_revocation_check,
+    verify_password, verify_password_async,
+)
+from ingest import FTS_TABLES, load_feed, mark_stale, sync_items
+from sql_convert import ensure_item_hashes_table, ensure_items_fts, ensure_items_table
+from replicas import ReplicaSet, WriteMarkerMiddleware, get_read_session, read_session
+
+# 30 items; prices repeat and a few are missing, so keysets have ties and gaps to get right
+ITEMS = [
+    {
+        "id": f"{n:03d}",
+        "item_name": f"item {n}",
+        "company": "acme" if n % 2 else "globex",
+        "category": "men" if n % 3 else "women",
+        "current_price": None if n % 11 == 0 else float(100 * (n % 4)),
+        "discount_percentage": n % 7 * 10,
+        "rating": {"stars": None if n % 5 == 0 else round(1 + n % 9 / 2, 1), "count": n},
+    }
+    for n in range(1, 31)
+]
+
+def _create_schema():
+    # db.py's migrations are Postgres-only: items from sql_convert.py's SQLite DDL, the rest from the models
+    with engine.begin() as conn:
+        ensure_items_table(conn)
+        ensure_item_hashes_table(conn)
+        ensure_items_fts(conn)
+        facets.setup(conn)
+        Base.metadata.create_all(conn, tables=[User.__table__, BagItem.__table__, ReplicaHeartbeat.__table__])
+        conn.execute(insert(ReplicaHeartbeat).values(id=1, beat_at=0))
+
+@pytest.fixture(scope="module", autouse=True)
+def catalog_db():
+    _create_schema()
+    with engine.begin() as conn:
+        sync_items(conn, ITEMS)
+    yield
+    engine.dispose()
+
+# ---------- Keyset cursors ----------
+@pytest.mark.parametrize("sort, value", [("id", None), ("price_asc", 200.0), ("rating", 4.5)])
+def test_cursor_round_trip(sort, value):
+    assert decode_cursor(encode_cursor("007", sort, value), sort) == (value, "007")
+
+@pytest.mark.parametrize("cursor, sort", [
+    (encode_cursor("007", "price_asc", 200.0), "price_desc"),  # made for another ordering
+    (encode_cursor("007"), "rating"),
+    ("not a cursor", "id"),
+])
+def test_cursor_rejected(cursor, sort):
+    with pytest.raises(HTTPException) as err:
+        decode_cursor(cursor, sort)
+    assert err.value.status_code == 400
+
+# sort -> (an item's value for it, descending), as catalog.SORTS orders them
+SORT_VALUES = {
+    "id": (lambda it: it["id"], False),
+    "price_asc": (lambda it: it["current_price"], False),
+    "price_desc": (lambda it: it["current_price"], True),
+    "rating": (lambda it: it["rating"]["stars"], True),
+}
+
+def _expected_ids(sort):
+    value, desc = SORT_VALUES[sort]
+    rows = sorted(((value(it), it["id"]) for it in ITEMS if value(it) is not None), reverse=desc)
+    return [i for _, i in rows]
+
+@pytest.mark.parametrize("sort", list(SORT_VALUES))
+def test_pages_follow_cursor(sort):
+    q = ItemQuery(sort=sort)
+    seen, cursor = [], None
+    with SessionLocal() as db:
+        while True:
+            after = decode_cursor(cursor, sort) if cursor else None
+            page = fetch_page(db, ("id",), after, 4, q)
+            assert len(page["items"]) <= 4
+            seen += [it["id"] for it in page["items"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+    # Every item with a value for the sort, once, in order
+    assert seen == _expected_ids(sort)
+
+def test_cursor_with_filters():
+    q = ItemQuery(company=("acme",), sort="price_desc")
+    with SessionLocal() as db:
+        first = fetch_page(db, ("id", "company"), None, 3, q)
+        rest = fetch_page(db, ("id", "company"), decode_cursor(first["next_cursor"], q.sort), 100, q)
+    ids = [it["id"] for it in first["items"] + rest["items"]]
+    assert rest["next_cursor"] is None
+    assert ids == [i for i in _expected_ids("price_desc") if int(i) % 2]
+
+# ---------- Feed reader ----------
+# Multi-byte text and long numbers, so small chunks cut through characters and values
+FEED_ITEMS = [
+    {"id": f"f{n}", "item_name": "Kurta \u00e9t\u00e9 \u2014 \U0001f455 " * (n + 1), "current_price": 1234.5678 * n, "tags": [n] * n}
+    for n in range(7)
+]
+
+def _write_feed(path, payload, indent=None):
+    path.write_text(json.dumps(payload, ensure_ascii=False, indent=indent), encoding="utf-8")
+    return path
+
+@pytest.fixture(params=["flat", "nested"])
+def feed_path(request, tmp_path):
+    items = FEED_ITEMS if request.param == "flat" else [FEED_ITEMS[:3], FEED_ITEMS[3:5], [], FEED_ITEMS[5:]]
+    # Keys before "items" are skipped, whatever they hold
+    return _write_feed(tmp_path / "feed.json", {"version": 2, "meta": {"items": ["decoy"]}, "items": items}, indent=1)
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 1 << 16])
+def test_feed_reads_across_chunk_boundaries(feed_path, chunk_size):
+    assert [it for it, _ in iter_items(feed_path, chunk_size=chunk_size)] == FEED_ITEMS
+
+def test_feed_resumes_after_any_item(feed_path):
+    offsets = [offset for _, offset in iter_items(feed_path)]
+    for n, offset in enumerate(offsets):
+        assert [it for it, _ in iter_items(feed_path, offset, chunk_size=5)] == FEED_ITEMS[n + 1:]
+
+def test_feed_checkpoint_mid_inner_array(tmp_path):
+    path = _write_feed(tmp_path / "feed.json", {"items": [FEED_ITEMS[:3], FEED_ITEMS[3:]]})
+    offsets = [offset for _, offset in iter_items(path)]
+    write_checkpoint(path, offsets[1])  # after the second item of the first inner array
+    assert read_checkpoint(path) == offsets[1]
+    assert [it["id"] for it, _ in iter_items(path, read_checkpoint(path))] == [it["id"] for it in FEED_ITEMS[2:]]
+
+def test_feed_checkpoint_dropped_when_file_changes(tmp_path):
+    path = _write_feed(tmp_path / "feed.json", {"items": FEED_ITEMS})
+    offset = next(iter_items(path))[1]
+
+    write_checkpoint(path, offset)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("\n")
+    assert read_checkpoint(path) == 0
+
+    write_checkpoint(path, offset)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))  # same size, rewritten
+    assert read_checkpoint(path) == 0
+
+@pytest.mark.parametrize("document", [
+    '["not", "an", "object"]',
+    '{"products": []}',
+    '{"items": {"id": "x"}}',
+    '{"items": [{"id": "a"} {"id": "b"}]}',
+    '{"items": [{"id": "a"}, 42]}',
+    '{"items": [[{"id": "a"}], {"id": "b"}]}',
+    '{"items": [{"id": "a", "item_name": "cut sh',
+])
+def test_feed_rejects_malformed_input(tmp_path, document):
+    path = tmp_path / "feed.json"
+    path.write_text(document, encoding="utf-8")
+    with pytest.raises(FeedError):
+        list(iter_items(path, chunk_size=4))
+
+# ---------- Feed sync ----------
+def _feed_item(item_id, **fields):
+    return {"id": item_id, "item_name": f"feed {item_id}", "company": "initech", "category": "kids", **fields}
+
+@pytest.fixture
+def reseed():
+    """sync_items in its own transaction; the module's catalog is synced back afterwards."""
+    def run(items, **kwargs):
+        with engine.begin() as conn:
+            return sync_items(conn, items, **kwargs)
+    yield run
+    run(ITEMS)
+
+def _item_ids(prefix):
+    with SessionLocal() as db:
+        return sorted(db.execute(select(Item.id).where(Item.id.startswith(prefix))).scalars())
+
+def test_patched_item_still_follows_feed(reseed):
+    reseed(ITEMS + [_feed_item(p) for p in ("p0", "p1", "p2")])
+    # PATCH /items/p1, as update_item writes it
+    with engine.begin() as conn:
+        conn.execute(update(Item).where(Item.id == "p1").values(item_name="edited"))
+        mark_stale(conn, "p1")
+
+    stats = reseed(ITEMS + [_feed_item(p) for p in ("p0", "p1", "p2")])
+    assert (stats.updated, stats.deleted) == (1, 0)  # the feed's version is back
+    with engine.begin() as conn:
+        conn.execute(update(Item).where(Item.id == "p1").values(item_name="edited"))
+        mark_stale(conn, "p1")
+
+    stats = reseed(ITEMS + [_feed_item(p) for p in ("p0", "p2")])
+    assert stats.deleted == 1
+    assert _item_ids("p") == ["p0", "p2"]
+
+def test_unchanged_reseed_writes_nothing(reseed):
+    stats = reseed(ITEMS)
+    assert (stats.rows, stats.unchanged) == (len(ITEMS), len(ITEMS))
+    assert (stats.inserted, stats.updated, stats.deleted) == (0, 0, 0)
+
+def test_reseed_applies_the_delta(reseed):
+    feed = ITEMS + [_feed_item("p0"), _feed_item("p1")]
+    assert reseed(feed).inserted == 2
+
+    feed[-1] = _feed_item("p1", item_name="renamed")
+    stats = reseed(feed[:-2] + feed[-1:])  # p0 left the feed
+    assert (stats.inserted, stats.updated, stats.deleted) == (0, 1, 1)
+    with SessionLocal() as db:
+        assert db.execute(select(Item.item_name).where(Item.id == "p1")).scalar() == "renamed"
+    assert _item_ids("p") == ["p1"]
+
+def test_api_items_left_alone(reseed):
+    with engine.begin() as conn:
+        conn.execute(insert(Item).values(id="p-api", item_name="made through POST /items"))
+    try:
+        assert reseed(ITEMS).deleted == 0
+        assert _item_ids("p") == ["p-api"]
+    finally:
+        with engine.begin() as conn:
+            conn.execute(delete(Item).where(Item.id == "p-api"))
+
+def _search_rows(conn):
+    # Every FTS table holds exactly the items' rows
+    return {t: sorted(conn.exec_driver_sql(f"SELECT id, item_name FROM {t}").all()) for t in FTS_TABLES
+            if conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = ?", (t,)).first()}
+
+def _facet_rows(conn):
+    return sorted(conn.exec_driver_sql("SELECT facet, value, item_count FROM facet_counts WHERE item_count > 0").all())
+
+def _assert_indexes_match_items():
+    with engine.connect() as conn:
+        items = sorted(conn.exec_driver_sql("SELECT id, item_name FROM items").all())
+        search = _search_rows(conn)
+        assert search and all(rows == items for rows in search.values())
+        kept = _facet_rows(conn)
+        facets.rebuild(conn)
+        assert kept == _facet_rows(conn)
+        conn.rollback()
+
+def test_deferred_load_rebuilds_search_and_facets(reseed, monkeypatch):
+    monkeypatch.setattr(settings, "SEED_DEFER_MIN_CHANGES", 5)
+    with engine.connect() as conn:
+        triggers = conn.exec_driver_sql("SELECT count(*) FROM sqlite_master WHERE type = 'trigger'").scalar()
+    feed = ITEMS + [_feed_item(f"p{n:02d}", current_price=250.0 * n) for n in range(20)]
+    assert reseed(feed).inserted == 20
+    _assert_indexes_match_items()
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("SELECT count(*) FROM sqlite_master WHERE type = 'trigger'").scalar() == triggers
+
+    # A small delta goes through the restored triggers
+    feed[-1] = _feed_item("p19", company="umbrella", item_name="renamed")
+    assert reseed(feed[:-3] + feed[-1:]).deleted == 2
+    _assert_indexes_match_items()
+
+def test_chunked_load_resumes_and_deletes(tmp_path, reseed):
+    reseed(ITEMS + [_feed_item("p-gone")])
+    path = tmp_path / "feed.json"
+    path.write_text(json.dumps({"items": ITEMS + [_feed_item(f"p{n}") for n in range(5)]}))
+    stats = load_feed(engine, path, commit_every=7)
+    assert (stats.rows, stats.inserted, stats.deleted) == (len(ITEMS) + 5, 5, 1)
+    assert _item_ids("p") == [f"p{n}" for n in range(5)]
+    assert list(tmp_path.iterdir()) == [path]  # checkpoint cleared
+
+# ---------- Catalog cache and conditional GETs ----------
+@pytest.fixture
+def catalog_app():
+    """/items and /items/all wired like main.py's listing, plus a log of the bodies built."""
+    app = FastAPI()
+    app.add_middleware(ConditionalGetMiddleware, paths=("/items",))
+    builds = []
+
+    def page():
+        builds.append("page")
+        with SessionLocal() as db:
+            yield dump_json(fetch_page(db, ("id", "item_name"), None, 4))
+
+    def whole():
+        builds.append("all")
+        return stream_json(("id",))
+
+    @app.get("/items")
+    def items():
+        return cached_response(("items", 4), page)
+
+    @app.get("/items/all")
+    def items_all():
+        return streamed_response(("items", None), whole)
+
+    catalog_cache.invalidate()
+    with TestClient(app) as client:
+        yield client, builds
+
+def _rename(item_id, name):
+    # A write, as the CRUD endpoints make it: the table, then the cache
+    with engine.begin() as conn:
+        conn.execute(update(Item).where(Item.id == item_id).values(item_name=name))
+    catalog_cache.invalidate()
+
+def test_cache_serves_until_invalidated(catalog_app):
+    client, builds = catalog_app
+    first = client.get("/items")
+    assert client.get("/items").content == first.content
+    assert builds == ["page"]
+
+    _rename("001", "renamed")
+    try:
+        again = client.get("/items")
+        assert again.json()["items"][0]["item_name"] == "renamed"
+        assert builds == ["page", "page"]
+    finally:
+        _rename("001", "item 1")
+
+def test_streamed_listing_is_kept(catalog_app):
+    client, builds = catalog_app
+    streamed = client.get("/items/all")
+    assert [it["id"] for it in streamed.json()["items"]] == sorted(it["id"] for it in ITEMS)
+    assert client.get("/items/all").content == streamed.content
+    assert builds == ["all"]
+
+def test_not_modified(catalog_app):
+    client, builds = catalog_app
+    r = client.get("/items")
+    etag, last_modified = r.headers["etag"], r.headers["last-modified"]
+
+    for headers in (
+        {"If-None-Match": etag},
+        {"If-None-Match": etag[:-1] + '-gzip"'},  # the ETag compression.py gives the gzip body
+        {"If-None-Match": f'"other", W/{etag}'},
+        {"If-Modified-Since": last_modified},
+    ):
+        cached = client.get("/items", headers=headers)
+        assert cached.status_code == 304, headers
+        assert cached.content == b""
+        assert cached.headers["etag"] == headers.get("If-None-Match", etag).split(", ")[-1]
+    assert builds == ["page"]
+
+    # A write changes both validators
+    catalog_cache.invalidate()
+    fresh = client.get("/items", headers={"If-None-Match": etag})
+    assert fresh.status_code == 200
+    assert fresh.headers["etag"] != etag
+    assert client.get("/items", headers={"If-Modified-Since": last_modified}).status_code == 200
+    assert client.get("/items", headers={"If-None-Match": fresh.headers["etag"]}).status_code == 304
+
+# ---------- Write-behind bag ----------
+@pytest.fixture
+def user_id():
+    with engine.begin() as conn:
+        uid = conn.execute(
+            insert(User).values(email="bag@example.com", username="bag", password_hash="x", salt="x")
+        ).inserted_primary_key[0]
+    yield uid
+    with engine.begin() as conn:
+        conn.execute(delete(BagItem).where(BagItem.user_id == uid))
+        conn.execute(delete(User).where(User.id == uid))
+
+def _buffer(log_path):
+    # The flusher thread never gets to run on its own: the tests flush by hand
+    return BagBuffer(str(log_path), interval=3600, max_pending=1000, max_users=100, ttl=60, fsync=False)
+
+def _stored(user_id):
+    with SessionLocal() as db:
+        return sorted(db.execute(select(BagItem.product_id).where(BagItem.user_id == user_id)).scalars())
+
+def _crash(buf):
+    # What a killed worker leaves: its logs, and a lock nobody holds
+    buf.flush = lambda: 0  # no last round on the way out
+    buf._stop.set()
+    buf._wake.set()
+    buf._thread.join()
+    buf._log.close()
+    buf._lock_file.close()
+
+def test_failed_flush_is_requeued(user_id, tmp_path, monkeypatch):
+    buf = _buffer(tmp_path / "bag.log")
+    buf.start()
+    try:
+        with SessionLocal() as db:
+            assert buf.add(db, user_id, ["001", "002", "no-such-item"]) == 2
+
+        def write_fails(wanted):
+            # A tap made while the batch is out assumes it landed
+            with SessionLocal() as db:
+                buf.remove(db, user_id, ["002"])
+            raise RuntimeError("database unavailable")
+
+        monkeypatch.setattr(buf, "_write", write_fails)
+        with pytest.raises(RuntimeError):
+            buf.flush()
+        monkeypatch.undo()
+        assert _stored(user_id) == []
+        assert buf.dirty(user_id)
+        with SessionLocal() as db:
+            assert buf.ids(db, user_id) == ["001"]
+
+        # 002 went back to what the table holds, so only 001 is left to write
+        assert buf.flush() == 1
+        assert _stored(user_id) == ["001"]
+        assert not buf.dirty(user_id)
+    finally:
+        buf.stop()
+    assert list(tmp_path.iterdir()) == []
+
+def test_failed_flush_replayed_after_crash(user_id, tmp_path, monkeypatch):
+    dead = _buffer(tmp_path / "bag.log")
+    dead.start()
+    with SessionLocal() as db:
+        dead.add(db, user_id, ["003", "004"])
+    monkeypatch.setattr(dead, "_write", lambda wanted: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        dead.flush()
+    with SessionLocal() as db:
+        dead.remove(db, user_id, ["004"])  # after the failure: replay must end with it out
+    _crash(dead)
+    assert _stored(user_id) == []
+
+    survivor = _buffer(tmp_path / "bag.log")
+    assert survivor.start() == 2
+    try:
+        assert _stored(user_id) == ["003"]
+        assert not any(p.name.startswith(os.path.basename(dead.log_path)) for p in tmp_path.iterdir())
+    finally:
+        survivor.stop()
+    assert list(tmp_path.iterdir()) == []
+
+def test_running_worker_log_left_alone(user_id, tmp_path):
+    live = _buffer(tmp_path / "bag.log")
+    live.start()
+    try:
+        with SessionLocal() as db:
+            live.add(db, user_id, ["005"])
+        other = _buffer(tmp_path / "bag.log")
+        assert other.start() == 0
+        other.stop()
+        assert _stored(user_id) == []
+        assert live.flush() == 1
+        assert _stored(user_id) == ["005"]
+    finally:
+        live.stop()
+
+# ---------- Slow query log ----------
+@pytest.mark.parametrize("statement, shape", [
+    ("SELECT items.id FROM items\n  WHERE items.id IN (?, ?, ?) AND items.company = 'O''Neil' LIMIT 50",
+     "SELECT items.id FROM items WHERE items.id IN (...) AND items.company = ? LIMIT ?"),
+    ("UPDATE users SET password_hash=%(password_hash)s WHERE users.id IN (%(id_1_1)s, %(id_1_2)s)",
+     "UPDATE users SET password_hash=%(password_hash)s WHERE users.id IN (...)"),
+    ("SELECT t1.id FROM t1 WHERE t1.rating > 4.5 AND t1.id = $1 AND t1.tag IN ($2, $3)",
+     "SELECT t1.id FROM t1 WHERE t1.rating > ? AND t1.id = $1 AND t1.tag IN (...)"),
+])
+def test_slow_queries_keep_only_the_shape(statement, shape):
+    assert statement_shape(statement) == shape
+
+def test_slow_query_shape_truncated():
+    assert len(statement_shape("SELECT " + "items.item_name, " * 100 + "items.id FROM items")) == SHAPE_MAX_CHARS
+
+# ---------- Passwords ----------
+@pytest.fixture
+def fast_kdf(monkeypatch):
+    # The real schemes at toy costs
+    monkeypatch.setattr(settings, "PASSWORD_SCHEME", "pbkdf2_sha256")
+    monkeypatch.setattr(settings, "PBKDF2_ITERATIONS", 1000)
+    monkeypatch.setattr(settings, "LEGACY_PBKDF2_ITERATIONS", 500)
+    monkeypatch.setattr(settings, "SCRYPT_N", 16)
+
+def _legacy_hash(password, salt_hex):
+    # What rows written before passwords.py hold: a bare hex digest, the salt in its own column
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt_hex), settings.LEGACY_PBKDF2_ITERATIONS).hex()
+
+def _set_hash(user_id, password_hash, salt):
+    with engine.begin() as conn:
+        conn.execute(update(User).where(User.id == user_id).values(password_hash=password_hash, salt=salt))
+
+def _stored_hash(user_id):
+    with SessionLocal() as db:
+        return tuple(db.execute(select(User.password_hash, User.salt).where(User.id == user_id)).one())
+
+def test_legacy_hash_verifies_and_needs_rehash(fast_kdf):
+    salt = "ab" * 16
+    stored = _legacy_hash("hunter2", salt)
+    assert verify_password("hunter2", stored, salt)
+    assert not verify_password("hunter3", stored, salt)
+    assert needs_rehash(stored, salt)
+
+def test_current_hash_not_rehashed(fast_kdf, monkeypatch):
+    stored, salt = hash_password("hunter2")
+    assert verify_password("hunter2", stored, salt)
+    assert not needs_rehash(stored, salt)
+    # A raised cost or another scheme flags it again
+    monkeypatch.setattr(settings, "PBKDF2_ITERATIONS", 2000)
+    assert needs_rehash(stored, salt)
+    monkeypatch.setattr(settings, "PBKDF2_ITERATIONS", 1000)
+    monkeypatch.setattr(settings, "PASSWORD_SCHEME", "scrypt")
+    assert needs_rehash(stored, salt)
+
+def test_rehash_moves_to_target(fast_kdf, user_id):
+    salt = "cd" * 16
+    legacy = _legacy_hash("hunter2", salt)
+    _set_hash(user_id, legacy, salt)
+    asyncio.run(rehash_password(user_id, "hunter2", legacy))
+    stored, new_salt = _stored_hash(user_id)
+    assert stored.startswith("pbkdf2_sha256$i=1000$")
+    assert verify_password("hunter2", stored, new_salt)
+    assert not needs_rehash(stored, new_salt)
+
+def test_rehash_keeps_a_concurrent_change(fast_kdf, user_id, monkeypatch):
+    salt = "cd" * 16
+    legacy = _legacy_hash("hunter2", salt)
+    _set_hash(user_id, legacy, salt)
+    changed = hash_password("new-secret")
+    hash_async = functions.hash_password_async
+
+    async def racing(password):
+        # The user changes their password while the login's rehash is being derived
+        _set_hash(user_id, *changed)
+        return await hash_async(password)
+
+    monkeypatch.setattr(functions, "hash_password_async", racing)
+    asyncio.run(rehash_password(user_id, "hunter2", legacy))
+    assert _stored_hash(user_id) == changed
+
+@pytest.mark.parametrize("stored, salt", [
+    ("md5$i=1000$abcd$00", "abcd"),
+    ("pbkdf2_sha256$i=1000$abcd", "abcd"),
+    ("pbkdf2_sha256$i=1000$abcd$00$00", "abcd"),
+    ("pbkdf2_sha256$i=lots$abcd$00", "abcd"),
+    ("pbkdf2_sha256$i=0$abcd$00", "abcd"),
+    ("pbkdf2_sha256$n=1000$abcd$00", "abcd"),
+    ("pbkdf2_sha256$i=1000$not-hex$00", "abcd"),
+    ("scrypt$n=15,r=8,p=1$abcd$00", "abcd"),
+    ("scrypt$n=16,r=8$abcd$00", "abcd"),
+    ("deadbeef", "not-hex"),
+])
+def test_malformed_hash_fails_closed(fast_kdf, stored, salt):
+    assert not verify_password("hunter2", stored, salt)
+    assert not asyncio.run(verify_password_async("hunter2", stored, salt))
+    assert not needs_rehash(stored, salt)
+
+# ---------- Token cache ----------
+@pytest.fixture(params=["get_current_user", "_user_from_claims"])
+def auth_client(request, user_id):
+    # The DB-backed and the stateless dependency share the verified-token cache
+    dependency = getattr(functions, request.param)
+    app = FastAPI()
+
+    @app.get("/me")
+    def me(user=Depends(dependency)):
+        return user
+
+    yield TestClient(app)
+    set_revocation_check(None)
+
+def _token(user_id, ttl=60):
+    return create_access_token(str(user_id), {
+        "username": "bag", "email": "bag@example.com", "exp": int(time.time()) + ttl,
+    })
+
+def _clock_ahead(monkeypatch, seconds):
+    # functions.py reads both clocks: time.time() for the cache, datetime.now() for exp
+    later = time.time() + seconds
+
+    class _Later(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.fromtimestamp(later, tz)
+
+    monkeypatch.setattr(functions.time, "time", lambda: later)
+    monkeypatch.setattr(functions, "datetime", _Later)
+
+def test_revoked_token_rejected_while_cached(auth_client, user_id):
+    token = _token(user_id)
+    headers = {"Authorization": f"Bearer {token}"}
+    assert auth_client.get("/me", headers=headers).json()["id"] == user_id
+    assert functions._token_cache.get(token) is not None
+
+    set_revocation_check(lambda claims: claims["sub"] == str(user_id))
+    r = auth_client.get("/me", headers=headers)
+    assert r.status_code == 401 and r.json()["detail"] == "token revoked"
+
+def test_expired_token_not_served_from_cache(auth_client, user_id, monkeypatch):
+    assert settings.AUTH_TOKEN_CACHE_TTL_SECONDS > 120  # the cache entry alone would outlive the token
+    headers = {"Authorization": f"Bearer {_token(user_id, ttl=60)}"}
+    assert auth_client.get("/me", headers=headers).status_code == 200
+
+    _clock_ahead(monkeypatch, 120)
+    r = auth_client.get("/me", headers=headers)
+    assert r.status_code == 401 and r.json()["detail"] == "invalid token"
+
+# ---------- Replicas ----------
+@pytest.fixture
+def replica_set(tmp_path, monkeypatch):
+    """Two stand-in replicas, copies of the primary file, in place of DATABASE_REPLICA_URLS."""
+    pairs = []
+    for n in range(2):
+        path = tmp_path / f"replica{n}.db"
+        src, dst = sqlite3.connect(DB_FILE), sqlite3.connect(path)
+        src.backup(dst)
+        src.close()
+        dst.close()
+        pairs.append((create_engine(f"sqlite:///{path}"), None))
+    rs = ReplicaSet(pairs, max_lag=5, interval=1)
+    monkeypatch.setattr(replicas, "replicas", rs)
+    yield rs
+    for sync_engine, _ in pairs:
+        sync_engine.dispose()
+
+def _lag(rs, *seconds):
+    # Heartbeats as far behind as the replicas' copies would be (None: leave it), then one measurement
+    now = time.time()
+    for replica, lag in zip(rs.members, seconds):
+        if lag is None:
+            continue
+        with replica.engine.begin() as conn:
+            conn.execute(update(ReplicaHeartbeat).where(ReplicaHeartbeat.id == 1).values(beat_at=now - lag))
+    rs.measure()
+
+def _database(session: Session) -> str:
+    return session.get_bind().url.database
+
+def _served_from():
+    with read_session() as db:
+        return _database(db)
+
+def test_reads_go_round_robin_to_fresh_replicas(replica_set):
+    _lag(replica_set, 0.5, 1)
+    served = {_served_from() for _ in range(4)}
+    assert served == {_database(r.Session()) for r in replica_set.members}
+
+def test_lagging_replica_skipped(replica_set):
+    _lag(replica_set, 60, 1)
+    fresh = _database(replica_set.members[1].Session())
+    assert {_served_from() for _ in range(4)} == {fresh}
+
+def test_falls_back_to_primary(replica_set):
+    fallbacks = replica_set.fallbacks.value
+    _lag(replica_set, 60, 60)
+    assert _served_from() == DB_FILE
+    assert replica_set.fallbacks.value == fallbacks + 1
+
+    # A measurement from several heartbeats ago counts as missing
+    _lag(replica_set, 0, 0)
+    for replica in replica_set.members:
+        replica.measured_at -= 10 * replica_set.interval
+    assert _served_from() == DB_FILE
+
+    # As does a replica that can't be read
+    with replica_set.members[0].engine.begin() as conn:
+        conn.exec_driver_sql("DROP TABLE replica_heartbeat")
+    _lag(replica_set, None, 60)
+    assert _served_from() == DB_FILE
+
+def test_one_heartbeat_per_interval(replica_set):
+    with engine.begin() as conn:
+        conn.execute(update(ReplicaHeartbeat).where(ReplicaHeartbeat.id == 1).values(beat_at=0))
+    other_worker = ReplicaSet([], max_lag=5, interval=1)
+    assert replica_set.beat()
+    assert not other_worker.beat()
+
+def test_client_reads_its_writes_on_primary(replica_set):
+    app = FastAPI()
+    app.add_middleware(WriteMarkerMiddleware)
+
+    @app.post("/write")
+    def write():
+        return {"ok": True}
+
+    @app.get("/read")
+    def read(db: Session = Depends(get_read_session)):
+        return {"database": _database(db)}
+
+    _lag(replica_set, 0, 0)
+    with TestClient(app) as client:
+        assert client.get("/read").json()["database"] != DB_FILE
+        marker = client.post("/write").headers["X-Last-Write"]
+        # Any worker: the marker travels with the client, as a cookie or the header
+        assert client.get("/read").json()["database"] == DB_FILE
+        client.cookies.clear()
+        assert client.get("/read", headers={"X-Last-Write": marker}).json()["database"] == DB_FILE
+        stale = str(time.time() - 60)
+        assert client.get("/read", headers={"X-Last-Write": stale}).json()["database"] != DB_FILE
@@ -0,0 +1,65 @@
+# backfill_bag.py
+# Move bag rows parked by migration 5 (bag_items_legacy, keyed by email) into
+# bag_items (keyed by user id), a batch per transaction so it never holds long
+# locks and can be stopped and rerun at any point.
+#
+#   python backfill_bag.py
+#   python backfill_bag.py --batch 5000
+
+import argparse
+import time
+
+from sqlalchemy import inspect, text
+
+from db import engine, BAG_LEGACY_TABLE
+
+# The batch is always the head of the legacy table: moved rows are deleted in the same transaction
+_HEAD = text(f"SELECT email, product_id FROM {BAG_LEGACY_TABLE} ORDER BY email, product_id LIMIT :n")
+_IN_BATCH = "(b.email, b.product_id) <= (:email, :product_id)"
+_COPY = text(f"""
+    INSERT INTO bag_items (user_id, product_id, added_at)
+    SELECT u.id, b.product_id, b.added_at
+    FROM {BAG_LEGACY_TABLE} b
+    JOIN users u ON u.email = b.email
+    JOIN items i ON i.id = b.product_id
+    WHERE {_IN_BATCH}
+    ON CONFLICT DO NOTHING
+    RETURNING 1
+""")
+_DELETE = text(f"DELETE FROM {BAG_LEGACY_TABLE} AS b WHERE {_IN_BATCH}")
+
+def backfill(batch: int) -> dict:
+    """Copy and delete legacy rows batch by batch; drop the legacy table once it is empty."""
+    stats = {"copied": 0, "skipped": 0, "batches": 0}
+    with engine.connect() as conn:
+        if not inspect(conn).has_table(BAG_LEGACY_TABLE):
+            return stats
+    while True:
+        with engine.begin() as conn:
+            head = conn.execute(_HEAD, {"n": batch}).all()
+            if not head:
+                conn.execute(text(f"DROP TABLE {BAG_LEGACY_TABLE}"))
+                return stats
+            last = {"email": head[-1][0], "product_id": head[-1][1]}
+            copied = len(conn.execute(_COPY, last).all())
+            # Rows for deleted users or products, and ones already in the new bag, are dropped
+            taken = conn.execute(_DELETE, last).rowcount
+        stats["copied"] += copied
+        stats["skipped"] += taken - copied
+        stats["batches"] += 1
+
+def main():
+    ap = argparse.ArgumentParser(description="Move email-keyed bag rows into the user_id-keyed bag.")
+    ap.add_argument("--batch", type=int, default=1000, help="rows per transaction")
+    args = ap.parse_args()
+
+    start = time.perf_counter()
+    stats = backfill(args.batch)
+    if not stats["batches"]:
+        print(f"{BAG_LEGACY_TABLE} not found or empty, nothing to move")
+        return
+    print(f"moved {stats['copied']} bag rows ({stats['skipped']} skipped) "
+          f"in {stats['batches']} batches, {time.perf_counter() - start:.2f}s; {BAG_LEGACY_TABLE} dropped")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+from __future__ import annotations
+import glob, json, os, secrets, threading, time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, TextIO, Tuple
+
+try:
+    import fcntl
+except ImportError:  # not on Windows: BagBuffer.start() refuses to run
+    fcntl = None
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import bag
+import metrics
+from config import settings
+from db import BagItem, Item, engine
+
+Changes = Dict[int, Dict[str, bool]]  # user_id -> product_id -> wanted state (True = in the bag)
+
+class BagBuffer:
+    """Write-behind layer for bag taps (BAG_WRITE_BEHIND).
+
+    A user's bag is read from bag_items once and then served from memory.
+    Every add/remove is appended to a local log, applied to the in-memory bag
+    and kept as the product's wanted state; tapping a product back to what the
+    table already holds cancels its pending write. The flusher writes what is
+    left every `interval` seconds (sooner past `max_pending` changes) in one
+    transaction, then truncates the log. Whatever the log still holds at
+    startup is written back first, so an acknowledged tap survives a crash.
+
+    Each worker logs to its own `<log_path>.<pid>-<id>` and holds an flock on
+    a `.lock` file next to it while it runs. A worker starting up writes back
+    the logs whose lock nobody holds (their worker is gone), then removes them.
+
+    Other workers and direct readers of bag_items see changes up to `interval`
+    late; this process rereads a bag with nothing pending once it is older
+    than `ttl`.
+    """
+
+    def __init__(self, log_path: str, interval: float, max_pending: int, max_users: int, ttl: float, fsync: bool):
+        self.base_path = log_path
+        self.log_path = f"{log_path}.{os.getpid()}-{secrets.token_hex(3)}"
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_users = max_users
+        self.ttl = ttl
+        self.fsync = fsync
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._bags: OrderedDict[int, Tuple[Dict[str, None], float]] = OrderedDict()  # ordered set, loaded at
+        self._pending: Changes = {}
+        self._stored: Changes = {}      # what bag_items held when each pending product was first tapped
+        self._n_pending = 0
+        self._flushing: set[int] = set()  # users with changes in the transaction being written
+        self._log: TextIO | None = None
+        self._lock_file: TextIO | None = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+        self.taps = metrics.counter("bag_buffer.taps")
+        self.flushes = metrics.counter("bag_buffer.flushes")
+        self.flush_errors = metrics.counter("bag_buffer.flush_errors")
+        self.rows_written = metrics.counter("bag_buffer.rows_written")
+        self.flush_ms = metrics.histogram("bag_buffer.flush_ms")
+        metrics.gauge("bag_buffer.pending", lambda: self._n_pending)
+
+    # ---------- Lifecycle ----------
+    def start(self) -> int:
+        """Write back what dead workers' logs hold, then start the flusher. Returns rows replayed."""
+        if fcntl is None:
+            raise RuntimeError("BAG_WRITE_BEHIND needs fcntl.flock to keep workers' logs apart")
+        self._lock_file = _locked(self.log_path + ".lock", wait=True)
+        replayed = self._replay_orphans()
+        self._log = open(self.log_path, "a", encoding="utf-8")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="bag-flusher", daemon=True)
+        self._thread.start()
+        return replayed
+
+    def stop(self) -> None:
+        """Stop the flusher and write everything still pending."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+        self.flush()
+        with self._lock:
+            self._log.close()
+            self._log = None
+            if not self._pending:
+                # Everything is written: nothing for a later worker to replay
+                os.remove(self.log_path)
+                os.remove(self.log_path + ".lock")
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                pass  # the changes went back to pending; the next round retries them
+
+    def _replay_orphans(self) -> int:
+        """Replay and remove every log whose worker no longer holds its lock."""
+        replayed = 0
+        for lock_path in glob.glob(glob.escape(self.base_path) + ".*.lock"):
+            if lock_path == self.log_path + ".lock":
+                continue
+            lock_file = _locked(lock_path, wait=False)
+            if lock_file is None:
+                continue  # its worker is running
+            with lock_file:
+                replayed += self._replay(lock_path[: -len(".lock")])
+                os.remove(lock_path)
+        # A log from before per-worker logs
+        return replayed + self._replay(self.base_path)
+
+    def _replay(self, log_path: str) -> int:
+        # The ".flushing" file is a rotated log whose flush never finished; it is older than the log
+        paths = [p for p in (log_path + ".flushing", log_path) if os.path.exists(p)]
+        wanted: Changes = {}
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        user_id, product_id, on = json.loads(line)
+                    except ValueError:
+                        continue  # cut short by the crash, so never acknowledged
+                    wanted.setdefault(user_id, {})[product_id] = bool(on)
+        if wanted:
+            self._write(wanted)
+        for path in paths:
+            os.remove(path)
+        return sum(map(len, wanted.values()))
+
+    # ---------- Reads and taps ----------
+    def _dirty(self, user_id: int) -> bool:
+        return user_id in self._pending or user_id in self._flushing
+
+    def _load(self, db: Session, user_id: int) -> Dict[str, None]:
+        with self._lock:
+            entry = self._bags.get(user_id)
+            if entry is not None and (self._dirty(user_id) or not self.ttl or time.monotonic() - entry[1] <= self.ttl):
+                self._bags.move_to_end(user_id)
+                return entry[0]
+        rows = db.execute(
+            select(BagItem.product_id).where(BagItem.user_id == user_id).order_by(BagItem.added_at, BagItem.product_id)
+        ).scalars().all()
+        with self._lock:
+            entry = self._bags.get(user_id)
+            if entry is not None and self._dirty(user_id):
+                return entry[0]  # tapped while we were reading; memory is ahead of what we read
+            ids = dict.fromkeys(rows)
+            self._bags[user_id] = (ids, time.monotonic())
+            # Forget the least recently used bags, never ones with unwritten changes
+            dirty = []
+            while self._bags and len(self._bags) + len(dirty) > self.max_users:
+                old, old_entry = self._bags.popitem(last=False)
+                if self._dirty(old):
+                    dirty.append((old, old_entry))
+            for old, old_entry in reversed(dirty):
+                self._bags[old] = old_entry
+                self._bags.move_to_end(old, last=False)
+            return ids
+
+    def ids(self, db: Session, user_id: int) -> List[str]:
+        ids = self._load(db, user_id)
+        with self._lock:
+            return list(ids)
+
+    def add(self, db: Session, user_id: int, ids: Iterable[str]) -> int:
+        """Put catalog products in the bag. Returns how many weren't there already."""
+        current = self._load(db, user_id)
+        new = [p for p in ids if p not in current]
+        if new:
+            known = set(db.execute(select(Item.id).where(Item.id.in_(new))).scalars())
+            new = [p for p in new if p in known]
+        return self._tap(user_id, current, new, True)
+
+    def remove(self, db: Session, user_id: int, ids: Iterable[str]) -> int:
+        """Take products out of the bag. Returns how many were in it."""
+        return self._tap(user_id, self._load(db, user_id), ids, False)
+
+    def _tap(self, user_id: int, current: Dict[str, None], ids: Iterable[str], on: bool) -> int:
+        changed = 0
+        with self._lock:
+            # Put the bag back if it was evicted between _load and here
+            self._bags.setdefault(user_id, (current, time.monotonic()))
+            pending = self._pending.setdefault(user_id, {})
+            stored = self._stored.setdefault(user_id, {})
+            for product_id in ids:
+                if (product_id in current) == on:
+                    continue
+                # Log first: a tap that reached memory is always in the log
+                self._append(user_id, product_id, on)
+                if on:
+                    current[product_id] = None
+                else:
+                    del current[product_id]
+                stored.setdefault(product_id, not on)
+                if stored[product_id] == on:
+                    # Back to what the table holds: nothing to write
+                    del pending[product_id], stored[product_id]
+                    self._n_pending -= 1
+                elif product_id not in pending:
+                    pending[product_id] = on
+                    self._n_pending += 1
+                changed += 1
+            if not pending:
+                del self._pending[user_id], self._stored[user_id]
+            if changed and self._log is not None:
+                self._log.flush()
+                if self.fsync:
+                    os.fsync(self._log.fileno())
+            if self._n_pending >= self.max_pending:
+                self._wake.set()
+        self.taps.inc(changed)
+        return changed
+
+    def _append(self, user_id: int, product_id: str, on: bool) -> None:
+        if self._log is not None:
+            self._log.write(json.dumps([user_id, product_id, int(on)]) + "\n")
+
+    def dirty(self, user_id: int) -> bool:
+        """Whether bag_items is behind this process for `user_id`."""
+        with self._lock:
+            return self._dirty(user_id)
+
+    # ---------- Flushing ----------
+    def flush(self) -> int:
+        """Write every pending change in one transaction. Returns rows written."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch, stored = self._pending, self._stored
+                self._pending, self._stored, self._n_pending = {}, {}, 0
+                self._flushing = set(batch)
+                rotated = self.log_path + ".flushing"
+                if self._log is not None:
+                    # New taps go to a fresh log while this batch is written
+                    self._log.close()
+                    os.replace(self.log_path, rotated)
+                    self._log = open(self.log_path, "a", encoding="utf-8")
+            start = time.perf_counter()
+            try:
+                written = self._write(batch)
+            except Exception:
+                self.flush_errors.inc()
+                self._requeue(batch, stored)
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = set()
+            if os.path.exists(rotated):
+                os.remove(rotated)
+            self.flushes.inc()
+            self.rows_written.inc(written)
+            self.flush_ms.observe((time.perf_counter() - start) * 1000)
+            return written
+
+    def _requeue(self, batch: Changes, stored: Changes) -> None:
+        """Put a failed batch back under the taps made since (those win) and back in the log."""
+        with self._lock:
+            for user_id, changes in batch.items():
+                pending = self._pending.setdefault(user_id, {})
+                now_stored = self._stored.setdefault(user_id, {})
+                for product_id, on in changes.items():
+                    was = stored[user_id][product_id]
+                    if product_id not in pending:
+                        pending[product_id] = on
+                        now_stored[product_id] = was
+                        self._n_pending += 1
+                        self._append(user_id, product_id, on)
+                    else:
+                        # The newer tap assumed this batch had landed; the table still holds `was`
+                        now_stored[product_id] = was
+                        if pending[product_id] == was:
+                            del pending[product_id], now_stored[product_id]
+                            self._n_pending -= 1
+                if not pending:
+                    del self._pending[user_id], self._stored[user_id]
+            if self._log is not None:
+                self._log.flush()
+                if self.fsync:
+                    os.fsync(self._log.fileno())
+
+    def _write(self, wanted: Changes) -> int:
+        with engine.begin() as conn:
+            for user_id, changes in wanted.items():
+                adds = [p for p, on in changes.items() if on]
+                removes = [p for p, on in changes.items() if not on]
+                if adds:
+                    conn.execute(bag.insert_statement(user_id, adds))
+                if removes:
+                    conn.execute(bag.delete_statement(user_id, removes))
+        return sum(map(len, wanted.values()))
+
+def _locked(path: str, wait: bool) -> TextIO | None:
+    """Open `path` (creating it) with an exclusive flock; None if another process holds it and not `wait`."""
+    while True:
+        f = open(path, "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return None
+        # Removed by whoever held it before us (a finished replay): lock the new file instead
+        if os.path.exists(path) and os.path.samestat(os.fstat(f.fileno()), os.stat(path)):
+            return f
+        f.close()
+        if not wait:
+            return None
+
+bag_buffer = BagBuffer(
+    log_path=settings.BAG_WRITE_BEHIND_LOG,
+    interval=settings.BAG_FLUSH_INTERVAL_SECONDS,
+    max_pending=settings.BAG_FLUSH_MAX_PENDING,
+    max_users=settings.BAG_WRITE_BEHIND_MAX_USERS,
+    ttl=settings.BAG_WRITE_BEHIND_TTL_SECONDS,
+    fsync=settings.BAG_WRITE_BEHIND_FSYNC,
+)
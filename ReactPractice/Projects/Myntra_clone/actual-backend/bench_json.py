@@ -0,0 +1,89 @@
+# bench_json.py
+# Time to turn an /items page into response bytes, per page size, on a scratch
+# SQLite catalog of items.json repeated up to --items rows:
+#   orm + jsonable_encoder   the old create/update path: ORM entities, a dict
+#                            comprehension per row, jsonable_encoder, json.dumps
+#   tuples + jsonable_encoder  fetch_page's column tuples, still through
+#                            jsonable_encoder and json.dumps (a plain dict return)
+#   tuples + JSONBody        fetch_page's column tuples, encoded once by fastjson
+# Each timing covers the query, the rows and the encoding.
+#
+#   python bench_json.py --items 20000 --sizes 24,200,1000
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+def time_calls(fn, runs: int) -> float:
+    """Median milliseconds per call after a short warm-up."""
+    for _ in range(min(3, runs)):
+        fn()
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark JSON encoding of catalog pages.")
+    ap.add_argument("--items", type=int, default=20_000, help="catalog size; also the last page size")
+    ap.add_argument("--sizes", default="24,200,1000", help="comma separated page sizes")
+    ap.add_argument("--rows", type=int, default=50_000, help="rows encoded per case and size (sets the run count)")
+    args = ap.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp.name, 'bench.db')}"
+
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from sqlalchemy import select
+
+    import fastjson
+    from catalog import ITEM_FIELDS, ALL_ITEMS, fetch_page
+    from db import JSON_PATH, Item, SessionLocal, engine, migrate
+    from fastjson import JSONBody
+    from feed import iter_items
+    from ingest import sync_items
+
+    migrate()
+    base = [it for it, _ in iter_items(JSON_PATH)]
+    items = [{**it, "id": f"{it['id']}-{n}"} for n in range(args.items // len(base) + 1) for it in base][:args.items]
+    with engine.begin() as conn:
+        sync_items(conn, items)
+
+    def orm(limit: int) -> bytes:
+        with SessionLocal() as db:
+            objs = db.execute(select(Item).order_by(Item.id).limit(limit)).scalars().all()
+            rows = [{c.name: getattr(o, c.name) for c in o.__table__.columns} for o in objs]
+        return JSONResponse(jsonable_encoder({"items": rows})).body
+
+    def tuples_encoder(limit: int) -> bytes:
+        with SessionLocal() as db:
+            return JSONResponse(jsonable_encoder(fetch_page(db, ITEM_FIELDS, None, limit, ALL_ITEMS))).body
+
+    def tuples_body(limit: int) -> bytes:
+        with SessionLocal() as db:
+            return JSONBody(fetch_page(db, ITEM_FIELDS, None, limit, ALL_ITEMS)).body
+
+    cases = {
+        "orm + jsonable_encoder": orm,
+        "tuples + jsonable_encoder": tuples_encoder,
+        "tuples + JSONBody": tuples_body,
+    }
+    sizes = [int(s) for s in args.sizes.split(",") if s] + [args.items]
+    print(f"{args.items} items, encoder: {'orjson' if fastjson.orjson is not None else 'stdlib json'}")
+    for size in sizes:
+        runs = max(3, args.rows // size)
+        print(f"page of {size} ({len(tuples_body(size)) / 1024:.0f} KiB), {runs} runs")
+        baseline = None
+        for name, fn in cases.items():
+            ms = time_calls(lambda: fn(size), runs)
+            baseline = baseline or ms
+            print(f"  {name:<26} {ms:9.3f} ms  {baseline / ms:5.1f}x")
+    tmp.cleanup()
+
+if __name__ == "__main__":
+    main()
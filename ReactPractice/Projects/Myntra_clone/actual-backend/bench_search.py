@@ -0,0 +1,76 @@
+# bench_search.py
+# Per-query overhead of the /search/items query layer against the configured database:
+# the old per-request items_fts reflection + statement build vs. search.py's
+# module-level table and cached statements.
+#
+#   python bench_search.py --q shirt --runs 2000
+
+import argparse
+import re
+import statistics
+import time
+
+from sqlalchemy import MetaData, Table, literal_column, select
+
+import search
+from db import Item, SessionLocal, engine
+
+def legacy_fts(db, q: str, limit: int):
+    """The pre-search.py SQLite path: reflect items_fts and rebuild the statement on every call."""
+    phrases = re.findall(r'"([^"]+)"', q)
+    unquoted = re.sub(r'"[^"]+"', " ", q)
+    tokens = re.findall(r"\w+", unquoted.lower())
+    match_expr = " ".join([*(f'"{p.strip()}"' for p in phrases if p.strip()), *(f"{t}*" for t in tokens)]) or q
+    items_fts = Table("items_fts", MetaData(), autoload_with=engine)
+    stmt = (
+        select(Item)
+        .select_from(items_fts.join(Item, Item.id == items_fts.c.id))
+        .where(literal_column("items_fts").op("MATCH")(match_expr))
+        .limit(limit)
+    )
+    return db.execute(stmt).scalars().all()
+
+def time_calls(fn, runs: int) -> tuple[float, float]:
+    """(median, p95) microseconds per call after a short warm-up."""
+    for _ in range(min(50, runs)):
+        fn()
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark search query overhead.")
+    ap.add_argument("--q", default="shirt", help="search text")
+    ap.add_argument("--limit", type=int, default=20)
+    ap.add_argument("--runs", type=int, default=2000)
+    args = ap.parse_args()
+
+    cases = {}
+    with SessionLocal() as db:
+        if engine.dialect.name == "sqlite":
+            cases["legacy fts (reflect per call)"] = lambda: legacy_fts(db, args.q, args.limit)
+            # Same single query as the legacy path, through the cached statement
+            _, page, _ = search._statements("fts5", "first")
+            params = {"q": search._fts5_match(args.q), "limit": args.limit}
+            cases["cached statement (page only)"] = lambda: db.execute(page, params).all()
+        # Full search call: hit count + ranked page
+        cases["search.py fts"] = lambda: search.search(db, args.q, args.limit)
+        first = search.search(db, args.q, args.limit)
+        if first["next_cursor"]:
+            cases["search.py fts, cursor page"] = lambda: search.search(db, args.q, args.limit, cursor=first["next_cursor"])
+        cases["search.py like"] = lambda: search.search(db, args.q, args.limit, mode="like")
+        cases["search.py fuzzy"] = lambda: search.search(db, args.q, args.limit, mode="fuzzy")
+        search.warm_memory_index(db)
+        cases["search.py memory"] = lambda: search.search(db, args.q, args.limit, mode="memory")
+
+        print(f"{engine.dialect.name}, q={args.q!r}, limit={args.limit}, {args.runs} runs")
+        for name, fn in cases.items():
+            median, p95 = time_calls(fn, args.runs)
+            print(f"  {name:<32} median {median:8.1f} us   p95 {p95:8.1f} us")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# bench_sqlite.py
+# Concurrent reads and bag writes against a scratch SQLite database, once per
+# connection profile: "default" (rollback journal, stock pragmas, one shared
+# pool, as before the SQLITE_* settings) and "tuned" (the SQLITE_* settings
+# from .env / the environment: WAL, pragmas, read pool + single writer).
+#
+# Readers alternate an /items page and a /search/items query; writers add and
+# remove bag rows. Each profile runs in its own interpreter on a fresh copy of
+# items.json repeated up to --items rows.
+#
+#   python bench_sqlite.py --readers 8 --writers 4 --seconds 10
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# The settings SQLite used before the SQLITE_* profile existed
+DEFAULT_PROFILE = {
+    "SQLITE_WAL": "false",
+    "SQLITE_SYNCHRONOUS": "FULL",
+    "SQLITE_CACHE_SIZE_MB": "2",
+    "SQLITE_MMAP_SIZE_MB": "0",
+    "SQLITE_READ_POOL_SIZE": "0",
+}
+QUERIES = ("shirt", "cotton", "women", "kurta", "shoes", "watch")
+
+def percentile(samples: list, pct: float) -> float:
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct))]
+
+def run_worker(args) -> dict:
+    """One profile: build the scratch database, then run the load and report counts and latencies."""
+    from sqlalchemy import insert
+    from sqlalchemy.exc import OperationalError
+
+    import bag
+    import search
+    from catalog import ITEM_FIELDS, ALL_ITEMS, fetch_page
+    from db import JSON_PATH, SessionLocal, User, engine, migrate
+    from feed import iter_items
+    from ingest import sync_items
+
+    migrate()
+    base = [it for it, _ in iter_items(JSON_PATH)]
+    items = [{**it, "id": f"{it['id']}-{n}"} for n in range(args.items // len(base) + 1) for it in base][:args.items]
+    with engine.begin() as conn:
+        sync_items(conn, items)
+        user_ids = [
+            conn.execute(insert(User).values(
+                username=f"bench{w}", email=f"bench{w}@example.com", password_hash="-", salt="-"
+            ).returning(User.id)).scalar()
+            for w in range(args.writers)
+        ]
+    product_ids = [it["id"] for it in items]
+
+    lock = threading.Lock()
+    stop = threading.Event()
+    stats = {"reads": [], "writes": [], "read_errors": 0, "write_errors": 0}
+
+    def reader(n: int):
+        rnd = random.Random(n)
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                with SessionLocal() as db:
+                    if rnd.random() < 0.5:
+                        fetch_page(db, ITEM_FIELDS, None, 24, ALL_ITEMS)
+                    else:
+                        search.search(db, rnd.choice(QUERIES), 20)
+            except OperationalError:
+                with lock:
+                    stats["read_errors"] += 1
+                continue
+            with lock:
+                stats["reads"].append(time.perf_counter() - start)
+
+    def writer(n: int):
+        rnd = random.Random(1000 + n)
+        while not stop.is_set():
+            ids = rnd.sample(product_ids, 3)
+            start = time.perf_counter()
+            try:
+                with SessionLocal() as db:
+                    bag.add(db, user_ids[n], ids)
+                    bag.remove(db, user_ids[n], ids)
+            except OperationalError:
+                with lock:
+                    stats["write_errors"] += 1
+                continue
+            with lock:
+                stats["writes"].append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=reader, args=(n,)) for n in range(args.readers)]
+    threads += [threading.Thread(target=writer, args=(n,)) for n in range(args.writers)]
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    return {
+        "reads_per_s": len(stats["reads"]) / args.seconds,
+        "writes_per_s": len(stats["writes"]) / args.seconds,
+        "read_p50_ms": percentile(stats["reads"], 0.50) * 1000,
+        "read_p95_ms": percentile(stats["reads"], 0.95) * 1000,
+        "write_p50_ms": percentile(stats["writes"], 0.50) * 1000,
+        "write_p95_ms": percentile(stats["writes"], 0.95) * 1000,
+        "read_errors": stats["read_errors"],
+        "write_errors": stats["write_errors"],
+    }
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark SQLite connection profiles under concurrent reads and writes.")
+    ap.add_argument("--readers", type=int, default=8)
+    ap.add_argument("--writers", type=int, default=4)
+    ap.add_argument("--seconds", type=float, default=10)
+    ap.add_argument("--items", type=int, default=20_000, help="catalog size")
+    ap.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args)))
+        return
+
+    print(f"{args.readers} readers, {args.writers} writers, {args.seconds:g}s, {args.items} items")
+    for name, profile in (("default", DEFAULT_PROFILE), ("tuned", {})):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = {
+                **os.environ, **profile,
+                "DATABASE_URL": f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+                # Room for every thread, so only SQLite's own locking is measured
+                "DB_POOL_SIZE": str(args.readers + args.writers),
+            }
+            out = subprocess.run(
+                [sys.executable, __file__, "--worker", *sys.argv[1:]],
+                env=env, check=True, capture_output=True, text=True,
+            ).stdout
+        r = json.loads(out.strip().splitlines()[-1])
+        print(
+            f"  {name:<8} reads {r['reads_per_s']:8.1f}/s  p50 {r['read_p50_ms']:7.2f} ms  p95 {r['read_p95_ms']:7.2f} ms"
+            f"  | writes {r['writes_per_s']:7.1f}/s  p50 {r['write_p50_ms']:7.2f} ms  p95 {r['write_p95_ms']:7.2f} ms"
+            f"  | errors {r['read_errors']} read, {r['write_errors']} write"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from typing import List, Optional
+from typing import List, Literal, Optional
 from pydantic_settings import BaseSettings
 from pydantic import field_validator
 import os
@@ -6,18 +6,129 @@ import os
 class Settings(BaseSettings):
     API_PREFIX: str = "/api"
     DEBUG: bool = False
+    # /metrics is served in DEBUG, otherwise only to requests sending this in X-Metrics-Token
+    METRICS_TOKEN: str = ""
 
     DATABASE_URL: Optional[str] = None
+    # Serve items, search, bag and auth from async endpoints on an asyncpg/aiosqlite engine
+    # (async_api.py), so slow clients hold a coroutine instead of a threadpool thread
+    DB_ASYNC: bool = False
+
+    # Connection pool, per engine and per worker (db_pool.py); the async engine gets its own
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT_SECONDS: float = 30
+    # Replace connections older than this (-1 = never), ahead of server/proxy idle cutoffs
+    DB_POOL_RECYCLE_SECONDS: int = 1800
+    # Liveness check on checkout: "always" (a round trip per checkout), "idle" (only for
+    # connections idle over DB_POOL_PING_IDLE_SECONDS) or "never"
+    DB_POOL_PRE_PING: Literal["always", "idle", "never"] = "idle"
+    DB_POOL_PING_IDLE_SECONDS: float = 30
+    # Cancel statements running longer than this (0 = no limit)
+    DB_STATEMENT_TIMEOUT_MS: int = 0
+    # Statements at least this slow are kept in <prefix>.slow_queries on /metrics (0 = off)
+    DB_SLOW_QUERY_MS: int = 200
+    DB_SLOW_QUERY_LOG_SIZE: int = 50
+    # Read replicas (replicas.py), comma separated: items listing, search, /bag/ids and /me
+    # read from one that is at most REPLICA_MAX_LAG_SECONDS behind, else from the primary
+    DATABASE_REPLICA_URLS: str = ""
+    REPLICA_MAX_LAG_SECONDS: float = 5
+    # How often the primary's heartbeat is written and each replica's lag measured (0 = never,
+    # so reads stay on the primary). Needs a long-running process.
+    REPLICA_HEARTBEAT_SECONDS: float = 1
     ALLOWED_ORIGINS: str = "" 
 
     # Security
+    # Target cost for new and upgraded password hashes (pick it with calibrate_kdf.py)
+    PASSWORD_SCHEME: Literal["pbkdf2_sha256", "scrypt"] = "pbkdf2_sha256"
     PBKDF2_ITERATIONS: int = 150_000
+    SCRYPT_N: int = 2 ** 14
+    SCRYPT_R: int = 8
+    SCRYPT_P: int = 1
+    # Cost of the bare-hex hashes stored before the self-describing format
+    LEGACY_PBKDF2_ITERATIONS: int = 150_000
     SECRET_KEY: str = "change-me"          
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 120
+    # Trust the signed username/email claims instead of reading users per request
+    AUTH_STATELESS: bool = False
+    AUTH_TOKEN_CACHE_SIZE: int = 10_000
+    AUTH_TOKEN_CACHE_TTL_SECONDS: int = 300
+    # Password hashing pool, kept apart from the request threadpool.
+    # MAX_PENDING counts running + queued hashes; past it /login and /register answer 503.
+    PASSWORD_POOL_KIND: Literal["thread", "process"] = "thread"
+    PASSWORD_POOL_WORKERS: int = 2
+    PASSWORD_POOL_MAX_PENDING: int = 32
+
+    # Catalog cache (per process; other workers' writes show up after the TTL)
+    CATALOG_CACHE_ENABLED: bool = True
+    CATALOG_CACHE_TTL_SECONDS: int = 60
+    CATALOG_CACHE_MAX_ENTRIES: int = 512
+    CATALOG_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    # HTTP caching of catalog GETs (http_cache.py): how long browsers and CDNs may reuse a
+    # body before revalidating (0 = every time; an unchanged catalog answers an empty 304)
+    CATALOG_HTTP_MAX_AGE_SECONDS: int = 0
+    # Response compression (compression.py); brotli needs the brotli package, else gzip
+    COMPRESS_MIN_BYTES: int = 1024
+    COMPRESS_GZIP_LEVEL: int = 6
+    COMPRESS_BROTLI_QUALITY: int = 4
+    # Compressed catalog bodies kept by ETag, so each one is compressed once
+    COMPRESS_CACHE_MAX_BYTES: int = 32 * 1024 * 1024
+    # Values listed per category/company facet on /items?facets=true
+    ITEMS_FACET_LIMIT: int = 50
+
+    # Products per POST/DELETE /bag/batch request
+    BAG_BATCH_MAX: int = 500
+    # Write-behind bag (bag_buffer.py): taps are answered from memory and written in one
+    # transaction every BAG_FLUSH_INTERVAL_SECONDS, or sooner past BAG_FLUSH_MAX_PENDING changes.
+    # Needs a long-running process and fcntl (not on Windows).
+    BAG_WRITE_BEHIND: bool = False
+    # Each worker logs to its own <BAG_WRITE_BEHIND_LOG>.<pid>-<id>, replayed by the next one if it dies
+    BAG_WRITE_BEHIND_LOG: str = "bag_writes.log"
+    BAG_WRITE_BEHIND_FSYNC: bool = True
+    BAG_FLUSH_INTERVAL_SECONDS: float = 2.0
+    BAG_FLUSH_MAX_PENDING: int = 1000
+    # Bags kept in memory, and how long one with nothing pending is trusted before a reread
+    BAG_WRITE_BEHIND_MAX_USERS: int = 10_000
+    BAG_WRITE_BEHIND_TTL_SECONDS: int = 60
+
+    # Search: hits are counted up to the cap ("gte" beyond); deeper pages need the cursor
+    SEARCH_TOTAL_HITS_CAP: int = 1000
+    SEARCH_MAX_OFFSET: int = 1000
+    # mode=memory and /search/suggest: in-process indexes, rebuilt after the TTL to pick up other workers' writes (0 = never)
+    SEARCH_INDEX_PRELOAD: bool = True  # build it at startup
+    SEARCH_INDEX_TTL_SECONDS: int = 300
+    # Vocabulary terms a query word may expand to as a prefix
+    SEARCH_INDEX_MAX_EXPANSIONS: int = 64
+    # /search/suggest: completions kept per trie node (the max limit) and trie depth in characters
+    SUGGEST_MAX_LIMIT: int = 10
+    SUGGEST_TRIE_DEPTH: int = 12
+
+    # Let a worker that finds an outdated schema migrate it; off = refuse to start until `python migrate.py`
+    AUTO_MIGRATE: bool = True
+
+    # Bulk seeding from items.json
+    SEED_BATCH_SIZE: int = 5000
+    # Drop and rebuild the search index once a reseed has changed this many rows
+    SEED_DEFER_SEARCH_INDEX: bool = True
+    SEED_DEFER_MIN_CHANGES: int = 5000
+    # Commit + checkpoint every N items so a crashed load can resume (0 = one transaction)
+    SEED_COMMIT_EVERY: int = 0
 
     # Local SQLite fallback
     DB_PATH: str = "items.db"
+    # SQLite connection profile (db.py). WAL lets reads run alongside a write; NORMAL sync
+    # under WAL only risks the last commits on power loss, not on a process crash
+    SQLITE_WAL: bool = True
+    SQLITE_SYNCHRONOUS: Literal["OFF", "NORMAL", "FULL"] = "NORMAL"
+    # How long a connection waits on another process's lock before "database is locked"
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    # Page cache and memory-mapped reads, per connection (0 = no mmap)
+    SQLITE_CACHE_SIZE_MB: int = 64
+    SQLITE_MMAP_SIZE_MB: int = 256
+    # Read-only connections next to a single write connection; sessions send SELECTs to
+    # them and writes to the writer (0 = one shared pool of DB_POOL_SIZE, no split)
+    SQLITE_READ_POOL_SIZE: int = 4
 
     def model_post_init(self, _ctx):
         if not self.DATABASE_URL:
@@ -34,6 +145,10 @@ class Settings(BaseSettings):
                 else:
                     self.DATABASE_URL = f"sqlite:///{self.DB_PATH}"
 
+    @property
+    def replica_urls(self) -> List[str]:
+        return [u.strip() for u in self.DATABASE_REPLICA_URLS.split(",") if u.strip()]
+
     @field_validator("ALLOWED_ORIGINS")
     @classmethod
     def parse_allowed_origins(cls, v: str) -> List[str]:
@@ -1,18 +1,30 @@
 from __future__ import annotations
 from pathlib import Path
-import json
-from typing import Mapping, Any
+from typing import Any, AsyncGenerator, List, Tuple
 
 from sqlalchemy import (
-    create_engine, text, String, Integer, Float, Text, TIMESTAMP
+    create_engine, event, text, inspect, insert, select, ForeignKey, Index, String, Integer, Float, Text, TIMESTAMP
 )
-from sqlalchemy.orm import sessionmaker, DeclarativeBase, Mapped, mapped_column
+from sqlalchemy.engine import URL, Connection, Engine, make_url
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker, DeclarativeBase, Mapped, Session, mapped_column
 from sqlalchemy.sql import func
 
 from config import settings
+import db_pool
+import facets
+from catalog_cache import catalog_cache
+from ingest import IngestStats, load_feed
 
 JSON_PATH = "items.json"
 
+# Lower-cased text the substring/fuzzy search runs over; pg_trgm indexes exactly this expression
+SEARCH_TEXT_SQL = (
+    "lower(coalesce(item_name,'') || ' ' || coalesce(company,'') || ' ' || "
+    "coalesce(category,'') || ' ' || coalesce(tags,''))"
+)
+
 class Base(DeclarativeBase):
     pass
 
@@ -34,6 +46,18 @@ class Item(Base):
     tags: Mapped[str | None] = mapped_column(Text)
     # Postgres FTS column (created in _postgres_setup)
 
+class ItemHash(Base):
+    # Content hash of each item as last written by the feed seeder
+    __tablename__ = "item_hashes"
+    id: Mapped[str] = mapped_column(String, primary_key=True)
+    content_hash: Mapped[str] = mapped_column(String(32), nullable=False)
+
+class SchemaVersion(Base):
+    # One row per applied migration; the startup check only reads max(version)
+    __tablename__ = "schema_version"
+    version: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    applied_at: Mapped[Any] = mapped_column(TIMESTAMP(timezone=True), server_default=func.now())
+
 class User(Base):
     __tablename__ = "users"
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
@@ -45,18 +69,156 @@ class User(Base):
 
 class BagItem(Base):
     __tablename__ = "bag_items"
-    email: Mapped[str] = mapped_column(String(320), primary_key=True)
-    product_id: Mapped[str] = mapped_column(String, primary_key=True)
+    # Keyed by the integer user id (the JWT sub); the primary key also serves per-user lookups
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    product_id: Mapped[str] = mapped_column(ForeignKey("items.id", ondelete="CASCADE"), primary_key=True)
     added_at: Mapped[Any] = mapped_column(TIMESTAMP(timezone=True), server_default=func.now())
+    # Lets deleting an item find the bag rows to cascade to
+    __table_args__ = (Index("idx_bag_product", "product_id"),)
+
+class ReplicaHeartbeat(Base):
+    # One row the primary stamps with the time; replicas.py reads it back from each replica to measure lag
+    __tablename__ = "replica_heartbeat"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    beat_at: Mapped[float] = mapped_column(Float, nullable=False)
+
+# Bag rows from before the user_id key, parked by migration 5 until backfill_bag.py moves them
+BAG_LEGACY_TABLE = "bag_items_legacy"
 
 # ---------- Engine & Session ----------
-engine = create_engine(
-    settings.DATABASE_URL,
-    future=True,
-    pool_pre_ping=True,
-    echo=False,
+_db_url = make_url(settings.DATABASE_URL)
+# File-backed SQLite splits reads from writes: one write connection, so concurrent writers queue
+# in the pool instead of failing on SQLite's file lock, and SQLITE_READ_POOL_SIZE read-only
+# connections that WAL lets run alongside it
+SQLITE_SPLIT = (
+    _db_url.get_backend_name() == "sqlite"
+    and _db_url.database not in (None, "", ":memory:")
+    and settings.SQLITE_READ_POOL_SIZE > 0
 )
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
+_WRITER_POOL = {"pool_size": 1, "max_overflow": 0} if SQLITE_SPLIT else {}
+_READER_POOL = {"pool_size": settings.SQLITE_READ_POOL_SIZE}
+
+def _engine(url: URL, prefix: str, is_async: bool = False, **pool: Any):
+    opts = {**db_pool.engine_options(url, prefix, is_async=is_async), **pool}
+    if is_async:
+        eng = create_async_engine(url, **opts)
+        db_pool.instrument(eng.sync_engine, prefix)
+    else:
+        eng = create_engine(url, future=True, echo=False, **opts)
+        db_pool.instrument(eng, prefix)
+    return eng
+
+def _async_url(url: URL) -> URL:
+    """DATABASE_URL with the asyncio driver: asyncpg for Postgres, aiosqlite for SQLite."""
+    if url.get_backend_name() == "sqlite":
+        return url.set(drivername="sqlite+aiosqlite")
+    query = dict(url.query)
+    # asyncpg spells libpq's sslmode as ssl
+    if "sslmode" in query:
+        query["ssl"] = query.pop("sslmode")
+    return url.set(drivername="postgresql+asyncpg", query=query)
+
+# engine takes every write (and is the only engine outside SQLITE_SPLIT); read_engine serves
+# the sessions' SELECTs and catalog streaming
+engine = _engine(_db_url, "db", **_WRITER_POOL)
+read_engine = _engine(_db_url, "db_read", **_READER_POOL) if SQLITE_SPLIT else engine
+
+# DB_ASYNC: the async endpoints (async_api.py) use these engines; scripts, migrations and the
+# remaining sync endpoints keep the sync ones
+async_engine = async_read_engine = None
+if settings.DB_ASYNC:
+    _url = _async_url(_db_url)
+    async_engine = _engine(_url, "db_async", is_async=True, **_WRITER_POOL)
+    async_read_engine = _engine(_url, "db_async_read", is_async=True, **_READER_POOL) if SQLITE_SPLIT else async_engine
+
+def _sqlite_profile(read_only: bool):
+    """connect hook applying foreign keys and the SQLITE_* pragmas to each new connection."""
+    pragmas = [
+        "foreign_keys = ON",  # SQLite only enforces foreign keys (and their cascades) when each connection asks
+        f"busy_timeout = {settings.SQLITE_BUSY_TIMEOUT_MS}",
+        f"synchronous = {settings.SQLITE_SYNCHRONOUS}",
+        f"cache_size = -{settings.SQLITE_CACHE_SIZE_MB * 1024}",  # negative = KiB rather than pages
+        f"mmap_size = {settings.SQLITE_MMAP_SIZE_MB * 1024 * 1024}",
+    ]
+    if read_only:
+        pragmas.append("query_only = ON")
+    elif settings.SQLITE_WAL:
+        pragmas.append("journal_mode = WAL")  # stored in the file, so readers follow it
+
+    def on_connect(dbapi_conn, _record):
+        cursor = dbapi_conn.cursor()
+        for pragma in pragmas:
+            cursor.execute(f"PRAGMA {pragma}")
+        cursor.close()
+        if SQLITE_SPLIT and not read_only:
+            # Leave BEGIN to _begin_immediate rather than the driver's deferred one
+            dbapi_conn.isolation_level = None
+    return on_connect
+
+def _begin_immediate(conn: Connection):
+    # A deferred transaction that reads and then writes gets SQLITE_BUSY at once if another
+    # process wrote in between; IMMEDIATE takes the lock up front and waits on busy_timeout
+    conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+if engine.dialect.name == "sqlite":
+    for writer, reader in ((engine, read_engine), (async_engine, async_read_engine)):
+        if writer is None:
+            continue
+        writer = getattr(writer, "sync_engine", writer)
+        event.listen(writer, "connect", _sqlite_profile(read_only=False))
+        if SQLITE_SPLIT:
+            event.listen(writer, "begin", _begin_immediate)
+            event.listen(getattr(reader, "sync_engine", reader), "connect", _sqlite_profile(read_only=True))
+
+def _forget_writes(session: Session, transaction) -> None:
+    if transaction.parent is None:
+        session.info.pop("wrote", None)
+
+def _routing_session(writer: Engine, reader: Engine) -> type[Session]:
+    class RoutingSession(Session):
+        """Session reading through `reader` and writing through `writer`.
+
+        Flushes and INSERT/UPDATE/DELETE statements go to the writer, and so does
+        the rest of the transaction after them, so it reads its own writes.
+        Writes in raw text() aren't recognised: run those on `engine`.
+        """
+        def get_bind(self, mapper=None, clause=None, **kw):
+            if self.info.get("wrote") or self._flushing or getattr(clause, "is_dml", False):
+                self.info["wrote"] = True
+                return writer
+            return reader
+
+    event.listen(RoutingSession, "after_transaction_end", _forget_writes)
+    return RoutingSession
+
+def replica_engines() -> List[Tuple[Engine, Any]]:
+    """(sync, async or None) engine pair per DATABASE_REPLICA_URLS entry; SQLite ones are query_only."""
+    pairs = []
+    for i, raw in enumerate(settings.replica_urls):
+        url = make_url(raw)
+        sync = _engine(url, f"db_replica{i}")
+        async_ = _engine(_async_url(url), f"db_async_replica{i}", is_async=True) if settings.DB_ASYNC else None
+        if url.get_backend_name() == "sqlite":
+            for eng in (sync, async_ and async_.sync_engine):
+                if eng is not None:
+                    event.listen(eng, "connect", _sqlite_profile(read_only=True))
+        pairs.append((sync, async_))
+    return pairs
+
+SessionLocal = sessionmaker(
+    bind=engine,
+    class_=_routing_session(engine, read_engine) if SQLITE_SPLIT else Session,
+    autoflush=False, autocommit=False, future=True,
+)
+AsyncSessionLocal = None
+if async_engine is not None:
+    AsyncSessionLocal = async_sessionmaker(
+        bind=async_engine,
+        sync_session_class=(
+            _routing_session(async_engine.sync_engine, async_read_engine.sync_engine) if SQLITE_SPLIT else Session
+        ),
+        autoflush=False, expire_on_commit=False,
+    )
 
 def get_session():
     db = SessionLocal()
@@ -65,6 +227,10 @@ def get_session():
     finally:
         db.close()
 
+async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
+    async with AsyncSessionLocal() as db:
+        yield db
+
 # ---------- Bootstrap helpers ----------
 def _sqlite_setup(conn):
     # FTS5 virtual table + triggers (idempotent)
@@ -113,47 +279,169 @@ def _postgres_setup(conn):
     conn.exec_driver_sql("""CREATE INDEX IF NOT EXISTS idx_items_company  ON items(company);""")
     conn.exec_driver_sql("""CREATE INDEX IF NOT EXISTS idx_items_itemname ON items(item_name);""")
 
-def _seed_from_json_if_present(conn):
-    path = Path(JSON_PATH)
-    if not path.exists():
+def _sqlite_trigram_setup(conn):
+    # Substring index: FTS5 trigram tokenizer (SQLite >= 3.34), same columns as items_fts
+    try:
+        conn.exec_driver_sql("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS items_trgm USING fts5(
+            id UNINDEXED, item_name, company, category, tags, tokenize='trigram'
+        );
+        """)
+    except OperationalError:
+        return  # no trigram tokenizer in this build; search falls back to LIKE scans
+    conn.exec_driver_sql("""
+    CREATE TRIGGER IF NOT EXISTS items_trgm_ai
+    AFTER INSERT ON items BEGIN
+        INSERT INTO items_trgm (id, item_name, company, category, tags)
+        VALUES (new.id, new.item_name, new.company, new.category, new.tags);
+    END;""")
+    conn.exec_driver_sql("""
+    CREATE TRIGGER IF NOT EXISTS items_trgm_ad
+    AFTER DELETE ON items BEGIN
+        DELETE FROM items_trgm WHERE id = old.id;
+    END;""")
+    conn.exec_driver_sql("""
+    CREATE TRIGGER IF NOT EXISTS items_trgm_au
+    AFTER UPDATE ON items BEGIN
+        UPDATE items_trgm
+        SET item_name = new.item_name, company = new.company,
+            category = new.category, tags = new.tags
+        WHERE id = old.id;
+    END;""")
+    conn.exec_driver_sql("DELETE FROM items_trgm")
+    conn.exec_driver_sql("""
+    INSERT INTO items_trgm (id, item_name, company, category, tags)
+    SELECT id, item_name, company, category, tags FROM items;""")
+
+def _postgres_trigram_setup(conn):
+    # pg_trgm may not be installable (managed databases, missing contrib); search then scans
+    try:
+        with conn.begin_nested():
+            conn.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except DBAPIError:
         return
-    data = json.loads(path.read_text(encoding="utf-8"))
-    items = data["items"][0]
-
-    upsert_sql = text("""
-    INSERT INTO items (id,image,company,item_name,original_price,current_price,discount_percentage,
-                       return_period,delivery_date,rating_stars,rating_count,category,tags)
-    VALUES (:id,:image,:company,:item_name,:original_price,:current_price,:discount_percentage,
-            :return_period,:delivery_date,:rating_stars,:rating_count,:category,:tags)
-    ON CONFLICT(id) DO UPDATE SET
-        image=excluded.image, company=excluded.company, item_name=excluded.item_name,
-        original_price=excluded.original_price, current_price=excluded.current_price,
-        discount_percentage=excluded.discount_percentage, return_period=excluded.return_period,
-        delivery_date=excluded.delivery_date, rating_stars=excluded.rating_stars,
-        rating_count=excluded.rating_count, category=excluded.category, tags=excluded.tags
-    """)
+    conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS idx_items_trgm ON items USING GIN (({SEARCH_TEXT_SQL}) gin_trgm_ops)")
 
-    def norm(it: Mapping[str, Any]) -> Mapping[str, Any]:
-        r = it.get("rating") or {}
-        return dict(
-            id=it["id"], image=it.get("image"), company=it.get("company"),
-            item_name=it.get("item_name"), original_price=it.get("original_price"),
-            current_price=it.get("current_price"), discount_percentage=it.get("discount_percentage"),
-            return_period=it.get("return_period"), delivery_date=it.get("delivery_date"),
-            rating_stars=r.get("stars"), rating_count=r.get("count"),
-            category=it.get("category"), tags=it.get("tags"),
-        )
+# /items filters and sorts: (name, key columns, carried columns). Each leads with what a
+# listing filters or sorts on and carries the other facet columns, so facet counts and
+# keyset ordering come from the index alone (INCLUDE on Postgres, trailing keys on SQLite)
+_LISTING_INDEXES = (
+    ("idx_items_category_price", "category, current_price, id", "company, discount_percentage, rating_stars"),
+    ("idx_items_company_price", "company, current_price, id", "category, discount_percentage, rating_stars"),
+    ("idx_items_price", "current_price, id", ""),
+    ("idx_items_discount", "discount_percentage, id", ""),
+    ("idx_items_rating", "rating_stars, id", ""),
+)
+
+def _listing_indexes_setup(conn):
+    pg = conn.dialect.name == "postgresql"
+    for name, keys, carried in _LISTING_INDEXES:
+        if not carried:
+            cols = f"({keys})"
+        else:
+            cols = f"({keys}) INCLUDE ({carried})" if pg else f"({keys}, {carried})"
+        conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {name} ON items {cols}")
+    # Prefixes of the composites above
+    conn.exec_driver_sql("DROP INDEX IF EXISTS idx_items_category")
+    conn.exec_driver_sql("DROP INDEX IF EXISTS idx_items_company")
+
+def _migrate_v1(conn: Connection):
+    if conn.dialect.name == "sqlite":
+        _sqlite_setup(conn)
+    else:
+        _postgres_setup(conn)
 
-    for it in items:
-        conn.execute(upsert_sql, norm(it))
+def _migrate_v2(conn: Connection):
+    if conn.dialect.name == "sqlite":
+        _sqlite_trigram_setup(conn)
+    else:
+        _postgres_trigram_setup(conn)
 
-def init_db(seed_from_json: bool = True):
-    # Base tables
-    Base.metadata.create_all(bind=engine)
+def _migrate_v3(conn: Connection):
+    _listing_indexes_setup(conn)
+
+def _migrate_v4(conn: Connection):
+    # Trigger-maintained facet counts (facets.py)
+    facets.setup(conn)
+
+def _migrate_v5(conn: Connection):
+    # bag_items goes from (email, product_id) to (user_id, product_id). Only DDL here: existing
+    # rows are parked in BAG_LEGACY_TABLE and moved in batches by backfill_bag.py
+    if "email" not in {c["name"] for c in inspect(conn).get_columns("bag_items")}:
+        return
+    # idx_bag_email only repeated the primary key's leading column
+    conn.exec_driver_sql("DROP INDEX IF EXISTS idx_bag_email")
+    conn.exec_driver_sql("DROP INDEX IF EXISTS idx_bag_product")
+    conn.exec_driver_sql(f"ALTER TABLE bag_items RENAME TO {BAG_LEGACY_TABLE}")
+    if conn.dialect.name == "postgresql":
+        # The primary key index keeps its name across the rename and would clash with the new table's
+        conn.exec_driver_sql(f"ALTER INDEX IF EXISTS bag_items_pkey RENAME TO {BAG_LEGACY_TABLE}_pkey")
+    BagItem.__table__.create(conn)
+
+def _migrate_v6(conn: Connection):
+    # The heartbeat row replicas.py updates (create_all made the table)
+    conn.execute(insert(ReplicaHeartbeat).values(id=1, beat_at=0))
+
+# ---------- Migrations ----------
+# Every schema change gets the next number here; migrate.py applies the missing ones in order
+MIGRATIONS = {
+    1: _migrate_v1,
+    2: _migrate_v2,
+    3: _migrate_v3,
+    4: _migrate_v4,
+    5: _migrate_v5,
+    6: _migrate_v6,
+}
+SCHEMA_VERSION = max(MIGRATIONS)
+_MIGRATION_LOCK_KEY = 0x6D79_6E74  # pg advisory lock shared by all migrators
+
+def current_schema_version(conn: Connection) -> int:
+    if not inspect(conn).has_table(SchemaVersion.__tablename__):
+        return 0
+    return conn.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+
+def migrate() -> int:
+    """Create tables and bring the schema up to SCHEMA_VERSION.
+
+    On Postgres concurrent runs serialize on an advisory lock and the later
+    ones find nothing left to do.
+    """
     with engine.begin() as conn:
-        if engine.dialect.name == "sqlite":
-            _sqlite_setup(conn)
-        else:
-            _postgres_setup(conn)
-        if seed_from_json:
-            _seed_from_json_if_present(conn)
+        if conn.dialect.name == "postgresql":
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _MIGRATION_LOCK_KEY})
+        Base.metadata.create_all(bind=conn)
+        current = current_schema_version(conn)
+        for version in sorted(v for v in MIGRATIONS if v > current):
+            MIGRATIONS[version](conn)
+            conn.execute(insert(SchemaVersion).values(version=version))
+    return SCHEMA_VERSION
+
+def seed_items_from_json(commit_every: int | None = None, full: bool = False) -> IngestStats | None:
+    """Sync items with items.json (only changed rows are written)."""
+    path = Path(JSON_PATH)
+    if not path.exists():
+        return None
+    stats = load_feed(engine, path, commit_every=commit_every, full=full)
+    # Drop cached /items and /search responses built from the old rows
+    catalog_cache.invalidate()
+    return stats
+
+def init_db(seed_from_json: bool = True) -> IngestStats | None:
+    """Full bootstrap: migrate, then optionally seed. Run by `python migrate.py`, not per worker."""
+    migrate()
+    if seed_from_json:
+        return seed_items_from_json()
+    return None
+
+def ensure_schema():
+    """Startup check: a single version lookup once the database has been migrated."""
+    with engine.connect() as conn:
+        current = current_schema_version(conn)
+    if current >= SCHEMA_VERSION:
+        return
+    if not settings.AUTO_MIGRATE:
+        raise RuntimeError(
+            f"database schema is at version {current}, this build needs {SCHEMA_VERSION}: run `python migrate.py`"
+        )
+    # First boot of a dev database: bootstrap and seed it like `python migrate.py --seed`
+    init_db(seed_from_json=True)
@@ -0,0 +1,35 @@
+"""JSON bodies for the catalog endpoints: orjson when it is installed, the stdlib otherwise.
+
+An endpoint that returns a dict goes through FastAPI's jsonable_encoder (a
+recursive copy of the whole payload, run on the event loop even for sync
+endpoints) and then json.dumps. Item payloads are already plain JSON types:
+column tuples zipped with their names. Returning JSONBody(payload) skips the
+copy and encodes once.
+"""
+from __future__ import annotations
+import datetime, json
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # the stdlib encoder below is used instead
+    orjson = None
+
+def _default(value: Any) -> Any:
+    # The only non-JSON types item and bag rows carry (e.g. bag_items.added_at)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def dumps(payload: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False, default=_default).encode()
+
+class JSONBody(JSONResponse):
+    """JSONResponse encoded with dumps(); the payload is sent as is, without jsonable_encoder."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
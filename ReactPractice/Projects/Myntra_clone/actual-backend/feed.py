@@ -0,0 +1,171 @@
+"""Incremental reader for item feeds.
+
+Accepts both shapes the seeders have used, `{"items": [{...}, ...]}` and
+`{"items": [[{...}, ...], ...]}` (inner arrays are flattened), and yields one
+item at a time so memory stays at roughly one read chunk plus one item no
+matter how large the file is.
+
+`item_hash` gives the content hash the seeders use to skip unchanged items.
+
+Every item comes with the byte offset just past it. Passing that offset back
+as `offset=` resumes after that item; `read_checkpoint`/`write_checkpoint`
+keep it in a small file next to the feed.
+"""
+from __future__ import annotations
+import codecs, hashlib, json, os
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, Tuple
+
+CHUNK_SIZE = 1 << 16
+_WS = " \t\r\n"
+_decoder = json.JSONDecoder()
+
+class FeedError(ValueError):
+    pass
+
+class _Reader:
+    """Decoded text window over a binary file; `offset` is the byte offset of buf[pos]."""
+
+    def __init__(self, f: BinaryIO, chunk_size: int, offset: int = 0):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.offset = offset
+        self.eof = False
+
+    def fill(self) -> None:
+        data = self.f.read(self.chunk_size)
+        # Drop what has been consumed so the window never holds more than one item
+        self.buf = self.buf[self.pos:] + self.decoder.decode(data, final=not data)
+        self.pos = 0
+        self.eof = not data
+
+    def advance(self, end: int) -> None:
+        self.offset += len(self.buf[self.pos:end].encode("utf-8"))
+        self.pos = end
+
+    def peek(self) -> str:
+        """Skip whitespace and return the next character, or '' at end of file."""
+        while True:
+            i, n = self.pos, len(self.buf)
+            while i < n and self.buf[i] in _WS:
+                i += 1
+            self.offset += i - self.pos
+            self.pos = i
+            if i < n:
+                return self.buf[i]
+            if self.eof:
+                return ""
+            self.fill()
+
+    def expect(self, ch: str) -> None:
+        if self.peek() != ch:
+            raise FeedError(f"expected {ch!r} at byte {self.offset}")
+        self.advance(self.pos + 1)
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError as e:
+                if self.eof:
+                    raise FeedError(f"invalid JSON at byte {self.offset}: {e.msg}") from None
+            else:
+                # A number cut at the chunk edge would parse short; wait for what follows it
+                if end < len(self.buf) or self.eof:
+                    self.advance(end)
+                    return obj
+            self.fill()
+
+def _open_items(r: _Reader) -> bool:
+    """Consume the document up to the inside of the "items" array; True if it holds arrays."""
+    r.expect("{")
+    while True:
+        if r.peek() == "}":
+            raise FeedError('feed has no "items" array')
+        key = r.value()
+        r.expect(":")
+        if key == "items":
+            break
+        r.value()
+        if r.peek() == ",":
+            r.advance(r.pos + 1)
+    r.expect("[")
+    return r.peek() == "["
+
+def _elements(r: _Reader, resumed: bool) -> Iterator[Tuple[Dict[str, Any], int]]:
+    """Yield the items of the array `r` is inside of, through its closing bracket."""
+    first = not resumed
+    while True:
+        c = r.peek()
+        if c == "]":
+            r.advance(r.pos + 1)
+            return
+        if not first:
+            if c != ",":
+                raise FeedError(f"expected ',' or ']' at byte {r.offset}")
+            r.advance(r.pos + 1)
+        first = False
+        item = r.value()
+        if not isinstance(item, dict):
+            raise FeedError(f"feed item ending at byte {r.offset} is not an object")
+        yield item, r.offset
+
+def iter_items(path: str | os.PathLike, offset: int = 0, chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple[Dict[str, Any], int]]:
+    """Yield `(item, offset)` pairs; `offset` is where a later run can resume after `item`."""
+    with open(path, "rb") as f:
+        r = _Reader(f, chunk_size)
+        nested = _open_items(r)
+        resumed = offset > 0
+        if resumed:
+            # The header told us the shape; jump to just after the last item we were given
+            f.seek(offset)
+            r = _Reader(f, chunk_size, offset)
+        if not nested:
+            yield from _elements(r, resumed)
+            return
+        if resumed:
+            yield from _elements(r, True)
+        first = not resumed
+        while True:
+            c = r.peek()
+            if c == "]":
+                return
+            if not first:
+                r.expect(",")
+            first = False
+            r.expect("[")
+            yield from _elements(r, False)
+
+def item_hash(item: Dict[str, Any]) -> str:
+    """Content hash of one feed item, independent of key order and whitespace."""
+    canonical = json.dumps(item, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+# ---------- Checkpoints ----------
+def _checkpoint_path(path: str | os.PathLike) -> Path:
+    return Path(f"{os.fspath(path)}.offset")
+
+def read_checkpoint(path: str | os.PathLike) -> int:
+    """Saved resume offset for `path`, or 0 if there is none or the feed was replaced since."""
+    try:
+        saved = json.loads(_checkpoint_path(path).read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return 0
+    st = os.stat(path)
+    if saved.get("size") != st.st_size or saved.get("mtime_ns") != st.st_mtime_ns:
+        return 0
+    return int(saved.get("offset", 0))
+
+def write_checkpoint(path: str | os.PathLike, offset: int) -> None:
+    st = os.stat(path)
+    ck = _checkpoint_path(path)
+    tmp = ck.with_name(ck.name + ".tmp")
+    tmp.write_text(json.dumps({"offset": offset, "size": st.st_size, "mtime_ns": st.st_mtime_ns}), encoding="utf-8")
+    os.replace(tmp, ck)
+
+def clear_checkpoint(path: str | os.PathLike) -> None:
+    _checkpoint_path(path).unlink(missing_ok=True)
@@ -1,24 +1,83 @@
 from __future__ import annotations
-import hashlib, secrets, hmac, base64, json
+import hashlib, secrets, hmac, base64, json, threading, time
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict
+from typing import Any, Callable, Dict
 
 from fastapi import HTTPException, Header, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sqlalchemy import select
+from sqlalchemy import select, update
+from starlette.concurrency import run_in_threadpool
 
 from config import settings
-from db import User, get_session
+from db import User, SessionLocal, AsyncSessionLocal, get_session, get_async_session
+from replicas import get_read_session, get_async_read_session
+import passwords
+from password_pool import password_pool
 
 # ---------- Password hashing ----------
+# Hashes are stored self-describing (see passwords.py); the salt column keeps a copy of the salt.
+def _target() -> tuple[str, Dict[str, int]]:
+    if settings.PASSWORD_SCHEME == "scrypt":
+        return "scrypt", {"n": settings.SCRYPT_N, "r": settings.SCRYPT_R, "p": settings.SCRYPT_P}
+    return "pbkdf2_sha256", {"i": settings.PBKDF2_ITERATIONS}
+
+def _parse(stored_hash: str, salt_hex: str) -> passwords.ParsedHash | None:
+    try:
+        return passwords.parse(stored_hash, salt_hex, settings.LEGACY_PBKDF2_ITERATIONS)
+    except ValueError:
+        return None  # a corrupt or foreign hash never matches: the login fails as a wrong password
+
 def hash_password(password: str, salt_hex: str | None = None) -> tuple[str, str]:
-    salt = bytes.fromhex(salt_hex) if salt_hex else secrets.token_bytes(16)
-    dk = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, settings.PBKDF2_ITERATIONS)
-    return dk.hex(), salt.hex()
+    scheme, params = _target()
+    salt_hex = salt_hex or secrets.token_bytes(16).hex()
+    digest = passwords.derive(scheme, params, password, salt_hex)
+    return passwords.encode(scheme, params, salt_hex, digest), salt_hex
+
+def verify_password(password: str, stored_hash: str, salt_hex: str) -> bool:
+    p = _parse(stored_hash, salt_hex)
+    if p is None:
+        return False
+    return secrets.compare_digest(passwords.derive(p.scheme, p.params, password, p.salt_hex), p.digest_hex)
+
+def needs_rehash(stored_hash: str, salt_hex: str) -> bool:
+    """True when the stored hash uses another scheme or cost than the configured target."""
+    p = _parse(stored_hash, salt_hex)
+    return p is not None and passwords.needs_rehash(p, *_target())
+
+# Request handlers use these: the KDF runs on the bounded password pool, not the shared threadpool
+async def hash_password_async(password: str, salt_hex: str | None = None) -> tuple[str, str]:
+    scheme, params = _target()
+    salt_hex = salt_hex or secrets.token_bytes(16).hex()
+    digest = await password_pool.run(passwords.derive, scheme, params, password, salt_hex)
+    return passwords.encode(scheme, params, salt_hex, digest), salt_hex
 
-def verify_password(password: str, stored_hash_hex: str, salt_hex: str) -> bool:
-    calc, _ = hash_password(password, salt_hex)
-    return secrets.compare_digest(calc, stored_hash_hex)
+async def verify_password_async(password: str, stored_hash: str, salt_hex: str) -> bool:
+    p = _parse(stored_hash, salt_hex)
+    if p is None:
+        return False
+    digest = await password_pool.run(passwords.derive, p.scheme, p.params, password, p.salt_hex)
+    return secrets.compare_digest(digest, p.digest_hex)
+
+async def rehash_password(user_id: int, password: str, old_hash: str) -> None:
+    """Background task after a good login: move the user's hash to the current target cost."""
+    try:
+        new_hash, salt_hex = await hash_password_async(password)
+    except HTTPException:
+        return  # pool is saturated; the next login will try again
+
+    def store():
+        with SessionLocal() as db:
+            # Compare-and-set so a concurrent password change is never overwritten
+            db.execute(
+                update(User)
+                .where(User.id == user_id, User.password_hash == old_hash)
+                .values(password_hash=new_hash, salt=salt_hex)
+            )
+            db.commit()
+
+    await run_in_threadpool(store)
 
 # ---------- Minimal JWT (HS256) ----------
 def _b64url(b: bytes) -> str:
@@ -39,30 +98,145 @@ def create_access_token(sub: str, extra: Dict[str, Any] | None = None) -> str:
     sig = hmac.new(settings.SECRET_KEY.encode(), f"{head}.{body}".encode(), hashlib.sha256).digest()
     return f"{head}.{body}.{_b64url(sig)}"
 
-def get_current_user(
-    authorization: str = Header(None),
-    db: Session = Depends(get_session)
-) -> Dict[str, Any]:
+# ---------- Verified token cache ----------
+class _TokenCache:
+    """Bounded LRU of verified token -> claims; entries live for min(ttl, token exp)."""
+
+    def __init__(self, maxsize: int, ttl: int):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, Dict[str, Any]]] = OrderedDict()
+
+    def get(self, token: str) -> Dict[str, Any] | None:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return entry[1]
+
+    def put(self, token: str, claims: Dict[str, Any]) -> None:
+        if self.maxsize <= 0:
+            return
+        expires_at = min(time.time() + self.ttl, float(claims["exp"]))
+        with self._lock:
+            self._entries[token] = (expires_at, claims)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+_token_cache = _TokenCache(settings.AUTH_TOKEN_CACHE_SIZE, settings.AUTH_TOKEN_CACHE_TTL_SECONDS)
+_revocation_check: Callable[[Dict[str, Any]], bool] | None = None
+
+def set_revocation_check(check: Callable[[Dict[str, Any]], bool] | None) -> None:
+    """Install a denylist hook; it gets the token claims and returns True to reject them.
+
+    The hook runs on every authenticated request, cached tokens included, so it
+    must be cheap (an in-memory set of revoked `sub`/`iat` pairs, for example).
+    """
+    global _revocation_check
+    _revocation_check = check
+
+def _decode_token(token: str) -> Dict[str, Any]:
+    header_b64, payload_b64, sig_b64 = token.split(".")
+    signing_input = f"{header_b64}.{payload_b64}".encode()
+    sig = base64.urlsafe_b64decode(sig_b64 + "==")
+    expected = hmac.new(settings.SECRET_KEY.encode(), signing_input, hashlib.sha256).digest()
+    if not hmac.compare_digest(sig, expected):
+        raise ValueError("bad signature")
+    payload = json.loads(base64.urlsafe_b64decode(payload_b64 + "==").decode())
+    if int(payload["exp"]) < int(datetime.now(timezone.utc).timestamp()):
+        raise ValueError("expired")
+    int(payload["sub"])
+    return payload
+
+def _bearer_claims(authorization: str | None) -> Dict[str, Any]:
     if not authorization or not authorization.lower().startswith("bearer "):
         raise HTTPException(status_code=401, detail="missing bearer token")
     token = authorization.split(" ", 1)[1]
-    try:
-        header_b64, payload_b64, sig_b64 = token.split(".")
-        signing_input = f"{header_b64}.{payload_b64}".encode()
-        sig = base64.urlsafe_b64decode(sig_b64 + "==")
-        expected = hmac.new(settings.SECRET_KEY.encode(), signing_input, hashlib.sha256).digest()
-        if not hmac.compare_digest(sig, expected):
-            raise ValueError("bad signature")
-        payload = json.loads(base64.urlsafe_b64decode(payload_b64 + "==").decode())
-        if int(payload["exp"]) < int(datetime.now(timezone.utc).timestamp()):
-            raise ValueError("expired")
-        user_id = int(payload["sub"])
-    except Exception:
-        raise HTTPException(status_code=401, detail="invalid token")
+    claims = _token_cache.get(token)
+    if claims is None:
+        try:
+            claims = _decode_token(token)
+        except Exception:
+            raise HTTPException(status_code=401, detail="invalid token")
+        _token_cache.put(token, claims)
+    if _revocation_check is not None and _revocation_check(claims):
+        raise HTTPException(status_code=401, detail="token revoked")
+    return claims
 
+def _load_user(db: Session, user_id: int) -> Dict[str, Any]:
     row = db.execute(
         select(User.id, User.username, User.email).where(User.id == user_id)
     ).mappings().first()
     if not row:
         raise HTTPException(status_code=401, detail="user not found")
     return {"id": row["id"], "username": row["username"], "email": row["email"]}
+
+def _user_from_db(
+    authorization: str = Header(None),
+    db: Session = Depends(get_session)
+) -> Dict[str, Any]:
+    claims = _bearer_claims(authorization)
+    return _load_user(db, int(claims["sub"]))
+
+def _user_from_claims(authorization: str = Header(None)) -> Dict[str, Any]:
+    # The signature already vouches for these claims, so no session is checked out
+    claims = _bearer_claims(authorization)
+    if "username" in claims and "email" in claims:
+        return {"id": int(claims["sub"]), "username": claims["username"], "email": claims["email"]}
+    # Tokens minted without profile claims still need the lookup
+    with SessionLocal() as db:
+        return _load_user(db, int(claims["sub"]))
+
+# AUTH_STATELESS trusts the signed claims until the token expires: deleted or
+# renamed users keep their old identity until then unless a revocation hook says otherwise.
+get_current_user = _user_from_claims if settings.AUTH_STATELESS else _user_from_db
+
+# Same, for the async endpoints (DB_ASYNC)
+async def _user_from_db_async(
+    authorization: str = Header(None),
+    db: AsyncSession = Depends(get_async_session)
+) -> Dict[str, Any]:
+    claims = _bearer_claims(authorization)
+    return await db.run_sync(_load_user, int(claims["sub"]))
+
+async def _user_from_claims_async(authorization: str = Header(None)) -> Dict[str, Any]:
+    claims = _bearer_claims(authorization)
+    if "username" in claims and "email" in claims:
+        return {"id": int(claims["sub"]), "username": claims["username"], "email": claims["email"]}
+    async with AsyncSessionLocal() as db:
+        return await db.run_sync(_load_user, int(claims["sub"]))
+
+get_current_user_async = _user_from_claims_async if settings.AUTH_STATELESS else _user_from_db_async
+
+# Read-only endpoints (/me, /bag/ids) look the user up on a replica (replicas.py), and on the
+# primary when the replica doesn't have them yet (registered within the replica's lag)
+def _user_from_replica(
+    authorization: str = Header(None),
+    db: Session = Depends(get_read_session)
+) -> Dict[str, Any]:
+    user_id = int(_bearer_claims(authorization)["sub"])
+    try:
+        return _load_user(db, user_id)
+    except HTTPException:
+        with SessionLocal() as primary:
+            return _load_user(primary, user_id)
+
+async def _user_from_replica_async(
+    authorization: str = Header(None),
+    db: AsyncSession = Depends(get_async_read_session)
+) -> Dict[str, Any]:
+    user_id = int(_bearer_claims(authorization)["sub"])
+    try:
+        return await db.run_sync(_load_user, user_id)
+    except HTTPException:
+        async with AsyncSessionLocal() as primary:
+            return await primary.run_sync(_load_user, user_id)
+
+get_current_user_read = _user_from_claims if settings.AUTH_STATELESS else _user_from_replica
+get_current_user_read_async = _user_from_claims_async if settings.AUTH_STATELESS else _user_from_replica_async
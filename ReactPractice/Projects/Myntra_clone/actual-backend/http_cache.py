@@ -0,0 +1,100 @@
+"""ETag, Last-Modified and Cache-Control for catalog GETs, and 304s that skip the query.
+
+A catalog response's ETag is a hash of its URL and catalog_cache.validators()'s
+version token, which every item write in this process bumps. Both are known
+before the endpoint runs, so a request whose If-None-Match (or, without one,
+If-Modified-Since) still holds is answered 304 here, without a session or a
+query. Other workers' writes change the token when the catalog cache's TTL
+window rolls over, the same delay their cached bodies already have.
+
+compression.py adds a -gzip / -br suffix to the ETag of a compressed body; the
+comparison here ignores it (If-None-Match compares weakly).
+"""
+from __future__ import annotations
+import hashlib
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Iterable
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import metrics
+from catalog_cache import catalog_cache
+
+# compression.py's ETag suffixes, one per content coding
+CODING_SUFFIXES = ("-gzip", "-br")
+
+def etag_for(scope: Scope, token: str) -> str:
+    url = scope["path"].encode() + b"?" + scope["query_string"]
+    return '"' + hashlib.blake2b(token.encode() + b" " + url, digest_size=12).hexdigest() + '"'
+
+def _opaque(tag: str) -> str:
+    # W/"x", "x-gzip" and "x-br" all compare equal to "x"
+    tag = tag[2:] if tag.startswith("W/") else tag
+    for suffix in CODING_SUFFIXES:
+        if tag.endswith(suffix + '"'):
+            return tag[: -len(suffix) - 1] + '"'
+    return tag
+
+def matching_tag(if_none_match: str, etag: str) -> str | None:
+    """The If-None-Match entry that matches `etag` (as the client sent it), else None."""
+    for tag in (t.strip() for t in if_none_match.split(",")):
+        if tag == "*":
+            return etag
+        if _opaque(tag) == etag:
+            return tag
+    return None
+
+def _unmodified_since(if_modified_since: str, last_modified: float) -> bool:
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False  # unparseable dates are ignored
+    return int(last_modified) <= since
+
+class ConditionalGetMiddleware:
+    """Adds validators to 200 responses under `paths` and answers matching conditional GETs with 304."""
+
+    def __init__(self, app: ASGIApp, paths: Iterable[str], max_age: int = 0):
+        self.app = app
+        self.paths = tuple(paths)
+        # max-age=0 still lets browsers and CDNs store the body; they revalidate every time
+        self.cache_control = f"public, max-age={max_age}" if max_age else "public, no-cache"
+        self.not_modified = metrics.counter("http_cache.not_modified")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] != "GET" or not scope["path"].startswith(self.paths):
+            await self.app(scope, receive, send)
+            return
+        token, last_modified = catalog_cache.validators()
+        etag = etag_for(scope, token)
+        validators = {
+            "ETag": etag,
+            "Last-Modified": formatdate(last_modified, usegmt=True),
+            "Cache-Control": self.cache_control,
+        }
+
+        request = Headers(scope=scope)
+        if_none_match = request.get("if-none-match")
+        if if_none_match is not None:
+            matched = matching_tag(if_none_match, etag)
+        elif request.get("if-modified-since") and _unmodified_since(request["if-modified-since"], last_modified):
+            matched = etag
+        else:
+            matched = None
+        if matched is not None:
+            self.not_modified.inc()
+            headers = MutableHeaders({**validators, "ETag": matched})
+            headers.add_vary_header("Accept-Encoding")
+            await send({"type": "http.response.start", "status": 304, "headers": headers.raw})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_validators(message: Message) -> None:
+            if message["type"] == "http.response.start" and message["status"] == 200:
+                headers = MutableHeaders(scope=message)
+                for name, value in validators.items():
+                    headers[name] = value
+            await send(message)
+
+        await self.app(scope, receive, send_with_validators)
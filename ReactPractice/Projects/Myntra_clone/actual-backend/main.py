@@ -1,116 +1,216 @@
+import secrets
 from typing import Literal
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.routing import APIRoute
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from sqlalchemy import select, update, delete, or_, and_, func, Table, MetaData, literal_column
+from sqlalchemy import select, insert, update, delete, or_
 
 import config
-from db import init_db, get_session, Item, User, BagItem, engine
-from functions import create_access_token, hash_password, verify_password, get_current_user
+import bag
+import facets
+import metrics
+from db import SessionLocal, async_engine, async_read_engine, ensure_schema, get_session, Item, ItemHash, User, BagItem
+from functions import (
+    create_access_token, hash_password_async, verify_password_async, needs_rehash, rehash_password,
+    get_current_user, get_current_user_read,
+)
+from catalog import (
+    ITEM_FIELDS, ItemQuery, item_query, parse_fields, decode_cursor, fetch_page, facet_counts, stream_json, stream_ndjson, dump_json,
+)
+from catalog_cache import catalog_cache, cached_response, streamed_response
+from ingest import mark_stale
+from compression import CompressMiddleware
+from fastjson import JSONBody
+from http_cache import ConditionalGetMiddleware
+from search import search, warm_memory_index
+from search_index import memory_index
+from suggest import suggester
+from bag_buffer import bag_buffer
+from replicas import (
+    WRITE_MARKER_HEADER, WriteMarkerMiddleware, replicas, client_wrote_recently,
+    get_catalog_session, read_session, wrote_recently,
+)
+from password_pool import password_pool
 
 @asynccontextmanager
 async def lifespan(_app: FastAPI):
-    init_db(seed_from_json=True)  # ensure tables/FTS/seed before serving
+    ensure_schema()  # version check only; `python migrate.py --seed` does DDL and seeding
+    if config.settings.SEARCH_INDEX_PRELOAD:
+        with SessionLocal() as db:
+            warm_memory_index(db)
+    if config.settings.BAG_WRITE_BEHIND:
+        bag_buffer.start()
+    replicas.start()
     yield
+    replicas.stop()
+    bag_buffer.stop()
+    password_pool.shutdown()
+    if async_engine is not None:
+        await async_engine.dispose()
+        if async_read_engine is not async_engine:
+            await async_read_engine.dispose()
 
 app = FastAPI(lifespan=lifespan)
 
+# Both take (db, user_id, ids) and return how many products changed
+bag_writes = bag_buffer if config.settings.BAG_WRITE_BEHIND else bag
+
+# Innermost first: 304s are answered inside CORS, so they still carry its headers
+app.add_middleware(
+    ConditionalGetMiddleware,
+    paths=("/items", "/search/", "/facets/"),
+    max_age=config.settings.CATALOG_HTTP_MAX_AGE_SECONDS,
+)
+app.add_middleware(
+    CompressMiddleware,
+    min_bytes=config.settings.COMPRESS_MIN_BYTES,
+    gzip_level=config.settings.COMPRESS_GZIP_LEVEL,
+    brotli_quality=config.settings.COMPRESS_BROTLI_QUALITY,
+    cache_max_bytes=config.settings.COMPRESS_CACHE_MAX_BYTES,
+)
+app.add_middleware(WriteMarkerMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=config.CORS_ALLOW_ORIGINS or ["*"],
     allow_methods=config.CORS_ALLOW_METHODS,
     allow_headers=config.CORS_ALLOW_HEADERS,
+    expose_headers=[WRITE_MARKER_HEADER],
 )
 
 # ---------------- Items ----------------
 @app.get("/items")
-def get_items(db: Session = Depends(get_session)):
-    items = db.execute(select(Item)).scalars().all()
-    return {"items": [{c.name: getattr(i, c.name) for c in i.__table__.columns} for i in items]}
+def get_items(
+    cursor: str | None = Query(None, description="Opaque cursor from a previous page's next_cursor"),
+    limit: int | None = Query(None, ge=1, le=1000, description="Page size; omit to stream the whole catalog"),
+    fields: str | None = Query(None, description="Comma separated columns to return (id is always included)"),
+    fmt: Literal["json", "ndjson"] = Query("json", alias="format", description="json or newline-delimited json"),
+    q: ItemQuery = Depends(item_query),
+    with_facets: bool = Query(False, alias="facets", description="Add category/company/price/rating/discount counts (paged json only)"),
+    db: Session = Depends(get_catalog_session),
+):
+    cols = parse_fields(fields)
+    after = decode_cursor(cursor, q.sort) if cursor else None
+    if with_facets and (limit is None or fmt != "json"):
+        raise HTTPException(status_code=400, detail="facets need a paged json listing (set limit)")
+    if fmt == "ndjson":
+        return StreamingResponse(stream_ndjson(cols, after, limit, q), media_type="application/x-ndjson")
+
+    def page():
+        body = fetch_page(db, cols, after, limit, q)
+        if with_facets:
+            body["facets"] = facet_counts(db, q)
+        return body
+
+    # Whole catalog: stream it in chunks instead of building one big list
+    if limit is None:
+        return streamed_response(("items", cols, after, q), lambda: stream_json(cols, after, q))
+    cached = cached_response(("items", cols, after, limit, q, with_facets), lambda: [dump_json(page())])
+    # None: cache disabled, or the body is over CATALOG_CACHE_MAX_BYTES
+    return cached if cached is not None else JSONBody(page())
+
+_ITEM_COLUMNS = [getattr(Item, f) for f in ITEM_FIELDS]
+# What a client may write: the id is the server's, tsv and the like are derived
+_EDITABLE_FIELDS = [f for f in ITEM_FIELDS if f != "id"]
 
 @app.post("/items", status_code=201)
 def create_item(payload: dict, db: Session = Depends(get_session)):
     import uuid
-    obj = Item(
-        id=str(uuid.uuid4()),
-        image=payload.get("image"),
-        company=payload.get("company"),
-        item_name=payload.get("item_name"),
-        original_price=payload.get("original_price"),
-        current_price=payload.get("current_price"),
-        discount_percentage=payload.get("discount_percentage"),
-        return_period=payload.get("return_period"),
-        delivery_date=payload.get("delivery_date"),
-        rating_stars=payload.get("rating_stars"),
-        rating_count=payload.get("rating_count"),
-        category=payload.get("category"),
-        tags=payload.get("tags"),
-    )
-    db.add(obj)
+    values = {f: payload.get(f) for f in _EDITABLE_FIELDS}
+    # RETURNING hands back the stored row as a tuple: no refresh, no ORM object
+    row = db.execute(insert(Item).values(id=str(uuid.uuid4()), **values).returning(*_ITEM_COLUMNS)).one()
     db.commit()
-    db.refresh(obj)
-    return {"message": "Stored new item.", "item": {c.name: getattr(obj, c.name) for c in obj.__table__.columns}}
+    catalog_cache.invalidate()
+    item = dict(zip(ITEM_FIELDS, row))
+    memory_index.upsert(item)
+    suggester.upsert(item)
+    return JSONBody({"message": "Stored new item.", "item": item}, status_code=201)
 
 @app.patch("/items/{item_id}")
 def update_item(item_id: str, payload: dict, db: Session = Depends(get_session)):
+    values = {f: payload[f] for f in _EDITABLE_FIELDS if f in payload}
+    if not values:
+        raise HTTPException(status_code=400, detail=f"nothing to update; editable fields: {', '.join(_EDITABLE_FIELDS)}")
     stmt = (
         update(Item)
         .where(Item.id == item_id)
-        .values(**{k: v for k, v in payload.items() if hasattr(Item, k)})
-        .execution_options(synchronize_session="fetch")
+        .values(**values)
+        .returning(*_ITEM_COLUMNS)
+        .execution_options(synchronize_session=False)
     )
-    res = db.execute(stmt)
-    if res.rowcount == 0:
+    row = db.execute(stmt).first()
+    if row is None:
         raise HTTPException(status_code=404, detail="item not found")
+    # Still the feed's item: the next reseed writes the feed's version back, or deletes it if the feed dropped it
+    mark_stale(db.connection(), item_id)
     db.commit()
-    obj = db.get(Item, item_id)
-    return {"item": {c.name: getattr(obj, c.name) for c in obj.__table__.columns}}
+    catalog_cache.invalidate()
+    item = dict(zip(ITEM_FIELDS, row))
+    memory_index.upsert(item)
+    suggester.upsert(item)
+    return JSONBody({"item": item})
 
 @app.delete("/items/{item_id}")
 def delete_item(item_id: str, db: Session = Depends(get_session)):
     res = db.execute(delete(Item).where(Item.id == item_id))
     if res.rowcount == 0:
         raise HTTPException(status_code=404, detail="item not found")
+    db.execute(delete(ItemHash).where(ItemHash.id == item_id))
     db.commit()
+    catalog_cache.invalidate()
+    memory_index.remove(item_id)
+    suggester.remove(item_id)
     return {"ok": True}
 
 # ---------------- Auth ----------------
+# async so waiting on the password pool doesn't hold a threadpool worker; DB calls still use one
 @app.post("/register", status_code=201)
-def register(payload: dict, db: Session = Depends(get_session)):
+async def register(payload: dict, db: Session = Depends(get_session)):
     username = (payload.get("username") or "").strip()
     password = payload.get("password") or ""
     email = (payload.get("email") or "").strip()
     if not username or not password:
         raise HTTPException(status_code=400, detail="username and password are required")
 
-    exists = db.scalar(select(User.id).where(or_(User.username == username, User.email == email)))
+    exists = await run_in_threadpool(
+        db.scalar, select(User.id).where(or_(User.username == username, User.email == email))
+    )
     if exists:
         raise HTTPException(status_code=409, detail="username already exists")
 
-    pwd_hash, salt = hash_password(password)
-    db.add(User(username=username, email=email, password_hash=pwd_hash, salt=salt))
-    try:
-        db.commit()
-    except Exception:
-        db.rollback()
-        raise HTTPException(status_code=409, detail="username already exists")
+    pwd_hash, salt = await hash_password_async(password)
+
+    def store():
+        db.add(User(username=username, email=email, password_hash=pwd_hash, salt=salt))
+        try:
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise HTTPException(status_code=409, detail="username already exists")
+
+    await run_in_threadpool(store)
     return {"message": "User created"}
 
 @app.post("/login")
-def login(payload: dict, db: Session = Depends(get_session)):
+async def login(payload: dict, background_tasks: BackgroundTasks, db: Session = Depends(get_session)):
     email = (payload.get("useremail") or "").strip()
     password = payload.get("password") or ""
     if not email or not password:
         raise HTTPException(status_code=400, detail="username and password are required")
 
-    row = db.execute(
+    row = await run_in_threadpool(lambda: db.execute(
         select(User.id, User.username, User.email, User.password_hash, User.salt).where(User.email == email)
-    ).mappings().first()
+    ).mappings().first())
 
-    if not row or not verify_password(password, row["password_hash"], row["salt"]):
+    if not row or not await verify_password_async(password, row["password_hash"], row["salt"]):
         raise HTTPException(status_code=401, detail="invalid credentials")
 
+    if needs_rehash(row["password_hash"], row["salt"]):
+        background_tasks.add_task(rehash_password, row["id"], password, row["password_hash"])
+
     token = create_access_token(str(row["id"]), extra={"username": row["username"], "email": row["email"]})
     return {
         "access_token": token,
@@ -119,7 +219,7 @@ def login(payload: dict, db: Session = Depends(get_session)):
     }
 
 @app.get("/me")
-def me(current_user: dict = Depends(get_current_user)):
+def me(current_user: dict = Depends(get_current_user_read)):
     return {"user": current_user}
 
 # ---------------- Bag (JWT user) ----------------
@@ -128,110 +228,105 @@ def add_to_bag(payload: dict, current_user: dict = Depends(get_current_user), db
     product_id = (payload.get("product_id") or "").strip()
     if not product_id:
         raise HTTPException(status_code=400, detail="product_id is required")
-    email = current_user["email"]
-
-    existing = db.get(BagItem, {"email": email, "product_id": product_id})
-    if not existing:
-        db.add(BagItem(email=email, product_id=product_id))
-        db.commit()
+    # Nothing added is either already in the bag or not in the catalog
+    if not bag_writes.add(db, current_user["id"], [product_id]) and db.get(Item, product_id) is None:
+        raise HTTPException(status_code=404, detail="product not found")
     return {"ok": True, "product_id": product_id}
 
+# Registered before /bag/{product_id} so "batch" isn't taken for a product id
+@app.post("/bag/batch", status_code=201)
+def add_to_bag_batch(payload: dict, current_user: dict = Depends(get_current_user), db: Session = Depends(get_session)):
+    ids = bag.product_ids(payload)
+    return {"ok": True, "added": bag_writes.add(db, current_user["id"], ids)}
+
+@app.delete("/bag/batch")
+def remove_from_bag_batch(payload: dict, current_user: dict = Depends(get_current_user), db: Session = Depends(get_session)):
+    ids = bag.product_ids(payload)
+    return {"ok": True, "removed": bag_writes.remove(db, current_user["id"], ids)}
+
 @app.delete("/bag/{product_id}")
 def remove_from_bag(product_id: str, current_user: dict = Depends(get_current_user), db: Session = Depends(get_session)):
-    email = current_user["email"]
-    res = db.execute(delete(BagItem).where(BagItem.email == email, BagItem.product_id == product_id))
-    if res.rowcount == 0:
+    if not bag_writes.remove(db, current_user["id"], [product_id]):
         raise HTTPException(status_code=404, detail="not found")
-    db.commit()
     return {"ok": True}
 
 @app.get("/bag/ids")
-def get_bag_ids(current_user: dict = Depends(get_current_user), db: Session = Depends(get_session)):
-    email = current_user["email"]
-    ids = db.execute(select(BagItem.product_id).where(BagItem.email == email)).scalars().all()
+def get_bag_ids(request: Request, current_user: dict = Depends(get_current_user_read)):
+    user_id = current_user["id"]
+    # A replica may not have this user's own recent taps yet, and the write-behind buffer keeps what it reads
+    primary = config.settings.BAG_WRITE_BEHIND or wrote_recently(("bag", user_id)) or client_wrote_recently(request)
+    with read_session(primary=primary) as db:
+        if config.settings.BAG_WRITE_BEHIND:
+            return {"ids": bag_buffer.ids(db, user_id)}
+        ids = db.execute(select(BagItem.product_id).where(BagItem.user_id == user_id)).scalars().all()
     return {"ids": ids}
 
+@app.get("/bag")
+def get_bag(current_user: dict = Depends(get_current_user), db: Session = Depends(get_session)):
+    # Bag rows joined to their items: everything the bag page renders, in one query
+    if config.settings.BAG_WRITE_BEHIND and bag_buffer.dirty(current_user["id"]):
+        bag_buffer.flush()  # the join reads bag_items, so write this user's taps first
+    items = bag.with_items(db, current_user["id"])
+    return JSONBody({"items": items, "count": len(items)})
+
 # ---------------- Search (ORM/Core) ----------------
 @app.get("/search/items")
 def search_items(
     q: str = Query(..., min_length=1, description="Free text search"),
     limit: int = Query(50, ge=1, le=200, description="Max items to return"),
-    mode: Literal["auto","fts","like"] = Query("auto", description="Force fts/like or auto"),
-    op:   Literal["AND","OR"] = Query("AND", description="Combine words for LIKE fallback"),
+    offset: int = Query(0, ge=0, le=config.settings.SEARCH_MAX_OFFSET, description="Results to skip; use cursor for deeper pages"),
+    cursor: str | None = Query(None, description="next_cursor from the previous page"),
+    mode: Literal["auto","fts","like","fuzzy","memory"] = Query("auto", description="Force fts/like/fuzzy/memory or auto"),
+    op:   Literal["AND","OR"] = Query("AND", description="Combine words for like/fuzzy/memory"),
+    db: Session = Depends(get_catalog_session)
+):
+    run = lambda: search(db, q, limit, offset, cursor, "fts" if mode == "auto" else mode, op)
+    cached = cached_response(("search", q, limit, offset, cursor, mode, op), lambda: [dump_json(run())])
+    return cached if cached is not None else JSONBody(run())
+
+@app.get("/search/suggest")
+def search_suggest(
+    q: str = Query(..., min_length=1, description="What the user has typed so far"),
+    limit: int = Query(5, ge=1, le=config.settings.SUGGEST_MAX_LIMIT, description="Completions to return"),
+    db: Session = Depends(get_catalog_session)
+):
+    # Answered from the in-process trie; the session is only used to (re)build it
+    warm_memory_index(db, suggester)
+    return {"suggestions": suggester.complete(q, limit)}
+
+# ---------------- Facets ----------------
+# Precomputed counts (facets.py); one value's count is a primary-key lookup
+@app.get("/facets/{facet}")
+def get_facet(
+    facet: Literal["category","company","price"],
+    limit: int | None = Query(None, ge=1, le=1000, description="Most common values only"),
     db: Session = Depends(get_session)
 ):
-    def search_like():
-        terms = [t for t in q.split() if t]
-        if not terms:
-            return []
-        if engine.dialect.name == "sqlite":
-            parts = [
-                or_(
-                    func.lower(Item.item_name).like(f"%{t.lower()}%"),
-                    func.lower(Item.company).like(f"%{t.lower()}%"),
-                    func.lower(Item.category).like(f"%{t.lower()}%"),
-                    func.lower(Item.tags).like(f"%{t.lower()}%"),
-                )
-                for t in terms
-            ]
-        else:
-            parts = [
-                or_(
-                    Item.item_name.ilike(f"%{t}%"),
-                    Item.company.ilike(f"%{t}%"),
-                    Item.category.ilike(f"%{t}%"),
-                    Item.tags.ilike(f"%{t}%"),
-                )
-                for t in terms
-            ]
-        cond = and_(*parts) if op == "AND" else or_(*parts)
-        rows = db.execute(select(Item).where(cond).limit(limit)).scalars().all()
-        return [{c.name: getattr(r, c.name) for c in r.__table__.columns} for r in rows]
-
-    def search_fts():
-        if engine.dialect.name == "postgresql":
-            ts_query = func.plainto_tsquery("simple", q)
-            rank = func.ts_rank(Item.__table__.c.tsv, ts_query)
-            stmt = (
-                select(Item, rank.label("rank"))
-                .where(Item.__table__.c.tsv.op("@@")(ts_query))
-                .order_by(desc("rank"))            # correct ordering in PG
-                .limit(limit)
-            )
-            rows = db.execute(stmt).mappings().all()
-            out = []
-            for r in rows:
-                i = r[Item]
-                out.append({c.name: getattr(i, c.name) for c in i.__table__.columns})
-            return out
-        else:
-            # ---------- SQLite FTS5 ----------
-            # Build a prefix MATCH query: phrases exact, tokens as prefixes
-            import re
-            phrases = re.findall(r'"([^"]+)"', q)
-            unquoted = re.sub(r'"[^"]+"', " ", q)
-            tokens = re.findall(r"\w+", unquoted.lower())
-            match_expr = " ".join(
-                [*(f'"{p.strip()}"' for p in phrases if p.strip()), *(f"{t}*" for t in tokens)]
-            ) or q
-
-            # Reflect FTS table so items_fts.c.id exists
-            metadata = MetaData()
-            items_fts = Table("items_fts", metadata, autoload_with=engine)
-
-            stmt = (
-                select(Item)
-                .select_from(items_fts.join(Item, Item.id == items_fts.c.id))
-                # MATCH the table (FTS5 best practice)
-                .where(literal_column("items_fts").op("MATCH")(match_expr))
-                .limit(limit)
-            )
-            rows = db.execute(stmt).scalars().all()
-            return [{c.name: getattr(r, c.name) for c in r.__table__.columns} for r in rows]
-
-    if mode in ("fts", "auto"):
-        return {"items": search_fts()}
-    return {"items": search_like()}
+    return {"facet": facet, "values": facets.values(db, facet, limit)}
+
+@app.get("/facets/{facet}/{value:path}")
+def get_facet_value(facet: Literal["category","company","price"], value: str, db: Session = Depends(get_session)):
+    return {"facet": facet, "value": value, "count": facets.count(db, facet, value)}
+
+# ---------------- Metrics ----------------
+@app.get("/metrics")
+def get_metrics(x_metrics_token: str = Header("")):
+    # Pool state and query timings are for operators: hidden unless DEBUG or the token matches
+    token = config.settings.METRICS_TOKEN
+    if not config.settings.DEBUG and not (token and secrets.compare_digest(x_metrics_token, token)):
+        raise HTTPException(status_code=404, detail="Not Found")
+    return metrics.snapshot()
+
+# ---------------- Async mode ----------------
+if config.settings.DB_ASYNC:
+    # Swap the sync routes that async_api.py also serves for its async versions
+    import async_api
+    served = {(r.path, m) for r in async_api.router.routes for m in r.methods}
+    app.router.routes = [
+        r for r in app.router.routes
+        if not (isinstance(r, APIRoute) and any((r.path, m) in served for m in r.methods))
+    ]
+    app.include_router(async_api.router)
 
 if __name__ == "__main__":
     import uvicorn
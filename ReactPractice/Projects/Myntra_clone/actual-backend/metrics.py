@@ -0,0 +1,101 @@
+from __future__ import annotations
+import bisect, threading, time
+from collections import deque
+from typing import Any, Callable, Dict, List, Sequence
+
+# Millisecond buckets suited to request/hash latencies
+DEFAULT_MS_BUCKETS: tuple[float, ...] = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+class Counter:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, n: int = 1) -> None:
+        with self._lock:
+            self.value += n
+
+    def snapshot(self) -> int:
+        return self.value
+
+class Histogram:
+    """Fixed-bucket histogram; `counts[i]` holds observations <= buckets[i], the last slot is +Inf."""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_MS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            counts, count, total, peak = list(self.counts), self.count, self.sum, self.max
+        cumulative, buckets = 0, {}
+        for le, n in zip([*map(str, self.buckets), "+Inf"], counts):
+            cumulative += n
+            buckets[le] = cumulative
+        return {
+            "count": count,
+            "sum": round(total, 3),
+            "avg": round(total / count, 3) if count else 0.0,
+            "max": round(peak, 3),
+            "buckets": buckets,
+        }
+
+class Gauge:
+    """Reads its value from a callback at snapshot time."""
+
+    def __init__(self, read: Callable[[], float]):
+        self.read = read
+
+    def snapshot(self) -> float:
+        return self.read()
+
+class EventLog:
+    """The last `maxlen` events (dicts), newest last, each stamped with its wall-clock time."""
+
+    def __init__(self, maxlen: int):
+        self._events: deque[Dict[str, Any]] = deque(maxlen=maxlen)
+
+    def record(self, event: Dict[str, Any]) -> None:
+        self._events.append({"at": round(time.time(), 3), **event})
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        return list(self._events)
+
+_registry: Dict[str, Counter | Histogram | Gauge | EventLog] = {}
+_registry_lock = threading.Lock()
+
+def _register(name: str, factory: Callable[[], Any]) -> Any:
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = factory()
+        return metric
+
+def counter(name: str) -> Counter:
+    return _register(name, Counter)
+
+def histogram(name: str, buckets: Sequence[float] = DEFAULT_MS_BUCKETS) -> Histogram:
+    return _register(name, lambda: Histogram(buckets))
+
+def gauge(name: str, read: Callable[[], float]) -> Gauge:
+    return _register(name, lambda: Gauge(read))
+
+def events(name: str, maxlen: int = 100) -> EventLog:
+    return _register(name, lambda: EventLog(maxlen))
+
+def snapshot() -> Dict[str, Any]:
+    with _registry_lock:
+        items = sorted(_registry.items())
+    return {name: metric.snapshot() for name, metric in items}
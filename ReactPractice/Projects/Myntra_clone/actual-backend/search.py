@@ -0,0 +1,252 @@
+from __future__ import annotations
+import base64, json, re
+from functools import lru_cache
+from typing import Any, Dict, Literal, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import select, func, or_, and_, cast, bindparam, column, table, text, Float, literal_column
+from sqlalchemy.orm import Session
+
+from catalog import ITEM_FIELDS
+from config import settings
+from db import Item, engine, SEARCH_TEXT_SQL
+from search_index import memory_index
+from suggest import suggester
+
+Mode = Literal["fts", "like", "fuzzy", "memory"]
+
+# Postgres generated tsvector column (not part of the public item fields)
+_tsv = literal_column("items.tsv")
+# Lower-cased concatenation of the searchable columns, as indexed by idx_items_trgm
+_search_text = literal_column(SEARCH_TEXT_SQL)
+
+# ---------- Search-after cursor ----------
+def encode_search_cursor(score: float | None, last_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([score, last_id]).encode()).decode().rstrip("=")
+
+def decode_search_cursor(cursor: str) -> Tuple[float | None, str]:
+    try:
+        score, last_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return (None if score is None else float(score)), str(last_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid cursor")
+
+# ---------- Statements ----------
+# FTS5 virtual table (created in db._sqlite_setup); declared here instead of reflected per request
+items_fts = table("items_fts", column("id"), column("item_name"), column("company"), column("category"), column("tags"))
+# FTS5 trigram table for substring/fuzzy search (db._sqlite_trigram_setup)
+items_trgm = table("items_trgm", column("id"), column("item_name"), column("company"), column("category"), column("tags"))
+_COLUMNS = [getattr(Item, f) for f in ITEM_FIELDS]
+
+def _fts5_match(q: str) -> str | None:
+    """Prefix MATCH expression: quoted phrases stay exact, bare words become prefixes."""
+    phrases = re.findall(r'"([^"]+)"', q)
+    unquoted = re.sub(r'"[^"]+"', " ", q)
+    tokens = re.findall(r"\w+", unquoted.lower())
+    parts = [*(f'"{p.strip()}"' for p in phrases if p.strip()), *(f"{t}*" for t in tokens)]
+    return " ".join(parts) or None
+
+def _phrase(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+def _trigram_match(terms: list[str], op: str, fuzzy: bool) -> str | None:
+    """MATCH expression for items_trgm, or None when the index can't answer it.
+
+    Substring: every term as a phrase, which needs at least 3 characters.
+    Fuzzy: any trigram of any term or of its adjacent-letter swaps; bm25 then
+    ranks items sharing the most trigrams first, so a typo only costs the few
+    trigrams it touches (and a swap like "shrit" still reaches "shirt").
+    """
+    if fuzzy:
+        variants = [v for t in terms for v in (t, *(t[:i] + t[i + 1] + t[i] + t[i + 2:] for i in range(len(t) - 1)))]
+        grams = dict.fromkeys(v[i:i + 3] for v in variants for i in range(len(v) - 2))
+        return " OR ".join(_phrase(g) for g in grams) or None
+    if any(len(t) < 3 for t in terms):
+        return None
+    return f" {op} ".join(_phrase(t) for t in terms)
+
+_trigram: Dict[str, bool] = {}
+
+def _trigram_ready(db: Session) -> bool:
+    """Whether migration 2 could build the trigram index (FTS5 trigram / pg_trgm); looked up once.
+
+    Asks through the request's session, so the async endpoints don't touch the sync engine.
+    """
+    if "ready" not in _trigram:
+        if engine.dialect.name == "sqlite":
+            found = db.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'items_trgm'")).first()
+        else:
+            found = db.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first()
+        _trigram["ready"] = found is not None
+    return _trigram["ready"]
+
+def _matches(kind: str, n_terms: int, op: str):
+    """(id query over the matching items, score expression or None) for one query shape."""
+    if kind == "fts5":
+        # bm25() is lower-is-better; negate it so a higher score always means more relevant
+        score = -func.bm25(literal_column("items_fts"))
+        stmt = (
+            select(Item.id)
+            .select_from(items_fts.join(Item, Item.id == items_fts.c.id))
+            .where(literal_column("items_fts").op("MATCH")(bindparam("q")))
+        )
+        return stmt, score
+    if kind in ("trgm5", "fuzzy5"):
+        stmt = (
+            select(Item.id)
+            .select_from(items_trgm.join(Item, Item.id == items_trgm.c.id))
+            .where(literal_column("items_trgm").op("MATCH")(bindparam("q")))
+        )
+        return stmt, (-func.bm25(literal_column("items_trgm")) if kind == "fuzzy5" else None)
+    if kind == "tsquery":
+        ts_query = func.plainto_tsquery("simple", bindparam("q"))
+        # ts_rank_cd is float4; as double the score survives the cursor round trip exactly
+        return select(Item.id).where(_tsv.op("@@")(ts_query)), cast(func.ts_rank_cd(_tsv, ts_query), Float)
+
+    terms = [bindparam(f"t{i}") for i in range(n_terms)]
+    combine = and_ if op == "AND" else or_
+    if kind == "trgm_pg":
+        # LIKE on the indexed expression lets the pg_trgm GIN index find substrings
+        return select(Item.id).where(combine(*(_search_text.like(t) for t in terms))), None
+    if kind == "fuzzy_pg":
+        # <% is word_similarity above pg_trgm.word_similarity_threshold, also served by the index
+        cond = combine(*(t.op("<%")(_search_text) for t in terms))
+        sims = [func.word_similarity(t, _search_text) for t in terms]
+        score = sum(sims[1:], sims[0])
+        return select(Item.id).where(cond), cast(score, Float)
+
+    # Unindexed scan, for when no trigram index is available
+    cols = (Item.item_name, Item.company, Item.category, Item.tags)
+    if engine.dialect.name == "sqlite":
+        parts = [or_(*(func.lower(c).like(t) for c in cols)) for t in terms]
+    else:
+        parts = [or_(*(c.ilike(t) for c in cols)) for t in terms]
+    return select(Item.id).where(combine(*parts)), None
+
+@lru_cache(maxsize=256)
+def _statements(kind: str, paging: str, n_terms: int = 0, op: str = "AND"):
+    """(count, page, has score) statements for a query shape, built once; values are bound at execute.
+
+    Reusing the same statement objects lets SQLAlchemy skip rebuilding them
+    and hit its compiled-statement cache on every call.
+    """
+    matches, score = _matches(kind, n_terms, op)
+    count = select(func.count()).select_from(matches.limit(bindparam("cap")).subquery())
+    if score is None:
+        page = matches.with_only_columns(*_COLUMNS).order_by(Item.id)
+    else:
+        page = matches.with_only_columns(*_COLUMNS, score.label("score")).order_by(score.desc(), Item.id)
+    if paging == "cursor":
+        if score is None:
+            page = page.where(Item.id > bindparam("last_id"))
+        else:
+            last_score = bindparam("last_score", type_=Float)
+            page = page.where(or_(score < last_score, and_(score == last_score, Item.id > bindparam("last_id"))))
+    elif paging == "offset":
+        page = page.offset(bindparam("offset"))
+    return count, page.limit(bindparam("limit")), score is not None
+
+# ---------- Search ----------
+def warm_memory_index(db: Session, *indexes) -> None:
+    """(Re)build in-process indexes (default: all) from the items table if missing or past their TTL."""
+    stale = [ix for ix in (indexes or (memory_index, suggester)) if ix.stale()]
+    if stale:
+        rows = db.execute(select(*_COLUMNS)).mappings().all()
+        for ix in stale:
+            ix.load(rows)
+
+def _memory_search(db: Session, q: str, limit: int, offset: int, cursor: str | None, op: str) -> Dict[str, Any]:
+    warm_memory_index(db, memory_index)
+    after = None
+    if cursor:
+        last_score, last_id = decode_search_cursor(cursor)
+        if last_score is None:
+            raise HTTPException(status_code=400, detail="invalid cursor")
+        after = (last_score, last_id)
+    hits, page = memory_index.search(q, limit + 1, offset, after, op)
+    has_more = len(page) > limit
+    page = page[:limit]
+    cap = settings.SEARCH_TOTAL_HITS_CAP
+    return {
+        "items": [{**row, "score": score} for score, row in page],
+        "total": {"value": min(hits, cap), "relation": "gte" if hits > cap else "eq"},
+        "next_cursor": encode_search_cursor(page[-1][0], page[-1][1]["id"]) if has_more else None,
+    }
+
+def search(
+    db: Session,
+    q: str,
+    limit: int,
+    offset: int = 0,
+    cursor: str | None = None,
+    mode: Mode = "fts",
+    op: Literal["AND", "OR"] = "AND",
+) -> Dict[str, Any]:
+    """One ranked page of matches plus a capped hit count.
+
+    FTS results are ordered by relevance (bm25 on SQLite, ts_rank_cd on
+    Postgres) with id as tie-breaker. "like" finds substrings through the
+    trigram index (FTS5 trigram / pg_trgm) and orders by id; "fuzzy" ranks by
+    trigram overlap, so misspelt terms still match. Both fall back to a LIKE
+    scan when the index is missing or a term is too short for it. "memory"
+    answers from the in-process inverted index (search_index.py) with BM25
+    over prefix matches, without a database round trip once it is built.
+
+    Pass either `offset` or the previous page's `next_cursor`: the cursor
+    resumes after the last (score, id) seen, so deep pages don't materialise
+    and skip the rows in front of them. `total` counts at most
+    SEARCH_TOTAL_HITS_CAP matches and says "gte" when there are more.
+    """
+    if cursor and offset:
+        raise HTTPException(status_code=400, detail="use either offset or cursor, not both")
+    if mode == "memory":
+        return _memory_search(db, q, limit, offset, cursor, op)
+    empty = {"items": [], "total": {"value": 0, "relation": "eq"}, "next_cursor": None}
+    params: Dict[str, Any] = {}
+    n_terms = 0
+    if mode in ("like", "fuzzy"):
+        terms = [t.lower() for t in q.split()]
+        if not terms:
+            return empty
+        fuzzy = mode == "fuzzy"
+        if not _trigram_ready(db):
+            kind = "like"
+        elif engine.dialect.name == "sqlite":
+            params["q"] = _trigram_match(terms, op, fuzzy)
+            kind = "like" if params["q"] is None else "fuzzy5" if fuzzy else "trgm5"
+        else:
+            kind = "fuzzy_pg" if fuzzy else "trgm_pg"
+        if kind in ("like", "trgm_pg", "fuzzy_pg"):
+            params.pop("q", None)
+            params.update({f"t{i}": t if kind == "fuzzy_pg" else f"%{t}%" for i, t in enumerate(terms)})
+            n_terms = len(terms)
+    elif engine.dialect.name == "sqlite":
+        kind = "fts5"
+        params["q"] = _fts5_match(q)
+        if params["q"] is None:
+            return empty
+    else:
+        kind = "tsquery"
+        params["q"] = q
+
+    paging = "cursor" if cursor else "offset" if offset else "first"
+    count, page, scored = _statements(kind, paging, n_terms, op if n_terms else "AND")
+
+    cap = settings.SEARCH_TOTAL_HITS_CAP
+    hits = db.execute(count, {**params, "cap": cap + 1}).scalar()
+
+    if cursor:
+        last_score, last_id = decode_search_cursor(cursor)
+        if scored and last_score is None:
+            raise HTTPException(status_code=400, detail="invalid cursor")
+        params.update(last_score=last_score, last_id=last_id)
+    elif offset:
+        params["offset"] = offset
+    rows = db.execute(page, {**params, "limit": limit + 1}).mappings().all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "items": [dict(r) for r in rows],
+        "total": {"value": min(hits, cap), "relation": "gte" if hits > cap else "eq"},
+        "next_cursor": encode_search_cursor(rows[-1].get("score"), rows[-1]["id"]) if has_more else None,
+    }
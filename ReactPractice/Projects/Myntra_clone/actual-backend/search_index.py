@@ -0,0 +1,202 @@
+from __future__ import annotations
+import bisect, heapq, math, re, threading, time
+from array import array
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Mapping, Tuple
+
+from catalog import ITEM_FIELDS
+from config import settings
+
+# Searchable columns, the same ones items_fts and idx_items_tsv cover
+TEXT_FIELDS = ("item_name", "company", "category", "tags")
+_TOKEN = re.compile(r"\w+")
+# Per-word score maps kept between writes; type-ahead repeats the same prefixes
+SCORE_CACHE_SIZE = 1024
+# BM25 parameters (the usual defaults, as in SQLite's bm25())
+K1 = 1.2
+B = 0.75
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text.lower())
+
+class SearchIndex:
+    """In-process inverted index over the item catalog (search mode=memory).
+
+    Documents are numbered in insertion order, so every posting list is an
+    append-only pair of arrays (doc numbers ascending, term frequencies).
+    Changing or removing an item tombstones its old number; the lists are
+    compacted once dead documents outnumber live ones. The index only sees
+    writes made through this process: `ttl` bounds how stale it gets with
+    respect to other workers and offline reseeds.
+    """
+
+    def __init__(self, ttl: float, max_expansions: int):
+        self.ttl = ttl
+        self.max_expansions = max_expansions
+        self._lock = threading.RLock()
+        self._built_at: float | None = None
+        self._reset()
+
+    def _reset(self) -> None:
+        self._ids: List[str | None] = []          # doc number -> item id, None once dead
+        self._rows: List[Dict[str, Any] | None] = []
+        self._lens = array("I")                   # doc number -> token count
+        self._docno: Dict[str, int] = {}
+        self._postings: Dict[str, array] = {}     # term -> doc numbers
+        self._freqs: Dict[str, array] = {}        # term -> term frequency, parallel to _postings
+        self._vocab: List[str] = []               # sorted terms, for prefix lookups
+        self._live = 0
+        self._total_len = 0
+        self._score_cache: Dict[str, Dict[int, float]] = {}
+
+    # ---------- Maintenance ----------
+    def stale(self) -> bool:
+        with self._lock:
+            if self._built_at is None:
+                return True
+            return bool(self.ttl) and time.monotonic() - self._built_at > self.ttl
+
+    def invalidate(self) -> None:
+        """Rebuild on the next query (after writes this process can't replay one by one)."""
+        with self._lock:
+            self._built_at = None
+
+    def load(self, rows: Iterable[Mapping[str, Any]]) -> None:
+        """Replace the whole index with `rows`."""
+        with self._lock:
+            self._reset()
+            for row in rows:
+                self._add(row)
+            self._vocab = sorted(self._postings)
+            self._built_at = time.monotonic()
+
+    def upsert(self, row: Mapping[str, Any]) -> None:
+        with self._lock:
+            if self._built_at is None:
+                return  # nothing to keep in sync yet; the next load reads the table
+            self._score_cache.clear()
+            self._drop(row["id"])
+            for term in self._add(row):
+                bisect.insort(self._vocab, term)
+            self._maybe_compact()
+
+    def remove(self, item_id: str) -> None:
+        with self._lock:
+            if self._built_at is not None:
+                self._score_cache.clear()
+                self._drop(item_id)
+                self._maybe_compact()
+
+    def _add(self, row: Mapping[str, Any]) -> List[str]:
+        """Index one row under a new doc number; returns the terms it added to the vocabulary."""
+        doc = len(self._ids)
+        tokens = tokenize(" ".join(str(row[f]) for f in TEXT_FIELDS if row.get(f)))
+        new_terms = []
+        for term, tf in Counter(tokens).items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = array("I")
+                self._freqs[term] = array("H")
+                new_terms.append(term)
+            postings.append(doc)
+            self._freqs[term].append(min(tf, 0xFFFF))
+        self._ids.append(row["id"])
+        self._rows.append({f: row.get(f) for f in ITEM_FIELDS})
+        self._lens.append(len(tokens))
+        self._docno[row["id"]] = doc
+        self._live += 1
+        self._total_len += len(tokens)
+        return new_terms
+
+    def _drop(self, item_id: str) -> None:
+        doc = self._docno.pop(item_id, None)
+        if doc is None:
+            return
+        self._ids[doc] = None
+        self._rows[doc] = None
+        self._live -= 1
+        self._total_len -= self._lens[doc]
+
+    def _maybe_compact(self) -> None:
+        if len(self._ids) - self._live > max(self._live, 1000):
+            self.load([r for r in self._rows if r is not None])
+
+    # ---------- Query ----------
+    def _expand(self, prefix: str) -> List[str]:
+        """Vocabulary terms starting with `prefix`, the exact term first, at most max_expansions."""
+        start = bisect.bisect_left(self._vocab, prefix)
+        out = []
+        for term in self._vocab[start:start + self.max_expansions]:
+            if not term.startswith(prefix):
+                break
+            out.append(term)
+        return out
+
+    def _term_scores(self, prefix: str) -> Dict[int, float]:
+        """BM25 contribution of one query word per live document it prefixes.
+
+        A document matching several expansions keeps its best one, so a short
+        prefix doesn't favour documents that merely contain many words.
+        """
+        cached = self._score_cache.get(prefix)
+        if cached is not None:
+            return cached
+        n = max(self._live, 1)
+        avgdl = self._total_len / n or 1.0
+        ids, lens = self._ids, self._lens
+        scores: Dict[int, float] = {}
+        for term in self._expand(prefix):
+            postings, freqs = self._postings[term], self._freqs[term]
+            df = len(postings)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for doc, tf in zip(postings, freqs):
+                if ids[doc] is None:
+                    continue
+                s = idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * lens[doc] / avgdl))
+                if s > scores.get(doc, 0.0):
+                    scores[doc] = s
+        if len(self._score_cache) >= SCORE_CACHE_SIZE:
+            self._score_cache.clear()
+        self._score_cache[prefix] = scores
+        return scores
+
+    def search(
+        self,
+        q: str,
+        limit: int,
+        offset: int = 0,
+        after: Tuple[float, str] | None = None,
+        op: str = "AND",
+    ) -> Tuple[int, List[Tuple[float, Dict[str, Any]]]]:
+        """(hit count, page of (score, row)) ordered by score desc, then id.
+
+        Every query word is a prefix. `after` is the (score, id) of the last
+        row already served and takes the place of `offset`.
+        """
+        words = list(dict.fromkeys(tokenize(q)))
+        if not words:
+            return 0, []
+        with self._lock:
+            per_word = sorted((self._term_scores(w) for w in words), key=len)
+            if op == "AND":
+                # Intersect from the rarest word so the candidate set only shrinks
+                total = dict(per_word[0])
+                for scores in per_word[1:]:
+                    total = {d: s + scores[d] for d, s in total.items() if d in scores}
+            else:
+                total = {}
+                for scores in per_word:
+                    for d, s in scores.items():
+                        total[d] = total.get(d, 0.0) + s
+            ids = self._ids
+            keys = ((-s, ids[d], d) for d, s in total.items())
+            if after is not None:
+                last = (-after[0], after[1])
+                keys = (k for k in keys if k[:2] > last)
+            top = heapq.nsmallest(offset + limit, keys)[offset:]
+            return len(total), [(-neg, self._rows[d]) for neg, _, d in top]
+
+memory_index = SearchIndex(
+    ttl=settings.SEARCH_INDEX_TTL_SECONDS,
+    max_expansions=settings.SEARCH_INDEX_MAX_EXPANSIONS,
+)